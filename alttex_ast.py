@@ -0,0 +1,665 @@
+'''
+alttex_ast
+
+Parses an equation once into a tree of nodes (groups, commands, fractions,
+subscripts and superscripts, and environments), and renders alt text from the
+tree. Both passes take time in proportion to the length of the equation, and
+the tree can be reused by other tools, e.g.
+    tree = parse_math(r'\frac{a}{b} + x_{i}^{2}')
+    render_equation(tree, symbols, special_symbols)
+
+Classes:
+    Atom
+    Command
+    Environment
+    Fraction
+    Group
+    Node
+    Renderer
+    Script
+
+Functions:
+    iter_nodes
+    parse_math
+    render_equation
+'''
+
+from alttex_functions import (UnbalancedBracesError, _known_start,
+                              checkpoint, diagnostic)
+
+# Number of brace arguments of commands that take them
+ARGUMENTS = {
+    'sqrt': 1, 'hat': 1, 'dot': 1, 'ddot': 1, 'bar': 1, 'vec': 1,
+    'tilde': 1, 'overline': 1, 'underline': 1, 'text': 1, 'mathrm': 1,
+    'mathbf': 1, 'mathit': 1, 'mathcal': 1, 'label': 1,
+    'hspace': 1, 'vspace': 1, 'operatorname': 1,
+}
+FRACTIONS = ('frac', 'dfrac', 'tfrac')
+# Commands whose arguments are written out as they are
+TEXT_COMMANDS = ('text', 'mathrm', 'mathbf', 'mathit', 'mathcal',
+                 'operatorname')
+# Commands with no alt text (and whose arguments are also left out)
+SILENT_COMMANDS = ('left', 'right', 'rm', 'label', 'hspace', 'vspace',
+                   'nonumber', 'displaystyle', ',', ':', ';', '!', ' ')
+ACCENTS = ('hat', 'dot', 'ddot', 'bar', 'vec', 'tilde', 'overline',
+           'underline')
+BIG_OPERATORS = ('sum', 'int', 'prod', 'oint', 'iint', 'bigcup', 'bigcap')
+BRACKETS = '()[]'
+DIGITS = '0123456789'
+
+
+class Node:
+    '''
+    Class to represent any node of the tree
+
+    Attributes:
+        start (int) : Index of the start of the node in the equation
+        end (int) : Index of the end of the node in the equation
+    '''
+    __slots__ = ('start', 'end')
+
+    def children(self):
+        '''
+        Function to list the nodes directly within this node
+
+        Returns:
+            children (list) : Child nodes (empty for an Atom)
+        '''
+        return []
+
+    def __repr__(self):
+        fields = ', '.join('%s=%r' % (name, getattr(self, name))
+                           for name in self.__slots__)
+        return '%s(%s)' % (type(self).__name__, fields)
+
+
+class Atom(Node):
+    '''
+    Class to represent a number, a run of letters or a single character
+
+    Attributes:
+        kind (str) : 'number', 'letters', 'bracket', 'newline' (for '\\\\'),
+            'align' (for '&') or 'char'
+        value (str) : Text of the atom
+    '''
+    __slots__ = ('kind', 'value')
+
+    def __init__(self, kind, value, start, end):
+        self.kind = kind
+        self.value = value
+        self.start = start
+        self.end = end
+
+
+class Group(Node):
+    '''
+    Class to represent the contents of a pair of braces
+
+    Attributes:
+        nodes (list) : Nodes within the braces
+    '''
+    __slots__ = ('nodes',)
+
+    def __init__(self, nodes, start, end):
+        self.nodes = nodes
+        self.start = start
+        self.end = end
+
+    def children(self):
+        return self.nodes
+
+
+class Command(Node):
+    '''
+    Class to represent a command, e.g. '\\alpha' or '\\sqrt{x}'
+
+    Attributes:
+        name (str) : Name of the command without the backslash
+        args (list) : Groups (or single nodes) of the command's arguments
+        option (Group) : Optional argument in square brackets (or None)
+    '''
+    __slots__ = ('name', 'args', 'option')
+
+    def __init__(self, name, args, option, start, end):
+        self.name = name
+        self.args = args
+        self.option = option
+        self.start = start
+        self.end = end
+
+    def children(self):
+        return ([self.option] if self.option is not None else []) + self.args
+
+
+class Fraction(Node):
+    '''
+    Class to represent a fraction
+
+    Attributes:
+        numerator (Node) : Group (or single node) of the numerator
+        denominator (Node) : Group (or single node) of the denominator
+    '''
+    __slots__ = ('numerator', 'denominator')
+
+    def __init__(self, numerator, denominator, start, end):
+        self.numerator = numerator
+        self.denominator = denominator
+        self.start = start
+        self.end = end
+
+    def children(self):
+        return [self.numerator, self.denominator]
+
+
+class Script(Node):
+    '''
+    Class to represent a node with a subscript and/or superscript
+
+    Attributes:
+        base (Node) : Node the scripts are attached to (None if there is
+            nothing before them)
+        sub (Node) : Subscript (or None)
+        sup (Node) : Superscript (or None)
+    '''
+    __slots__ = ('base', 'sub', 'sup')
+
+    def __init__(self, base, sub, sup, start, end):
+        self.base = base
+        self.sub = sub
+        self.sup = sup
+        self.start = start
+        self.end = end
+
+    def children(self):
+        return [node for node in (self.base, self.sub, self.sup)
+                if node is not None]
+
+
+class Environment(Node):
+    '''
+    Class to represent an environment, e.g. '\\begin{array}...\\end{array}'
+
+    Attributes:
+        name (str) : Name of the environment
+        spec (Group) : Column specification (or None)
+        rows (list) : Rows of the environment, each a list of cells, where
+            each cell is a list of nodes
+    '''
+    __slots__ = ('name', 'spec', 'rows')
+
+    def __init__(self, name, spec, rows, start, end):
+        self.name = name
+        self.spec = spec
+        self.rows = rows
+        self.start = start
+        self.end = end
+
+    def children(self):
+        return [node for row in self.rows for cell in row for node in cell]
+
+
+def iter_nodes(node):
+    '''
+    Function to visit every node of a tree, parents before their children
+
+    Parameters:
+        node (Node) : Root of the tree (e.g. from 'parse_math')
+
+    Yields:
+        node (Node) : Next node of the tree
+    '''
+    stack = [node]
+    while stack != []:
+        node = stack.pop()
+        yield node
+        stack.extend(reversed(node.children()))
+
+
+def parse_math(equation):
+    '''
+    Function to parse an equation into a tree of nodes in a single pass
+
+    Parameters:
+        equation (str) : Equation within math text (without delimiters)
+
+    Returns:
+        tree (Group) : Group of the top level nodes of 'equation'
+    '''
+    parser = _Parser(equation)
+    nodes = parser.sequence(None)
+    return Group(nodes, 0, len(equation))
+
+
+class _Parser:
+    # Recursive descent over the equation, where 'index' only moves forward
+
+    def __init__(self, equation):
+        self.equation = equation
+        self.length = len(equation)
+        self.index = 0
+
+    def sequence(self, closer):
+        # Nodes up to the close brace (or '\end{closer}' of an environment)
+        nodes = []
+        equation = self.equation
+        while self.index < self.length:
+            checkpoint()
+            char = equation[self.index]
+            start = self.index
+            if char in ' \t\n\r':
+                self.index += 1
+            elif char == '}':
+                if closer != '}':
+                    raise UnbalancedBracesError(
+                        'No open brace for the close brace at index %d of '
+                        '%r' % (start, equation))
+                self.index += 1
+                return nodes
+            elif char in '^_':
+                self.index += 1
+                argument = self.argument()
+                base = nodes.pop() if nodes != [] else None
+                # 'x_{i}^{2}' is one script node with both scripts
+                if (isinstance(base, Script) and
+                        getattr(base, 'sub' if char == '_' else 'sup')
+                        is None):
+                    script = base
+                else:
+                    script = Script(base, None, None,
+                                    start if base is None else base.start,
+                                    start)
+                if char == '_':
+                    script.sub = argument
+                else:
+                    script.sup = argument
+                script.end = self.index
+                nodes.append(script)
+            elif (char == '\\' and closer is not None and closer != '}' and
+                    equation.startswith('\\end{' + closer + '}', start)):
+                self.index += len(closer) + 6
+                return nodes
+            else:
+                nodes.append(self.node())
+        if closer is not None:
+            raise UnbalancedBracesError(
+                'No close brace for the open brace in %r' % equation)
+        return nodes
+
+    def node(self):
+        equation = self.equation
+        start = self.index
+        char = equation[start]
+        if char == '{':
+            self.index += 1
+            nodes = self.sequence('}')
+            return Group(nodes, start, self.index)
+        if char == '\\':
+            return self.command()
+        self.index += 1
+        if char in DIGITS:
+            while (self.index < self.length and
+                   equation[self.index] in DIGITS):
+                self.index += 1
+            if (self.index < self.length and equation[self.index] == '.'):
+                self.index += 1
+                while (self.index < self.length and
+                       equation[self.index] in DIGITS):
+                    self.index += 1
+            return Atom('number', equation[start:self.index], start,
+                        self.index)
+        if char.isalpha() and char.isascii():
+            while (self.index < self.length and
+                   equation[self.index].isalpha() and
+                   equation[self.index].isascii()):
+                self.index += 1
+            return Atom('letters', equation[start:self.index], start,
+                        self.index)
+        if char in BRACKETS:
+            return Atom('bracket', char, start, self.index)
+        if char == '&':
+            return Atom('align', char, start, self.index)
+        return Atom('char', char, start, self.index)
+
+    def argument(self):
+        # A brace group, a command, or else a single character (as in
+        # 'x^2', where only the '2' is the superscript)
+        while (self.index < self.length and
+               self.equation[self.index] in ' \t\n\r'):
+            self.index += 1
+        if self.index >= self.length:
+            return Group([], self.index, self.index)
+        char = self.equation[self.index]
+        if char in '{\\':
+            return self.node()
+        start = self.index
+        self.index += 1
+        if char in DIGITS:
+            return Atom('number', char, start, self.index)
+        if char.isalpha():
+            return Atom('letters', char, start, self.index)
+        return Atom('char', char, start, self.index)
+
+    def command(self):
+        equation = self.equation
+        start = self.index
+        index = start + 1
+        if index >= self.length:
+            self.index = index
+            return Atom('char', '\\', start, index)
+        if equation[index] == '\\':
+            self.index = index + 1
+            return Atom('newline', '\\\\', start, self.index)
+        if not (equation[index].isalpha() and equation[index].isascii()):
+            self.index = index + 1
+            if equation[index] in '{}':
+                return Atom('bracket', equation[index], start, self.index)
+            return Command(equation[index], [], None, start, self.index)
+        while (index < self.length and equation[index].isalpha() and
+               equation[index].isascii()):
+            index += 1
+        name = equation[start + 1:index]
+        self.index = index
+        if name in FRACTIONS:
+            numerator = self.argument()
+            denominator = self.argument()
+            return Fraction(numerator, denominator, start, self.index)
+        if name == 'begin':
+            return self.environment(start)
+        option = None
+        if name == 'sqrt' and equation.startswith('[', self.index):
+            close = equation.find(']', self.index)
+            if close >= 0:
+                inner = _Parser(equation[self.index + 1:close])
+                option = Group(inner.sequence(None), self.index, close + 1)
+                self.index = close + 1
+        args = [self.argument() for _ in range(ARGUMENTS.get(name, 0))]
+        return Command(name, args, option, start, self.index)
+
+    def environment(self, start):
+        group = self.argument()
+        name = ''.join(node.value for node in getattr(group, 'nodes', [])
+                       if isinstance(node, Atom))
+        spec = None
+        if name in ('array', 'tabular') and self.equation.startswith(
+                '{', self.index):
+            spec = self.node()
+        nodes = self.sequence(name)
+        rows = [[[]]]
+        for node in nodes:
+            if isinstance(node, Atom) and node.kind == 'newline':
+                rows.append([[]])
+            elif isinstance(node, Atom) and node.kind == 'align':
+                rows[-1].append([])
+            else:
+                rows[-1][-1].append(node)
+        if rows[-1] == [[]] and len(rows) > 1:
+            rows.pop()
+        return Environment(name, spec, rows, start, self.index)
+
+
+class Renderer:
+    '''
+    Class to render alt text from a tree made by 'parse_math'
+
+    Renderers keep no state between calls, so one can be shared by many
+    threads. The alt text of every node of a tree is added to one list,
+    which is only joined once the whole tree is rendered.
+
+    Attributes:
+        symbols (SymbolTable) : Table of LaTeX symbols in csv file with their
+            alt text
+        special_symbols (dict) : Dictionary of math symbols to be replaced
+    '''
+
+    def __init__(self, symbols, special_symbols):
+        '''
+        Parameters:
+            symbols (SymbolTable) : Table of LaTeX symbols in csv file with
+                their alt text
+            special_symbols (dict) : Dictionary of math symbols to be
+                replaced
+        '''
+        self.symbols = symbols
+        self.special_symbols = special_symbols
+        self._render = {Atom: self._atom, Group: self._group,
+                        Command: self._command, Fraction: self._fraction,
+                        Script: self._script,
+                        Environment: self._environment}
+
+    def render(self, node):
+        '''
+        Function to render the alt text of a node and its children
+
+        Parameters:
+            node (Node) : Node of a tree from 'parse_math'
+
+        Returns:
+            alt_text (str) : Alt text of 'node', with single spaces between
+                words
+        '''
+        parts = []
+        self._render[type(node)](node, parts)
+        return ' '.join(''.join(parts).split())
+
+    def _nodes(self, nodes, parts):
+        for node in nodes:
+            checkpoint()
+            self._render[type(node)](node, parts)
+
+    def _node(self, node, parts):
+        self._render[type(node)](node, parts)
+
+    def _bracketed(self, node, parts, opener='(', closer=')'):
+        # Alt text of 'node' between brackets, with no space inside them
+        parts.append(opener)
+        start = len(parts)
+        self._node(node, parts)
+        _strip(parts, start)
+        parts.append(closer)
+
+    def _atom(self, atom, parts):
+        if atom.kind == 'letters':
+            if len(atom.value) == 1 and atom.value.isupper():
+                parts.append(' uppercase ' + atom.value + ' ')
+            else:
+                parts.append(' ' + atom.value + ' ')
+        elif atom.kind == 'newline':
+            parts.append(' newline ')
+        elif atom.kind == 'align':
+            parts.append(' ')
+        elif atom.kind == 'char':
+            if atom.value == "'":
+                parts.append(' prime ')
+            else:
+                parts.append(' ' + self.special_symbols.get(atom.value,
+                                                            atom.value) +
+                             ' ')
+        else:
+            parts.append(' ' + atom.value + ' ')
+
+    def _group(self, group, parts):
+        self._nodes(group.nodes, parts)
+
+    def _command(self, command, parts):
+        name = command.name
+        if name in SILENT_COMMANDS:
+            return
+        if name in TEXT_COMMANDS:
+            for arg in command.args:
+                parts.append(' ' + self._source(arg) + ' ')
+            return
+        if name == 'sqrt':
+            if command.option is not None:
+                parts.append(' root ')
+                self._node(command.option, parts)
+                parts.append(' of (')
+            else:
+                parts.append(' root of (')
+            self._nodes(command.args, parts)
+            parts.append(') ')
+            return
+        if name in ACCENTS:
+            self._nodes(command.args, parts)
+            parts.append(' ' + self._alt_command(name) + ' ')
+            return
+        if name not in self.symbols:
+            known = _known_start(name, self.symbols)
+            if known is not None:
+                # The rest of the name is read as the text after it
+                parts.append(' ' + self.symbols[known] + ' ' +
+                             name[len(known):] + ' ')
+                self._nodes(command.args, parts)
+                return
+            diagnostic('unknown command', '\\' + name)
+        parts.append(' ' + self._alt_command(name) + ' ')
+        self._nodes(command.args, parts)
+
+    def _fraction(self, fraction, parts):
+        # The words before the numerator and denominator are filled in once
+        # both are rendered, as they depend on how long the two are
+        opener = len(parts)
+        parts.append('')
+        self._node(fraction.numerator, parts)
+        middle = len(parts)
+        parts.append('')
+        self._node(fraction.denominator, parts)
+        if (_short(parts, opener + 1, middle) and
+                _short(parts, middle + 1, len(parts))):
+            parts[middle] = ' over '
+        else:
+            parts[opener] = ' fraction with numerator '
+            parts[middle] = ' and denominator '
+        parts.append(' end fraction ')
+
+    def _script(self, script, parts):
+        base = script.base
+        name = base.name if isinstance(base, Command) else None
+        if name in BIG_OPERATORS:
+            parts.append(' ' + self._alt_command(name) + ' ')
+            if script.sub is not None:
+                parts.append(' from ' if script.sup is not None
+                             else ' over ')
+                self._node(script.sub, parts)
+            if script.sup is not None:
+                parts.append(' to ')
+                self._node(script.sup, parts)
+            parts.append(' of ')
+            return
+        if name is not None and self._alt_command(name).rstrip().endswith(
+                ' of') and script.sup is not None:
+            # 'sin^{2}' is read as 'sine superscript 2 of'
+            alt_name = self._alt_command(name).rstrip()[:-len(' of')]
+            parts.append(' ' + alt_name + ' superscript ')
+            self._scripted(script.sup, parts)
+            parts.append(' of ')
+            return
+        if _has_script(base):
+            # '{x^{y}}^{z}' is read as '(x superscript y) superscript z'
+            self._bracketed(base, parts)
+        elif base is not None:
+            self._node(base, parts)
+        if script.sub is not None:
+            if name == 'log':
+                parts.append(' base ')
+            elif name == 'lim':
+                self._bracketed(script.sub, parts, ' (', ') ')
+            else:
+                parts.append(' ' + self.special_symbols.get('_', 'subscript') +
+                             ' ')
+            if name != 'lim':
+                self._scripted(script.sub, parts)
+                parts.append(' ')
+        if script.sup is not None:
+            if isinstance(script.sup, Command) and script.sup.name == 'prime':
+                parts.append(' prime ')
+            else:
+                parts.append(' ' + self.special_symbols.get('^',
+                                                            'superscript') +
+                             ' ')
+                self._scripted(script.sup, parts)
+                parts.append(' ')
+
+    def _scripted(self, node, parts):
+        # Scripts of more than one part, or with scripts of their own, are
+        # put in brackets, so that 'x^{y^{z}}' is read as
+        # 'x superscript (y superscript z)'
+        if ((isinstance(node, Group) and len(node.nodes) > 1) or
+                _has_script(node)):
+            self._bracketed(node, parts)
+        else:
+            self._node(node, parts)
+
+    def _environment(self, environment, parts):
+        parts.append(' Begin ' + environment.name + ' environment. ')
+        for i, row in enumerate(environment.rows):
+            if i > 0:
+                parts.append(' and ')
+            for j, cell in enumerate(row):
+                if j > 0:
+                    parts.append(' for ' if environment.name == 'array'
+                                 else ' ')
+                self._nodes(cell, parts)
+        parts.append(' End ' + environment.name + ' environment. ')
+
+    def _alt_command(self, name):
+        alt_text = self.symbols.get(name)
+        return name if alt_text is None else alt_text
+
+    def _source(self, node):
+        # Text of a node as it was written (for '\text{...}' and the like)
+        if isinstance(node, Atom):
+            return node.value
+        return ' '.join(self._source(child) for child in node.children())
+
+
+def _has_script(node):
+    # Whether a node is a script, or a group of just one script
+    if isinstance(node, Group) and len(node.nodes) == 1:
+        node = node.nodes[0]
+    return isinstance(node, Script)
+
+
+def _strip(parts, start):
+    # Removes the spaces from the start and end of the text of parts[start:]
+    index = start
+    while index < len(parts):
+        parts[index] = parts[index].lstrip()
+        if parts[index] != '':
+            break
+        index += 1
+    index = len(parts) - 1
+    while index >= start:
+        parts[index] = parts[index].rstrip()
+        if parts[index] != '':
+            break
+        index -= 1
+
+
+def _short(parts, start, stop):
+    # Whether the text of parts[start:stop] is under 3 characters once its
+    # spaces are collapsed, only reading as far as it needs to
+    text = ''
+    for index in range(start, stop):
+        text += parts[index]
+        collapsed = ' '.join(text.split())
+        if len(collapsed) > 2:
+            return False
+        text = collapsed + (' ' if text[-1:].isspace() else '')
+    return True
+
+
+def render_equation(equation, symbols, special_symbols):
+    '''
+    Function to convert an equation into alt text by parsing it into a tree
+    and rendering the tree (an alternative to 'eqn_tokenise')
+
+    Parameters:
+        equation (str) : Equation within math text
+        symbols (SymbolTable) : Table of LaTeX symbols in csv file with their
+            alt text
+        special_symbols (dict) : Dictionary of math symbols to be replaced
+
+    Returns:
+        alt_equation (str) : Alt text version of 'equation'
+    '''
+    return Renderer(symbols, special_symbols).render(parse_math(equation))
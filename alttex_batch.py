@@ -0,0 +1,316 @@
+'''
+alttex_batch
+
+Converts many LaTeX documents into their alt text versions across a pool of
+processes, writing a manifest of the results.
+
+Functions:
+    convert_batch
+    convert_file
+    find_documents
+    output_path
+'''
+
+import glob
+import json
+import os
+import time
+from alttex_cache import EquationCache
+from alttex_converter import AltTexConverter
+from alttex_diagnostics import Diagnostics
+from alttex_functions import collecting, stream_tokenise, write_altex
+
+OUTPUT_SUFFIX = '_alt'
+
+_worker = {}
+
+
+def output_path(input_path):
+    '''
+    Function to find where the alt text version of a document is written
+
+    Parameters:
+        input_path (str) : Path to the LaTeX document
+
+    Returns:
+        path (str) : Path next to 'input_path', e.g. 'notes.tex' gives
+            'notes_alt.tex'
+    '''
+    root, extension = os.path.splitext(input_path)
+    return root + OUTPUT_SUFFIX + (extension or '.tex')
+
+
+def find_documents(inputs, extension='.tex'):
+    '''
+    Function to find the LaTeX documents to convert
+
+    Parameters:
+        inputs (list) : Paths to documents, directories (searched
+            recursively) or glob patterns
+        extension (str) : File extension of documents within directories
+
+    Returns:
+        paths (list) : Sorted paths of the documents, leaving out alt text
+            versions written by an earlier batch (e.g. 'delta_alt.tex' is
+            only left out if 'delta.tex' is also found)
+    '''
+    paths = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            pattern = os.path.join(glob.escape(item), '**', '*' + extension)
+            paths.update(glob.glob(pattern, recursive=True))
+        elif glob.has_magic(item):
+            paths.update(path for path in glob.glob(item, recursive=True)
+                         if os.path.isfile(path))
+        else:
+            paths.add(item)
+    sources = {os.path.normpath(path) for path in paths}
+    return sorted(path for path in paths if not _is_output(path, sources))
+
+
+def _is_output(path, sources):
+    # Whether a path is where the alt text version of one of 'sources' is
+    # written (see 'output_path')
+    root, extension = os.path.splitext(os.path.normpath(path))
+    if not root.endswith(OUTPUT_SUFFIX):
+        return False
+    source = root[:-len(OUTPUT_SUFFIX)]
+    return (source + extension in sources or
+            (extension == '.tex' and source in sources))
+
+
+def convert_file(input_path, delimiters, symbols, special_symbols,
+                 cache=None, incremental=False, jobs=1, budget=None):
+    '''
+    Function to convert one LaTeX document, recording any error rather than
+    raising it
+
+    Parameters:
+        input_path (str) : Path to the LaTeX document
+        delimiters (list) : Math text characters to search between
+        symbols (SymbolTable) : Table of LaTeX symbols in csv file with their
+            alt text
+        special_symbols (dict) : Dictionary of math symbols to be replaced
+        cache (EquationCache) : Cache of the alt text of equations (None
+            to convert every equation)
+        incremental (bool) : Whether to only convert the parts of the
+            document edited since the last run (see 'SpanIndex')
+        jobs (int) : Number of processes to convert the equations of the
+            document across (see 'parallel_tokenise')
+        budget (Budget) : Limits on the time and size of each equation and
+            table (None for no limits, see 'alttex_budget')
+
+    Returns:
+        record (dict) : Input and output paths, status ('ok' or 'failed'),
+            error message, time in seconds, sizes in bytes, the fallback
+            notes made within 'budget' (which are taken out of its
+            'diagnostics', so that a budget kept by a worker process does
+            not grow with each document), the report of the diagnostics
+            found (see 'Diagnostics.report') and, for an incremental run,
+            the number of parts reused and converted
+    '''
+    altex_path = output_path(input_path)
+    record = {'input': input_path, 'output': altex_path, 'status': 'ok',
+              'error': None, 'seconds': 0.0, 'input_bytes': None,
+              'output_bytes': None, 'spans_reused': None,
+              'spans_converted': None, 'fallbacks': None,
+              'diagnostics': None}
+    diagnostics = Diagnostics()
+    if budget is not None:
+        fallbacks = len(budget.diagnostics)
+    start = time.perf_counter()
+    try:
+        record['input_bytes'] = os.path.getsize(input_path)
+        index = None
+        if incremental:
+            # Only imported when used, to keep start up fast
+            from alttex_index import SpanIndex, index_path
+            index = SpanIndex(index_path(input_path), symbols, delimiters,
+                              special_symbols)
+        with open(input_path, 'r', encoding='utf8') as latex_file, \
+                open(altex_path, 'w', encoding='utf8') as altex_file, \
+                collecting(diagnostics):
+            if jobs == 1:
+                fragments = stream_tokenise(latex_file, delimiters, symbols,
+                                            special_symbols, cache, index,
+                                            budget)
+            else:
+                from alttex_parallel import parallel_tokenise
+                fragments = parallel_tokenise(latex_file, delimiters,
+                                              symbols, special_symbols,
+                                              cache, index, jobs, budget)
+            write_altex(fragments, altex_file)
+        record['output_bytes'] = os.path.getsize(altex_path)
+        if index is not None:
+            # Only saved once the whole document has been converted
+            index.save()
+            record['spans_reused'] = index.reused
+            record['spans_converted'] = index.converted
+    except Exception as error:
+        record['status'] = 'failed'
+        record['error'] = '%s: %s' % (type(error).__name__, error)
+        record['output'] = None
+        try:
+            os.remove(altex_path)
+        except OSError:
+            pass
+    record['seconds'] = time.perf_counter() - start
+    record['diagnostics'] = diagnostics.report()
+    if budget is not None:
+        record['fallbacks'] = budget.diagnostics[fallbacks:]
+        del budget.diagnostics[fallbacks:]
+    return record
+
+
+def _init_worker(csv_path, delimiters, special_symbols, cache_path=None,
+                 incremental=False, equation_jobs=1, budget=None):
+    # Runs once in each worker process, so the symbol table is only loaded
+    # (from its snapshot) once per process rather than once per document
+    _worker['converter'] = AltTexConverter(
+        csv_path, delimiters, special_symbols,
+        cache=EquationCache(path=cache_path))
+    _worker['incremental'] = incremental
+    _worker['equation_jobs'] = equation_jobs
+    _worker['budget'] = budget
+
+
+def _convert_in_worker(input_path):
+    converter = _worker['converter']
+    record = convert_file(input_path, converter.delimiters,
+                          converter.symbols, converter.special_symbols,
+                          converter.cache, _worker['incremental'],
+                          _worker['equation_jobs'], _worker['budget'])
+    # Worker processes exit without running clean up code, so the database
+    # is saved after every document
+    converter.cache.flush()
+    return record
+
+
+def _convert_in_pool(paths, jobs, initargs):
+    # Converts the documents across a pool of processes, with at most two
+    # documents sent to each process at a time. A worker that dies (e.g.
+    # killed for using too much memory) breaks the pool, so each document
+    # sent to it is converted again on its own to find the one that killed
+    # it, which is the only one failed, and the rest carry on in a new pool
+    # Imported here as multiprocessing is slow to import, and a single
+    # document is converted without a pool
+    from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                    wait)
+    from concurrent.futures.process import BrokenProcessPool
+    records = {}
+    waiting = list(range(len(paths) - 1, -1, -1))
+    while waiting != []:
+        suspects = []
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                 initargs=initargs) as executor:
+            running = {}
+            while suspects == [] and (waiting != [] or running != {}):
+                while waiting != [] and len(running) < 2 * jobs:
+                    index = waiting.pop()
+                    try:
+                        future = executor.submit(_convert_in_worker,
+                                                 paths[index])
+                    except BrokenProcessPool:
+                        suspects.append(index)
+                        break
+                    running[future] = index
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = running.pop(future)
+                    try:
+                        records[index] = future.result()
+                    except BrokenProcessPool:
+                        suspects.append(index)
+        # The pool has shut down, so the rest of the documents sent to it
+        # have either been converted or failed with it
+        for future, index in running.items():
+            try:
+                records[index] = future.result()
+            except BrokenProcessPool:
+                suspects.append(index)
+        for index in sorted(suspects):
+            with ProcessPoolExecutor(max_workers=1, initializer=_init_worker,
+                                     initargs=initargs) as executor:
+                try:
+                    records[index] = executor.submit(
+                        _convert_in_worker, paths[index]).result()
+                except BrokenProcessPool as error:
+                    records[index] = {
+                        'input': paths[index], 'output': None,
+                        'status': 'failed',
+                        'error': 'BrokenProcessPool: %s' % error,
+                        'seconds': 0.0, 'input_bytes': None,
+                        'output_bytes': None, 'spans_reused': None,
+                        'spans_converted': None, 'fallbacks': None,
+                        'diagnostics': None}
+    return [records[index] for index in range(len(paths))]
+
+
+def convert_batch(paths, delimiters, special_symbols,
+                  csv_path='LaTeX_Symbols.csv', jobs=None,
+                  manifest_path=None, cache_path=None, incremental=False,
+                  budget=None):
+    '''
+    Function to convert many LaTeX documents across a pool of processes
+
+    Parameters:
+        paths (list) : Paths to the LaTeX documents (see 'find_documents')
+        delimiters (list) : Math text characters to search between
+        special_symbols (dict) : Dictionary of math symbols to be replaced
+        csv_path (str) : Path to 'LaTeX_Symbols.csv'
+        jobs (int) : Number of processes (defaults to the number of CPUs,
+            and 1 converts the documents in this process), which the
+            equations of a single document are converted across if given
+        manifest_path (str) : Path to write the manifest to as JSON
+        cache_path (str) : Path to an sqlite database of equation alt text
+            shared by every process and kept between batches (None to only
+            cache equations within each process)
+        incremental (bool) : Whether to only convert the parts of each
+            document edited since the last run
+        budget (Budget) : Limits on the time and size of each equation and
+            table (None for no limits)
+
+    Returns:
+        manifest (dict) : Number of documents, failures, fallback notes,
+            processes and total time, the diagnostics of every document
+            together, and the record from 'convert_file' for each document
+    '''
+    csv_path = os.path.abspath(csv_path)
+    if cache_path is not None:
+        cache_path = os.path.abspath(cache_path)
+    equation_jobs = 1
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    elif len(paths) == 1:
+        # One document cannot be shared out, but its equations can
+        equation_jobs = jobs
+    jobs = max(1, min(jobs, len(paths)))
+    start = time.perf_counter()
+    records = []
+    if jobs == 1:
+        _init_worker(csv_path, delimiters, special_symbols, cache_path,
+                     incremental, equation_jobs, budget)
+        records = [_convert_in_worker(path) for path in paths]
+        _worker['converter'].cache.close()
+    else:
+        records = _convert_in_pool(paths, jobs, (csv_path, delimiters,
+                                                 special_symbols, cache_path,
+                                                 incremental, 1, budget))
+    diagnostics = Diagnostics()
+    for record in records:
+        if record['diagnostics'] is not None:
+            diagnostics.update(record['diagnostics'])
+    manifest = {
+        'documents': len(records),
+        'failed': sum(record['status'] == 'failed' for record in records),
+        'fallbacks': sum(len(record['fallbacks'] or ())
+                         for record in records),
+        'jobs': jobs,
+        'seconds': time.perf_counter() - start,
+        'diagnostics': diagnostics.report(),
+        'files': records,
+    }
+    if manifest_path is not None:
+        with open(manifest_path, 'w', encoding='utf8') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+    return manifest
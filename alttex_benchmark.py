@@ -0,0 +1,549 @@
+'''
+alttex_benchmark
+
+Benchmarks for the functions in 'alttex_functions', with a generator of
+synthetic LaTeX documents. Run this file directly to print the results, e.g.
+    python alttex_benchmark.py --output results.json --compare old.json
+
+Functions:
+    bench_functions
+    bench_nested_groups
+    bench_startup
+    check_diagnostic_lines
+    compare_results
+    fraction_groups
+    save_results
+    scaling_check
+    synthetic_document
+    synthetic_equation
+    synthetic_table
+    time_function
+'''
+
+import argparse
+import io
+import json
+import math
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import warnings
+from alttex_converter import DELIMITERS, SPECIAL_SYMBOLS
+from alttex_diagnostics import Diagnostics
+from alttex_functions import (collecting, eqn_tokenise, multi_replace,
+                              nested_brackets, next_bracket, parse_groups,
+                              stream_tokenise, tabular, tokenise)
+from alttex_symbols import SymbolTable
+
+# Commands that are all in 'LaTeX_Symbols.csv'
+COMMANDS = ['alpha', 'beta', 'theta', 'pi', 'partial', 'infty', 'cdot']
+# Most time in seconds for 'main.py' to convert a document with one
+# equation, beyond the time the interpreter takes to start
+STARTUP_BUDGET = 0.1
+# Slow to import modules, and modules of features, that converting a short
+# document should not need
+LAZY_MODULES = ('alttex_ast', 'alttex_budget', 'alttex_index',
+                'alttex_macros', 'alttex_parallel', 'alttex_profile',
+                'concurrent.futures', 'csv', 'multiprocessing', 'sqlite3',
+                'tracemalloc')
+
+
+def time_function(function, args, repeat=5, number=100):
+    '''
+    Function to time calls of 'function'
+
+    Parameters:
+        function (function) : Function to time
+        args (tuple) : Arguments to call 'function' with
+        repeat (int) : Number of timing runs (the fastest one is kept)
+        number (int) : Number of calls within each timing run (None to
+            choose it so that each run takes at least 0.2 seconds)
+
+    Returns:
+        seconds (float) : Time of a single call of 'function'
+    '''
+    timer = timeit.Timer(lambda: function(*args))
+    if number is None:
+        number = timer.autorange()[0]
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def synthetic_equation(terms=10, depth=2, frac_density=0.3, rng=None):
+    '''
+    Function to create an equation for benchmarks
+
+    Parameters:
+        terms (int) : Number of terms added together
+        depth (int) : Brace nesting depth of each term
+        frac_density (float) : Chance (from 0 to 1) of each level of nesting
+            being a fraction rather than a superscript
+        rng (Random) : Random number generator (defaults to a fixed seed, so
+            the same equation is always created)
+
+    Returns:
+        equation (str) : Equation without delimiters
+    '''
+    if rng is None:
+        rng = random.Random(0)
+    parts = []
+    for i in range(terms):
+        term = rng.choice(['x', 'y_{%d}' % i, '\\%s' % rng.choice(COMMANDS),
+                           '%d' % i, '\\sqrt{z}'])
+        for level in range(depth):
+            if rng.random() < frac_density:
+                term = '\\frac{%s}{%d}' % (term, level + 2)
+            else:
+                term = 'e^{%s}' % term
+        parts.append(term)
+    return ' + '.join(parts)
+
+
+def synthetic_table(rows=10, cols=3, rng=None):
+    '''
+    Function to create the body of a tabular environment for benchmarks
+
+    Parameters:
+        rows (int) : Number of rows
+        cols (int) : Number of columns
+        rng (Random) : Random number generator (defaults to a fixed seed)
+
+    Returns:
+        table (str) : Text between '\\begin{tabular}' and '\\end{tabular}'
+    '''
+    if rng is None:
+        rng = random.Random(0)
+    lines = ['{' + '|c' * cols + '|}\n']
+    for i in range(rows):
+        cells = []
+        for j in range(cols):
+            if rng.random() < 0.5:
+                cells.append('$%s$' % synthetic_equation(1, 1, 0.5, rng))
+            else:
+                cells.append('%d' % (i * cols + j))
+        lines.append('\\hline\n' + ' & '.join(cells) + ' \\\\\n')
+    lines.append('\\hline\n')
+    return ''.join(lines)
+
+
+def synthetic_document(inline=100, depth=2, frac_density=0.3, table_rows=10,
+                       align_lines=5, seed=0):
+    '''
+    Function to create a LaTeX document for benchmarks, where each part of
+    the workload can be varied independently
+
+    Parameters:
+        inline (int) : Number of inline equations
+        depth (int) : Brace nesting depth of the terms of each equation
+        frac_density (float) : Chance (from 0 to 1) of each level of nesting
+            being a fraction
+        table_rows (int) : Number of rows of the tabular environment (0 for
+            no table)
+        align_lines (int) : Number of lines of the align environment (0 for
+            no align environment)
+        seed (int) : Seed of the random number generator
+
+    Returns:
+        latex_doc (str) : LaTeX document, including the todo package
+    '''
+    rng = random.Random(seed)
+    lines = ['\\documentclass{article}\n', '\\usepackage{todonotes}\n',
+             '\\begin{document}\n']
+    for i in range(inline):
+        equation = synthetic_equation(rng.randint(1, 4), depth, frac_density,
+                                      rng)
+        lines.append('Paragraph %d has the equation $%s$ in it.\n' %
+                     (i, equation))
+    if align_lines > 0:
+        lines.append('\\begin{align}\n')
+        for i in range(align_lines):
+            lines.append('a_{%d} &= %s \\\\\n' %
+                         (i, synthetic_equation(2, depth, frac_density, rng)))
+        lines.append('\\end{align}\n')
+    if table_rows > 0:
+        lines.append('\\begin{tabular}' + synthetic_table(table_rows, 3, rng) +
+                     '\\end{tabular}\n')
+    lines.append('\\end{document}\n')
+    return ''.join(lines)
+
+
+def _sweeps(symbols):
+    # Name of each function mapped to the function and a builder of its
+    # arguments for an input of a given size
+    special = SPECIAL_SYMBOLS
+    replace_dict = dict(special)
+    replace_dict.update(('\\' + command, symbols[command])
+                        for command in COMMANDS)
+    return {
+        'tokenise': (tokenise, lambda size: (
+            synthetic_document(inline=25 * size, table_rows=0,
+                               align_lines=0), DELIMITERS, symbols, special)),
+        'eqn_tokenise': (eqn_tokenise, lambda size: (
+            synthetic_equation(10 * size), symbols, special)),
+        'next_bracket': (next_bracket, lambda size: (
+            '{' + synthetic_equation(50 * size) + '}', 0)),
+        'nested_brackets': (nested_brackets, lambda size: (
+            fraction_groups(10 * size)[-1], [''], symbols, special)),
+        'multi_replace': (multi_replace, lambda size: (
+            ' + '.join('\\%s_{%d}' % (COMMANDS[i % len(COMMANDS)], i)
+                       for i in range(50 * size)), replace_dict)),
+        'tabular': (tabular, lambda size: (
+            synthetic_table(10 * size), DELIMITERS, symbols, special)),
+    }
+
+
+def bench_functions(symbols, sizes=(1, 2, 4, 8, 16), functions=None,
+                    repeat=3):
+    '''
+    Function to time each stage of the conversion separately over inputs
+    that double in size
+
+    Parameters:
+        symbols (SymbolTable) : Table of LaTeX symbols in csv file with their
+            alt text
+        sizes (tuple) : Relative sizes of the inputs, each double the last
+        functions (list) : Names of the functions to time (defaults to all
+            of 'tokenise', 'eqn_tokenise', 'next_bracket',
+            'nested_brackets', 'multi_replace' and 'tabular')
+        repeat (int) : Number of timing runs (the fastest one is kept)
+
+    Returns:
+        results (dict) : Name of each function mapped to a list of
+            dictionaries with the size, input length and time in seconds
+    '''
+    sweeps = _sweeps(symbols)
+    if functions is None:
+        functions = list(sweeps)
+    results = {}
+    for name in functions:
+        function, build = sweeps[name]
+        results[name] = []
+        for size in sizes:
+            args = build(size)
+            results[name].append({
+                'size': size, 'length': len(args[0]),
+                'seconds': time_function(function, args, repeat=repeat,
+                                         number=None)})
+    return results
+
+
+def scaling_check(results, expected=None, tolerance=0.3):
+    '''
+    Function to flag functions whose time grows faster than expected as the
+    size of their input doubles
+
+    Parameters:
+        results (dict) : Results from 'bench_functions'
+        expected (dict) : Name of each function mapped to the expected
+            exponent of its growth (defaults to 1, i.e. linear time)
+        tolerance (float) : How far the measured exponent can be above the
+            expected exponent before the function is flagged
+
+    Returns:
+        scaling (dict) : Name of each function mapped to a dictionary of its
+            measured exponent (the median over each doubling), expected
+            exponent and whether it is flagged
+    '''
+    if expected is None:
+        expected = {}
+    scaling = {}
+    for name, timings in results.items():
+        exponents = []
+        for before, after in zip(timings, timings[1:]):
+            if before['seconds'] > 0 and after['seconds'] > 0:
+                exponents.append(
+                    math.log(after['seconds'] / before['seconds']) /
+                    math.log(after['length'] / before['length']))
+        if exponents == []:
+            continue
+        exponent = statistics.median(exponents)
+        scaling[name] = {'exponent': exponent,
+                         'expected': expected.get(name, 1.0),
+                         'flagged': exponent > expected.get(name, 1.0) +
+                         tolerance}
+    return scaling
+
+
+def save_results(results, path, scaling=None):
+    '''
+    Function to save benchmark results as JSON, with details of the machine
+    so that runs can be compared
+
+    Parameters:
+        results (dict) : Results from 'bench_functions'
+        path (str) : Path to write the results to
+        scaling (dict) : Results from 'scaling_check' (worked out from
+            'results' if not given)
+    '''
+    if scaling is None:
+        scaling = scaling_check(results)
+    with open(path, 'w', encoding='utf8') as results_file:
+        json.dump({'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'results': results, 'scaling': scaling},
+                  results_file, indent=2)
+
+
+def compare_results(old, new):
+    '''
+    Function to compare two runs of 'bench_functions'
+
+    Parameters:
+        old (dict) : Earlier results (or the contents of a file written by
+            'save_results')
+        new (dict) : Later results (or the contents of a file written by
+            'save_results')
+
+    Returns:
+        speedups (dict) : Name of each function in both runs mapped to a
+            dictionary of each size in both runs and the old time divided by
+            the new time (above 1 if the function is now faster)
+    '''
+    old = old.get('results', old)
+    new = new.get('results', new)
+    speedups = {}
+    for name in old:
+        if name not in new:
+            continue
+        old_times = {timing['size']: timing['seconds'] for timing in old[name]}
+        speedups[name] = {timing['size']: (old_times[timing['size']] /
+                                           timing['seconds'])
+                          for timing in new[name]
+                          if timing['size'] in old_times and
+                          timing['seconds'] > 0}
+    return speedups
+
+
+def fraction_groups(count=50, depth=3):
+    '''
+    Function to create brace groups like those passed to 'nested_brackets'
+    from fraction-heavy notes
+
+    Parameters:
+        count (int) : Number of terms in each group
+        depth (int) : Number of nested fractions in each term
+
+    Returns:
+        groups (list) : List of strings, each in braces
+    '''
+    groups = []
+    for size in (1, count // 5, count):
+        terms = []
+        for i in range(size):
+            term = 'x_{%d}' % i
+            for _ in range(depth):
+                term = '\\frac{%s}{\\sqrt{y^{2}+%d}}' % (term, i)
+            terms.append(term)
+        groups.append('{' + ' + '.join(terms) + '}')
+    return groups
+
+
+def bench_nested_groups(groups=None, number=20):
+    '''
+    Function to compare 'parse_groups' with pyparsing's 'nestedExpr' (if it
+    is installed), checking that both give the same parts
+
+    Parameters:
+        groups (list) : Strings in braces to parse (defaults to
+            'fraction_groups')
+        number (int) : Number of calls within each timing run
+
+    Returns:
+        results (list) : List of dictionaries with the length of each group
+            and the time of each parser in seconds
+    '''
+    try:
+        from pyparsing import nestedExpr
+    except ImportError:
+        nestedExpr = None
+    if groups is None:
+        groups = fraction_groups()
+    results = []
+    with warnings.catch_warnings():
+        # Newer pyparsing versions warn about the camel case names
+        warnings.simplefilter('ignore', DeprecationWarning)
+        for group in groups:
+            result = {'length': len(group),
+                      'parse_groups': time_function(parse_groups, (group,),
+                                                    number=number)}
+            if nestedExpr is not None:
+                def pyparsing_groups(equation):
+                    parser = nestedExpr(opener='{', closer='}')
+                    parsed = parser.parseString(equation, parseAll=True)
+                    return parsed.asList()[0]
+                if pyparsing_groups(group) != parse_groups(group):
+                    raise AssertionError('Parts differ for %r' % group)
+                result['pyparsing'] = time_function(pyparsing_groups,
+                                                    (group,), number=number)
+            results.append(result)
+    return results
+
+
+def bench_startup(repeat=5, budget=STARTUP_BUDGET):
+    '''
+    Function to time the cold start of 'main.py' converting a document with
+    one equation, as a commit hook would run it
+
+    Parameters:
+        repeat (int) : Number of runs (the fastest one is kept)
+        budget (float) : Most time in seconds for a run, beyond the time the
+            interpreter takes to start
+
+    Returns:
+        result (dict) : Time in seconds of the fastest run and of starting
+            the interpreter alone, the budget, whether the run was within
+            it, and the modules in 'LAZY_MODULES' that the run imported
+    '''
+    root = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as directory:
+        latex_path = os.path.join(directory, 'startup.tex')
+        with open(latex_path, 'w', encoding='utf8') as latex_file:
+            latex_file.write('\\documentclass{article}\n'
+                             '\\begin{document}\n$x^2$\n\\end{document}\n')
+        command = [sys.executable, os.path.join(root, 'main.py'), latex_path,
+                   '--manifest', os.path.join(directory, 'manifest.json')]
+        # The first run writes the symbol table snapshot and the bytecode,
+        # as an earlier run of the hook would have (even if writing bytecode
+        # is turned off, which would otherwise compile every module on every
+        # run)
+        environ = dict(os.environ)
+        environ.pop('PYTHONDONTWRITEBYTECODE', None)
+        subprocess.run(command, cwd=root, check=True, env=environ,
+                       stdout=subprocess.DEVNULL)
+        seconds = min(_run_seconds(command, root) for _ in range(repeat))
+        interpreter_seconds = min(
+            _run_seconds([sys.executable, '-c', 'pass'], root)
+            for _ in range(repeat))
+        imports = subprocess.run(command[:1] + ['-X', 'importtime'] +
+                                 command[1:], cwd=root, check=True,
+                                 stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.PIPE, text=True).stderr
+    imported = {line.split('|')[-1].strip() for line in imports.splitlines()
+                if line.startswith('import time:')}
+    return {'seconds': seconds, 'interpreter_seconds': interpreter_seconds,
+            'budget': budget,
+            'within_budget': seconds - interpreter_seconds <= budget,
+            'lazy_modules_imported': [name for name in LAZY_MODULES
+                                      if name in imported]}
+
+
+def check_diagnostic_lines(symbols):
+    '''
+    Function to check the line each diagnostic of a short document is
+    reported at, by both 'tokenise' and 'stream_tokenise', including a
+    command on the second line of an equation environment
+
+    Parameters:
+        symbols (SymbolTable) : Table of LaTeX symbols in csv file with their
+            alt text
+
+    Returns:
+        mismatches (list) : Dictionaries of the function, item, line it is
+            on and line it was reported at, for each diagnostic reported at
+            the wrong line (empty if every line is right)
+    '''
+    lines = ['\\documentclass{article}', '\\begin{document}']
+    lines += ['Line %d of text.' % number for number in range(3, 19)]
+    lines += ['\\begin{equation}', '\\bar{\\qux y}', '\\end{equation}',
+              'Then $x + \\zork$ and $y$.', '\\end{document}']
+    latex_doc = '\n'.join(lines) + '\n'
+    expected = {'\\qux': 20, '\\zork': 22}
+    mismatches = []
+    for name in ('tokenise', 'stream_tokenise'):
+        diagnostics = Diagnostics()
+        with collecting(diagnostics):
+            if name == 'tokenise':
+                tokenise(latex_doc, DELIMITERS, symbols, SPECIAL_SYMBOLS)
+            else:
+                for _ in stream_tokenise(io.StringIO(latex_doc), DELIMITERS,
+                                         symbols, SPECIAL_SYMBOLS):
+                    pass
+        reported = {entry['item']: entry['line'] for entry in
+                    diagnostics.report()['unknown command']}
+        for item, line in expected.items():
+            if reported.get(item) != line:
+                mismatches.append({'function': name, 'item': item,
+                                   'line': line,
+                                   'reported': reported.get(item)})
+    return mismatches
+
+
+def _run_seconds(command, cwd):
+    start = time.perf_counter()
+    subprocess.run(command, cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the stages of the alt text conversion.')
+    parser.add_argument('--output', default=None,
+                        help='where to save the results as JSON')
+    parser.add_argument('--compare', default=None,
+                        help='results saved by an earlier run to compare with')
+    parser.add_argument('--quick', action='store_true',
+                        help='only time the three smallest sizes')
+    parser.add_argument('--startup', action='store_true',
+                        help='only time the cold start of main.py, failing '
+                             'if it is over STARTUP_BUDGET')
+    parser.add_argument('--diagnostic-lines', action='store_true',
+                        help='only check the lines diagnostics are reported '
+                             'at, failing if any is wrong')
+    args = parser.parse_args()
+
+    if args.diagnostic_lines:
+        mismatches = check_diagnostic_lines(
+            SymbolTable.from_csv('LaTeX_Symbols.csv'))
+        for mismatch in mismatches:
+            print('FLAGGED: %(function)s reported %(item)s at line '
+                  '%(reported)s rather than %(line)s' % mismatch)
+        sys.exit(1 if mismatches != [] else 0)
+
+    if args.startup:
+        result = bench_startup()
+        print('main.py %.3fs  interpreter %.3fs  budget %.3fs%s' % (
+            result['seconds'], result['interpreter_seconds'],
+            result['budget'],
+            '' if result['within_budget'] else '  (FLAGGED: over budget)'))
+        if result['lazy_modules_imported'] != []:
+            print('FLAGGED: imported ' +
+                  ', '.join(result['lazy_modules_imported']))
+        sys.exit(0 if result['within_budget'] and
+                 result['lazy_modules_imported'] == [] else 1)
+
+    sizes = (1, 2, 4) if args.quick else (1, 2, 4, 8, 16)
+    results = bench_functions(SymbolTable.from_csv('LaTeX_Symbols.csv'),
+                              sizes=sizes)
+    scaling = scaling_check(results)
+    for name, timings in results.items():
+        for timing in timings:
+            print('%-16s length %7d  %.6fs' % (name, timing['length'],
+                                               timing['seconds']))
+        if name in scaling:
+            print('%-16s growth exponent %.2f%s' % (
+                name, scaling[name]['exponent'],
+                '  (FLAGGED: faster than expected)'
+                if scaling[name]['flagged'] else ''))
+    if args.output is not None:
+        save_results(results, args.output, scaling)
+    if args.compare is not None:
+        with open(args.compare, 'r', encoding='utf8') as old_file:
+            speedups = compare_results(json.load(old_file), results)
+        for name, by_size in speedups.items():
+            print('%-16s speedup %s' % (name, '  '.join(
+                'x%.2f' % speedup for speedup in by_size.values())))
+
+    for result in bench_nested_groups():
+        line = 'length %7d  parse_groups %.6fs' % (result['length'],
+                                                  result['parse_groups'])
+        if 'pyparsing' in result:
+            line += '  pyparsing %.6fs  (x%.1f)' % (
+                result['pyparsing'],
+                result['pyparsing'] / result['parse_groups'])
+        print(line)
@@ -0,0 +1,223 @@
+'''
+alttex_budget
+
+Limits the time and size of each equation and table of a document, so that
+one pathological equation (e.g. with deeply nested or unbalanced braces)
+is given a fallback todo note with its LaTeX, rather than stalling or
+stopping the conversion of the rest of the document.
+
+Classes:
+    Budget
+'''
+
+import time
+from collections import OrderedDict
+import alttex_functions
+from alttex_functions import (BRACES, BudgetExceededError, deadline,
+                              tabular)
+
+# Characters with a special meaning to LaTeX, written so that they are
+# typeset as they are within a todo note
+LATEX_ESCAPES = str.maketrans({
+    '\\': '\\textbackslash{}', '{': '\\{', '}': '\\}', '$': '\\$',
+    '&': '\\&', '%': '\\%', '#': '\\#', '_': '\\_', '^': '\\^{}',
+    '~': '\\~{}'
+})
+# Most equations over budget whose reason is kept, so that a budget shared by
+# a long running process does not grow without bound
+MAX_FAILED = 4096
+
+
+class Budget:
+    '''
+    Class to limit the time and size of each equation and table, giving a
+    fallback todo note for any that are over budget or fail to convert
+
+    Equations are timed with 'deadline', which 'eqn_tokenise' and
+    'iter_tabular' check as they go, so an equation is stopped soon after
+    its time runs out. A budget can be shared by many threads.
+
+    Attributes:
+        seconds (float) : Most time to convert one equation (None for no
+            limit)
+        max_length (int) : Most characters in one equation (None for no
+            limit)
+        max_depth (int) : Deepest nesting of braces in one equation (None
+            for no limit)
+        table_seconds (float) : Most time to convert one table, including
+            its equations (None for no limit)
+        max_table_length (int) : Most characters in one table (None for no
+            limit)
+        max_failed (int) : Most equations over budget kept, so that repeats
+            of them are given a fallback note without converting them again
+        diagnostics (list) : Dictionaries of the kind ('equation' or
+            'table'), reason and LaTeX of each fallback note, in the order
+            they were made
+    '''
+
+    def __init__(self, seconds=1.0, max_length=10000, max_depth=50,
+                 table_seconds=10.0, max_table_length=200000,
+                 max_failed=MAX_FAILED):
+        '''
+        Parameters:
+            seconds (float) : Most time to convert one equation
+            max_length (int) : Most characters in one equation
+            max_depth (int) : Deepest nesting of braces in one equation
+            table_seconds (float) : Most time to convert one table
+            max_table_length (int) : Most characters in one table
+            max_failed (int) : Most equations over budget kept
+        '''
+        self.seconds = seconds
+        self.max_length = max_length
+        self.max_depth = max_depth
+        self.table_seconds = table_seconds
+        self.max_table_length = max_table_length
+        self.max_failed = max_failed
+        self.diagnostics = []
+        # Reason each of the most recent equations over budget was given a
+        # fallback note, so that repeats of it are not converted again. The
+        # oldest is removed first (without a lock, so that the budget can
+        # still be sent to other processes)
+        self._failed = OrderedDict()
+
+    def equation(self, equation, convert, symbols, special_symbols):
+        '''
+        Function to convert an equation within the budget
+
+        Parameters:
+            equation (str) : Equation within math text
+            convert (function) : Function converting the equation, taking
+                the same parameters as 'eqn_tokenise'
+            symbols (SymbolTable) : Table of LaTeX symbols in csv file with
+                their alt text
+            special_symbols (dict) : Dictionary of math symbols to be
+                replaced
+
+        Returns:
+            alt_equation (str) : Alt text version of 'equation', or the text
+                of a fallback note if it is over budget
+        '''
+        reason = self._failed.get(equation)
+        if reason is None:
+            reason = self._equation_size(equation)
+        if reason is None:
+            start = time.perf_counter()
+            try:
+                with deadline(self.seconds):
+                    return convert(equation, symbols, special_symbols)
+            except BudgetExceededError:
+                if (self.seconds is None or
+                        time.perf_counter() - start < self.seconds):
+                    # The time of the table the equation is in has run out
+                    raise
+                reason = 'took longer than %gs' % self.seconds
+            except RecursionError:
+                reason = 'braces nested too deeply'
+            except Exception as error:
+                reason = '%s: %s' % (type(error).__name__, error)
+            self._failed[equation] = reason
+            if len(self._failed) > self.max_failed:
+                self._failed.popitem(last=False)
+        return self.fallback('equation', equation, reason)
+
+    def tabular(self, table, delimiters, symbols, special_symbols,
+                cache=None):
+        '''
+        Function to create alt text for a table within the budget (see
+        'tabular')
+
+        Parameters:
+            table (str) : String of text within the tabular environment
+            delimiters (list) : Math text characters to search between
+            symbols (SymbolTable) : Table of LaTeX symbols in csv file with
+                their alt text
+            special_symbols (dict) : Dictionary of math symbols to be
+                replaced
+            cache (EquationCache) : Cache of the alt text of equations (None
+                to convert every equation)
+
+        Returns:
+            alt_tab (list) : Alt text version of 'table', or a fallback note
+                if it is over budget
+        '''
+        if (self.max_table_length is not None and
+                len(table) > self.max_table_length):
+            reason = 'longer than %d characters' % self.max_table_length
+        else:
+            try:
+                with deadline(self.table_seconds):
+                    return tabular(table, delimiters, symbols,
+                                   special_symbols, cache)
+            except BudgetExceededError:
+                reason = 'took longer than %gs' % self.table_seconds
+            except Exception as error:
+                reason = '%s: %s' % (type(error).__name__, error)
+        return ['\\todo[inline]{begin alt text. ' +
+                self.fallback('table', table, reason) + ' end alt text}']
+
+    def limit(self, cache=None):
+        '''
+        Function to wrap an equation cache, so that each equation it
+        converts is kept within the budget
+
+        Parameters:
+            cache (EquationCache) : Cache of the alt text of equations (None
+                to convert every equation)
+
+        Returns:
+            limited (object) : Stand-in for 'cache' with the same
+                'eqn_tokenise' function
+        '''
+        return _LimitedCache(self, cache)
+
+    def fallback(self, kind, latex, reason):
+        '''
+        Function to record a fallback and write its note
+
+        Parameters:
+            kind (str) : 'equation' or 'table'
+            latex (str) : LaTeX of the equation or table
+            reason (str) : Why no alt text could be made
+
+        Returns:
+            note (str) : Text for the todo note, with 'latex' written so
+                that it is typeset as it is
+        '''
+        self.diagnostics.append({'kind': kind, 'reason': reason,
+                                 'latex': latex})
+        return ('no alt text could be made for this ' + kind + ': ' +
+                ' '.join(latex.split()).translate(LATEX_ESCAPES))
+
+    def _equation_size(self, equation):
+        # Reason the equation is too large to convert (None if it is not)
+        if self.max_length is not None and len(equation) > self.max_length:
+            return 'longer than %d characters' % self.max_length
+        if self.max_depth is None:
+            return None
+        depth = 0
+        for match in BRACES.finditer(equation):
+            if match.group() == '{':
+                depth += 1
+                if depth > self.max_depth:
+                    return ('braces nested deeper than %d' %
+                            self.max_depth)
+            else:
+                depth -= 1
+        return None
+
+
+class _LimitedCache:
+    # Stands in for the equation cache, converting each equation within the
+    # budget
+    def __init__(self, budget, cache):
+        self.budget = budget
+        self.cache = cache
+
+    def eqn_tokenise(self, equation, symbols, special_symbols):
+        if self.cache is not None:
+            convert = self.cache.eqn_tokenise
+        else:
+            # Looked up on each call so that it can be wrapped by a profiler
+            convert = alttex_functions.eqn_tokenise
+        return self.budget.equation(equation, convert, symbols,
+                                    special_symbols)
@@ -0,0 +1,256 @@
+'''
+alttex_cache
+
+Memoises the alt text of equations, so that notation repeated within and
+across documents is only converted once.
+
+Classes:
+    EquationCache
+'''
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from alttex_functions import eqn_tokenise, recording, replay
+
+# Part of every key, so raising it whenever a change to the conversion gives
+# different alt text means equations cached by older versions are not reused
+CACHE_VERSION = 4
+
+
+class EquationCache:
+    '''
+    Class to memoise 'eqn_tokenise' with an in-process LRU cache and an
+    optional sqlite database that can be shared across runs and processes
+
+    The diagnostics found when an equation is converted (see 'collecting')
+    are kept with its alt text, and recorded again each time it is found in
+    the cache, so what is reported does not depend on what is cached.
+
+    Attributes:
+        maxsize (int) : Most equations kept in memory
+        path (str) : Path to the sqlite database (None if not used)
+        max_disk_entries (int) : Most equations kept in the database
+        hits (int) : Number of equations found in memory
+        disk_hits (int) : Number of equations found in the database
+        misses (int) : Number of equations passed to 'eqn_tokenise'
+        evictions (int) : Number of equations removed from memory
+        disk_evictions (int) : Number of equations removed from the database
+        function (function) : Function converting the equations (None for
+            'eqn_tokenise')
+    '''
+
+    def __init__(self, maxsize=4096, path=None, max_disk_entries=100000,
+                 function=None):
+        '''
+        Parameters:
+            maxsize (int) : Most equations kept in memory
+            path (str) : Path to the sqlite database, which is created if it
+                does not exist (None to only cache in memory)
+            max_disk_entries (int) : Most equations kept in the database
+            function (function) : Function to convert the equations with,
+                taking the same parameters as 'eqn_tokenise' (None for
+                'eqn_tokenise')
+        '''
+        self.maxsize = maxsize
+        self.function = function
+        self.path = path
+        self.max_disk_entries = max_disk_entries
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._connection = None
+        self._unsaved = 0
+        if path is not None:
+            # Only imported when a database is used, to keep start up fast
+            import sqlite3
+            directory = os.path.dirname(os.path.abspath(path))
+            os.makedirs(directory, exist_ok=True)
+            self._connection = sqlite3.connect(path, timeout=30,
+                                               check_same_thread=False)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS equations '
+                '(key TEXT PRIMARY KEY, alt_text TEXT, last_used REAL, '
+                'diagnostics TEXT)')
+            columns = [row[1] for row in self._connection.execute(
+                'PRAGMA table_info(equations)')]
+            if 'diagnostics' not in columns:
+                # Made by an older version, whose equations have other keys
+                # and are evicted as the database fills up
+                self._connection.execute(
+                    'ALTER TABLE equations ADD COLUMN diagnostics TEXT')
+            self._connection.commit()
+
+    def key(self, equation, symbols, special_symbols):
+        '''
+        Function to find the cache key of an equation
+
+        Parameters:
+            equation (str) : Equation within math text
+            symbols (SymbolTable) : Table of LaTeX symbols in csv file with
+                their alt text
+            special_symbols (dict) : Dictionary of math symbols to be replaced
+
+        Returns:
+            key (str) : Hash of 'equation' with 'CACHE_VERSION' and the
+                fingerprint of 'symbols' and 'special_symbols', so editing
+                any of these gives new keys (and with the name of
+                'function', if it is not 'eqn_tokenise')
+        '''
+        special = repr(sorted(special_symbols.items()))
+        parts = (str(CACHE_VERSION), symbols.fingerprint, special, equation)
+        if self.function is not None:
+            parts += (self.function.__module__ + '.' +
+                      self.function.__qualname__,)
+        return hashlib.sha256('\0'.join(parts).encode('utf8')).hexdigest()
+
+    def eqn_tokenise(self, equation, symbols, special_symbols):
+        '''
+        Function to find the alt text of an equation, only calling
+        'eqn_tokenise' (or 'function') if it is not already cached
+
+        Parameters:
+            equation (str) : Equation within math text
+            symbols (SymbolTable) : Table of LaTeX symbols in csv file with
+                their alt text
+            special_symbols (dict) : Dictionary of math symbols to be replaced
+
+        Returns:
+            alt_equation (str) : Alt text version of 'equation'
+        '''
+        key = self.key(equation, symbols, special_symbols)
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+            else:
+                entry = self._load(key)
+                if entry is not None:
+                    self.disk_hits += 1
+                    self._remember(key, entry)
+        if entry is not None:
+            alt_equation, found = entry
+            if found != ():
+                replay(found)
+            return alt_equation
+        # 'eqn_tokenise' is looked up on each call so that it can be wrapped
+        # by a profiler
+        convert = eqn_tokenise if self.function is None else self.function
+        with recording() as found:
+            alt_equation = convert(equation, symbols, special_symbols)
+        entry = (alt_equation, tuple(found))
+        with self._lock:
+            self.misses += 1
+            self._remember(key, entry)
+            self._save(key, entry)
+        return alt_equation
+
+    def stats(self):
+        '''
+        Function to summarise how well the cache is working
+
+        Returns:
+            stats (dict) : Hit, miss and eviction counts, the number of
+                equations in memory and the hit rate
+        '''
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {'hits': self.hits, 'disk_hits': self.disk_hits,
+                    'misses': self.misses, 'evictions': self.evictions,
+                    'disk_evictions': self.disk_evictions,
+                    'size': len(self._memory),
+                    'hit_rate': ((self.hits + self.disk_hits) / lookups
+                                 if lookups else 0.0)}
+
+    def clear(self):
+        '''
+        Function to remove every equation from memory and the database
+        '''
+        with self._lock:
+            self._memory.clear()
+            if self._connection is not None:
+                self._connection.execute('DELETE FROM equations')
+                self._connection.commit()
+                self._unsaved = 0
+
+    def flush(self):
+        '''
+        Function to save any equations not yet written to the database
+        '''
+        with self._lock:
+            if self._connection is not None and self._unsaved > 0:
+                self._evict_disk()
+                self._connection.commit()
+                self._unsaved = 0
+
+    def close(self):
+        '''
+        Function to save any remaining equations and close the database
+        '''
+        self.flush()
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def _remember(self, key, entry):
+        # Each entry is the alt text of an equation with the diagnostics
+        # found when it was converted
+        self._memory[key] = entry
+        if len(self._memory) > self.maxsize:
+            self._memory.popitem(last=False)
+            self.evictions += 1
+
+    def _load(self, key):
+        if self._connection is None:
+            return None
+        row = self._connection.execute(
+            'SELECT alt_text, diagnostics FROM equations WHERE key = ?',
+            (key,)).fetchone()
+        if row is None:
+            return None
+        self._connection.execute(
+            'UPDATE equations SET last_used = ? WHERE key = ?',
+            (time.time(), key))
+        self._unsaved += 1
+        # Equations without diagnostics are stored with None to keep the
+        # database small
+        found = () if row[1] is None else tuple(
+            tuple(diagnostic) for diagnostic in json.loads(row[1]))
+        return row[0], found
+
+    def _save(self, key, entry):
+        if self._connection is None:
+            return
+        alt_equation, found = entry
+        self._connection.execute(
+            'INSERT OR REPLACE INTO equations '
+            '(key, alt_text, last_used, diagnostics) VALUES (?, ?, ?, ?)',
+            (key, alt_equation, time.time(),
+             json.dumps(found) if found != () else None))
+        self._unsaved += 1
+        # Committing in batches keeps the database off the hot path
+        if self._unsaved >= 256:
+            self._evict_disk()
+            self._connection.commit()
+            self._unsaved = 0
+
+    def _evict_disk(self):
+        count = self._connection.execute(
+            'SELECT COUNT(*) FROM equations').fetchone()[0]
+        excess = count - self.max_disk_entries
+        if excess > 0:
+            self._connection.execute(
+                'DELETE FROM equations WHERE key IN (SELECT key FROM '
+                'equations ORDER BY last_used LIMIT ?)', (excess,))
+            self.disk_evictions += excess
@@ -0,0 +1,180 @@
+'''
+alttex_converter
+
+Keeps the settings of a conversion (the symbol table, delimiters and special
+symbols) ready to convert any number of documents and equations.
+
+Classes:
+    AltTexConverter
+'''
+
+import io
+import re
+from alttex_functions import eqn_tokenise, stream_tokenise, write_altex
+from alttex_symbols import SymbolTable
+
+SPECIAL_SYMBOLS = {
+    r'_': ' subscript ', r'^': ' superscript ',
+    r'>': ' greater than ', r'<': ' less than ', r'-': ' minus ',
+    r'/': ' over ', r'!': ' factorial ', r'|': ' vertical bar '
+}
+DELIMITERS = [
+    r'\$\$(.*?)\$\$', r'\$(.*?)\$', r'\\\((.*?)\\\)', r'\\\[(.*?)\\\]',
+    r'\\begin\{math\}(.*?)\\end\{math\}',
+    r'(?s)\\begin\{equation\}(.*)\\end\{equation\}'
+]
+ENGINES = ('tokenise', 'ast')
+
+
+class AltTexConverter:
+    '''
+    Class to convert LaTeX documents and equations into their alt text
+    versions with one set of settings, which are loaded and compiled once
+
+    The settings are never changed after the converter is created and no
+    state is kept between conversions, so one converter can be shared by
+    many threads.
+
+    Attributes:
+        symbols (SymbolTable) : Table of LaTeX symbols in csv file with their
+            alt text
+        delimiters (tuple) : Compiled math text delimiters to search between
+        special_symbols (dict) : Dictionary of math symbols to be replaced
+        cache (EquationCache) : Cache of the alt text of equations (None to
+            convert every equation)
+        engine (str) : 'tokenise' to convert equations with 'eqn_tokenise',
+            or 'ast' to parse them into a tree and render it (see
+            'alttex_ast')
+        jobs (int) : Number of processes to convert the equations of each
+            document across (1 to convert them in this process, see
+            'alttex_parallel')
+        budget (Budget) : Limits on the time and size of each equation and
+            table (None for no limits, see 'alttex_budget')
+    '''
+
+    def __init__(self, csv_path='LaTeX_Symbols.csv', delimiters=None,
+                 special_symbols=None, symbols=None, cache=None,
+                 engine='tokenise', jobs=1, budget=None):
+        '''
+        Parameters:
+            csv_path (str) : Path to 'LaTeX_Symbols.csv'
+            delimiters (list) : Math text characters to search between
+                (defaults to 'DELIMITERS')
+            special_symbols (dict) : Dictionary of math symbols to be
+                replaced (defaults to 'SPECIAL_SYMBOLS')
+            symbols (SymbolTable) : Table of LaTeX symbols to use instead of
+                loading 'csv_path'
+            cache (EquationCache) : Cache of the alt text of equations, which
+                must be made with 'function=render_equation' for the 'ast'
+                engine (one is made if None)
+            engine (str) : 'tokenise' or 'ast' (see 'ENGINES')
+            jobs (int) : Number of processes to convert the equations of
+                each document across (None for the number of CPUs)
+            budget (Budget) : Limits on the time and size of each equation
+                and table, whose 'diagnostics' record every fallback note
+        '''
+        if engine not in ENGINES:
+            raise ValueError('Unknown engine %r (expected one of %s)'
+                             % (engine, ', '.join(ENGINES)))
+        if engine == 'ast':
+            # Only imported for this engine, as most conversions never use
+            # it
+            from alttex_ast import render_equation
+            from alttex_cache import EquationCache
+            # Documents are converted through the cache, so it is what
+            # chooses the renderer
+            if cache is None:
+                cache = EquationCache(function=render_equation)
+            elif cache.function is not render_equation:
+                raise ValueError("The cache of the 'ast' engine must be made "
+                                 "with 'function=render_equation'")
+        if symbols is None:
+            symbols = SymbolTable.from_csv(csv_path)
+        if delimiters is None:
+            delimiters = DELIMITERS
+        if special_symbols is None:
+            special_symbols = SPECIAL_SYMBOLS
+        self.symbols = symbols
+        self.delimiters = tuple(re.compile(delimiter)
+                                for delimiter in delimiters)
+        # Copied so that changes to the caller's dictionary cannot reach a
+        # conversion running in another thread
+        self.special_symbols = dict(special_symbols)
+        self.cache = cache
+        self.engine = engine
+        self.jobs = jobs
+        self.budget = budget
+
+    def convert_equation(self, equation):
+        '''
+        Function to convert an equation into its alt text
+
+        Parameters:
+            equation (str) : Equation within math text (without delimiters)
+
+        Returns:
+            alt_equation (str) : Alt text version of 'equation'
+        '''
+        if self.cache is not None:
+            convert = self.cache.eqn_tokenise
+        else:
+            convert = eqn_tokenise
+        if self.budget is not None:
+            return self.budget.equation(equation, convert, self.symbols,
+                                        self.special_symbols)
+        return convert(equation, self.symbols, self.special_symbols)
+
+    def iter_document(self, latex_file, index=None):
+        '''
+        Function to convert a LaTeX document as it is read
+
+        Parameters:
+            latex_file (file) : LaTeX document opened for reading (or any
+                iterable of its lines)
+            index (SpanIndex) : Alt text of the parts of the document from
+                the last run (None to convert the whole document)
+
+        Yields:
+            fragment (str) : Next part of the alt text version of the
+                document (see 'stream_tokenise')
+        '''
+        if self.jobs != 1:
+            # Only imported when a pool may be used
+            from alttex_parallel import parallel_tokenise
+            # The whole document is read before the first fragment
+            return parallel_tokenise(latex_file, self.delimiters,
+                                     self.symbols, self.special_symbols,
+                                     self.cache, index, self.jobs,
+                                     self.budget)
+        return stream_tokenise(latex_file, self.delimiters, self.symbols,
+                               self.special_symbols, self.cache, index,
+                               self.budget)
+
+    def convert_document(self, latex_doc):
+        '''
+        Function to convert a LaTeX document into its alt text version
+
+        Parameters:
+            latex_doc (str) : LaTeX document (all as a single string)
+
+        Returns:
+            altex_doc (str) : Alt text version of 'latex_doc', as it would be
+                written to a file by 'write_altex'
+        '''
+        altex_file = io.StringIO()
+        write_altex(self.iter_document(io.StringIO(latex_doc)), altex_file)
+        return altex_file.getvalue()
+
+    def convert_file(self, input_path, output_path, index=None):
+        '''
+        Function to convert a LaTeX document file into its alt text version
+
+        Parameters:
+            input_path (str) : Path to the LaTeX document
+            output_path (str) : Path to write the alt text version to
+            index (SpanIndex) : Alt text of the parts of the document from
+                the last run (None to convert the whole document)
+        '''
+        with open(input_path, 'r', encoding='utf8') as latex_file, \
+                open(output_path, 'w', encoding='utf8') as altex_file:
+            write_altex(self.iter_document(latex_file, index), altex_file)
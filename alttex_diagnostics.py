@@ -0,0 +1,145 @@
+'''
+alttex_diagnostics
+
+Collects what a conversion finds that may need attention (commands not in
+the csv file, delimiters without a match, table rows that do not fit their
+table and macros that could not be expanded), counting each and keeping
+where it was first found, so that one report is written once the conversion
+ends rather than a line of output each time something is found.
+
+Classes:
+    Diagnostics
+'''
+
+import json
+import threading
+
+KINDS = ('unknown command', 'unmatched delimiter', 'table row', 'macro')
+
+
+class Diagnostics:
+    '''
+    Class to collect the diagnostics of conversions, e.g.
+        diagnostics = Diagnostics()
+        with collecting(diagnostics):
+            write_altex(stream_tokenise(...), altex_file)
+        print(diagnostics.text())
+
+    A collector can be shared by many threads, each collecting with its own
+    'collecting' block.
+
+    Attributes:
+        counts (dict) : Kind of each diagnostic mapped to a dictionary of the
+            number of times each item was found
+        first_seen (dict) : Kind of each diagnostic mapped to a dictionary of
+            the file and line each item was first found at (either may be
+            None if not known)
+    '''
+
+    def __init__(self):
+        self.counts = {kind: {} for kind in KINDS}
+        self.first_seen = {kind: {} for kind in KINDS}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return sum(sum(counts.values()) for counts in self.counts.values())
+
+    def add(self, kind, item, where=None, count=1):
+        '''
+        Function to record a diagnostic
+
+        Parameters:
+            kind (str) : 'unknown command', 'unmatched delimiter', 'table
+                row' or 'macro'
+            item (str) : What was found, e.g. the command not in the csv file
+            where (function) : Function giving the file and line the item was
+                found at, only called the first time it is found (None if not
+                known)
+            count (int) : Number of times the item was found
+        '''
+        with self._lock:
+            counts = self.counts.setdefault(kind, {})
+            if item not in counts:
+                counts[item] = 0
+                self.first_seen.setdefault(kind, {})[item] = (
+                    (None, None) if where is None else where())
+            counts[item] += count
+
+    def update(self, report):
+        '''
+        Function to add the diagnostics of another report (e.g. of a document
+        converted in another process), keeping the positions already found
+
+        Parameters:
+            report (dict) : Report from 'Diagnostics.report'
+        '''
+        for kind, entries in report.items():
+            if kind == 'total':
+                continue
+            for entry in entries:
+                position = (entry['file'], entry['line'])
+                self.add(kind, entry['item'], lambda: position,
+                         entry['count'])
+
+    def report(self):
+        '''
+        Function to summarise the diagnostics
+
+        Returns:
+            report (dict) : Total number of diagnostics, and each kind mapped
+                to a list of dictionaries of the item, count, file and line
+                it was first found at, most frequent first
+        '''
+        report = {'total': len(self)}
+        with self._lock:
+            for kind, counts in self.counts.items():
+                report[kind] = [
+                    {'item': item, 'count': count,
+                     'file': self.first_seen[kind][item][0],
+                     'line': self.first_seen[kind][item][1]}
+                    for item, count in sorted(counts.items(),
+                                              key=lambda pair: -pair[1])]
+        return report
+
+    def text(self):
+        '''
+        Function to write the diagnostics as text, one line per item
+
+        Returns:
+            text (str) : e.g. "unknown command \\foo: 3 times (first at
+                notes.tex:12)"
+        '''
+        lines = []
+        for kind, entries in self.report().items():
+            if kind == 'total':
+                continue
+            for entry in entries:
+                lines.append('%s %s: %d %s%s' % (
+                    kind, entry['item'], entry['count'],
+                    'time' if entry['count'] == 1 else 'times',
+                    _first_at(entry['file'], entry['line'])))
+        return '\n'.join(lines)
+
+    def save(self, path):
+        '''
+        Function to write the diagnostics to a file, as text if the path ends
+        with '.txt' or as JSON otherwise
+
+        Parameters:
+            path (str) : Path to write the diagnostics to
+        '''
+        with open(path, 'w', encoding='utf8') as diagnostics_file:
+            if path.endswith('.txt'):
+                diagnostics_file.write(self.text() + '\n')
+            else:
+                json.dump(self.report(), diagnostics_file, indent=2)
+
+
+def _first_at(file, line):
+    if file is None and line is None:
+        return ''
+    if file is None:
+        return ' (first at line %d)' % line
+    if line is None:
+        return ' (first in %s)' % file
+    return ' (first at %s:%d)' % (file, line)
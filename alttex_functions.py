@@ -4,38 +4,156 @@ altex_functions
 Tokenises a LaTeX write-up document and inserts alt text for math text.
 
 Classes:
+    BudgetExceededError
+    CommandSubstituter
+    DelimiterMatcher
+    MathSpan
+    SymbolRules
     Token
+    TokenStream
+    UnbalancedBracesError
 
 Functions:
     alt_commands
     alt_symbols
     begin_doc
     check_brackets
+    checkpoint
+    collecting
+    command_substituter
     convert_commands
     convert_symbols
+    deadline
+    delimiter_matcher
+    diagnostic
+    doc_token_stream
+    eqn_token_stream
     eqn_tokenise
     find_commands
     find_equations
     flatten
+    iter_tabular
+    iter_tokenise
+    match_braces
+    math_spans
     multi_replace
     nested_brackets
     next_bracket
+    parse_groups
+    recording
+    replay
+    stream_tokenise
+    symbol_rules
     tabular
     tokenise
+    write_altex
 '''
 
 import re
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import lru_cache
 from typing import NamedTuple
 from string import ascii_letters
-from pyparsing import nestedExpr
+
+BRACES = re.compile(r'[{}]')
+# A command name is read to its last letter, so the longest name always wins
+# (e.g. '\sinh' is never read as '\sin' followed by 'h')
+COMMAND_NAMES = re.compile(r'\\([{}:,%]|[A-Za-z]*)')
+DOC_TOKEN_SPECIFICATION = [
+    ('NUMBER',     r'\d+(\.\d*)?'),           # Integer or decimal number
+    ('NEWLINE',    r'\n'),                    # Newline
+    ('SKIP',       r'[ \t]+'),                # Skip over spaces and tabs
+    ('ID',         r'[A-Za-z]+'),             # Words
+    ('EQN_1',      r'\$\$(.*?)\$\$'),         # EQN_1-EQN_5 = delimiters
+    ('EQN_2',      r'\$(.*?)\$'),
+    ('EQN_3',      r'\\begin\{math\}(.*?)\\end\{math\}'),
+    ('EQN_4',      r'\\\((.*?)\\\)'),
+    ('EQN_5',      r'\\\[(.*?)\\\]'),
+    ('BEGIN_ENV',  r'\\begin\{([^{}]*)\}'),   # Begin{...} of any environment
+    ('END_ENV',    r'\\end\{([^{}]*)\}'),     # End{...} of any environment
+    ('MISMATCH',   r'.'),                     # Any other character
+]
+DOC_TOKENS = re.compile('|'.join('(?P<%s>%s)' % pair
+                                 for pair in DOC_TOKEN_SPECIFICATION))
+ENVIRONMENTS = re.compile(r'\\(begin|end)\{([^{}]*)\}')
+# Environments converted as a whole, mapped to 'math' for display math (whose
+# alt text follows '\end{...}') or 'table' for tables (see 'iter_tabular').
+# Other environments are left as they are
+ENVIRONMENT_KINDS = {
+    'align': 'math', 'align*': 'math', 'eqnarray': 'math',
+    'eqnarray*': 'math', 'equation': 'math', 'equation*': 'math',
+    'gather': 'math', 'gather*': 'math', 'multline': 'math',
+    'multline*': 'math', 'tabular': 'table',
+}
+EQN_TOKEN_SPECIFICATION = [
+    ('NUMBER',       r'\d+(\.\d*)?'),          # Integer or decimal
+    ('ID',           r'[A-Za-z]+'),            # Words
+    ('SYMBOL',       r'[_/\^/>/</\-///!/\|]'), # Special symbols
+    ('OPEN_BRAC',    r'\\{'),                  # Curly bracket command
+    ('CLOSE_BRAC',   r'\\}'),                  # Curly bracket command
+    ('COLON',        r'\\:'),                  # Colon command
+    ('BRACKET',      r'[\(/\)/\[/\]]'),        # Parentheses
+    ('FRACTION',     r'\\frac'),               # \\frac
+    ('DFRACTION',    r'\\dfrac'),              # \\dfrac
+    ('BRACE',        r'\{(.*?\})'),            # Curly brackets
+    ('AND',          r'\&'),                   # And
+    ('NEWLINE',      r'\\\\'),                 # Newline
+    ('COMMAND',      r'\\'),                   # Command statement
+    ('MISMATCH',     r'.'),                    # Any other character
+]
+EQN_TOKENS = re.compile('|'.join('(?P<%s>%s)' % pair
+                                 for pair in EQN_TOKEN_SPECIFICATION))
+GROUP_STOPS = re.compile(r'[{} \t\n\r\'"]')
+# Flags of a delimiter pattern, kept for its part of a 'DelimiterMatcher'
+INLINE_FLAGS = {re.IGNORECASE: 'i', re.MULTILINE: 'm', re.DOTALL: 's',
+                re.VERBOSE: 'x'}
+QUOTED_STRINGS = {
+    quote: re.compile(quote + r'(?:[^' + quote + r'\n\r\\]|' + quote * 2 +
+                      r'|\\(?:[^x]|x[0-9a-fA-F]+))*')
+    for quote in ('"', "'")
+}
+# Commands left for the text around them by 'alt_commands'
+SKIPPED_COMMANDS = ('left', 'right', 'rm', 'text', ':', ',')
+# Positions of the special symbols whose alt text depends on the math text
+# around them (see 'SymbolRules.convert'), after a big operator, after a
+# logarithm and after any other command. Every other symbol is replaced
+# with 'str.translate'
+SYMBOL_CONTEXTS = {
+    'operator': re.compile(r'[_^]'),
+    'log': re.compile(r'\^(?=[\s\S]{0,2}prime)|\|(?=_)|_'),
+    # '_' is also checked at the start of the equation if it ends with '|',
+    # as the symbol before index 0 is read from the end of the equation
+    'other': re.compile(r'\^(?=[\s\S]{0,2}prime)|\|(?=_)|(?<=\|)_|'
+                        r'\A_(?=[\s\S]*\|\Z)'),
+}
+# Rows of a table converted together, so that repeated equations in them are
+# only converted once
+TABLE_BATCH_ROWS = 64
+# Row ends (with any spacing, e.g. '\\[2pt]'), cell separators and rules in
+# the body of a table
+TABLE_TOKENS = re.compile(
+    r'(?P<ROW_END>\\\\(?:\[[^\]\n]*\])?)|(?P<ESCAPED>\\&)|(?P<CELL_END>&)|'
+    r'(?P<RULE>\\(?:hline|toprule|midrule|bottomrule)(?![A-Za-z])|'
+    r'\\cline\{[^}]*\})')
+# Characters of alt text gathered by 'write_altex' before each write, so
+# that a document is written in a few large writes rather than two per line
+WRITE_BUFFER_SIZE = 1 << 16
+TRIG_FUNCTIONS = ('cos', 'sin', 'tan', 'arccos', 'arcsin', 'arctan', 'cosh',
+                  'sinh', 'tanh', 'cot', 'sec', 'coth')
 
 
 class Token(NamedTuple):
     '''
-    Class to represent a token of a string in 'tokenise' and 'eqn_tokenise'
+    Class to represent a token of a string, as found by 'doc_token_stream'
+    and 'eqn_token_stream' (see 'TokenStream')
 
     Attributes:
-        type (str) : Type of symbol out of options in 'token_specification'
+        type (str) : Type of symbol out of options in 'EQN_TOKEN_SPECIFICATION'
+            or 'DOC_TOKEN_SPECIFICATION'
         value (str) : Substring of token
         index (int) : Start index of 'value' in main string
         end_index (int) : End index of 'value' in main string
@@ -46,6 +164,221 @@ class Token(NamedTuple):
     end_index: int
 
 
+class MathSpan(NamedTuple):
+    '''
+    Class to represent math text found between delimiters, e.g. '$x^2$'
+
+    Attributes:
+        kind (int) : Index of the delimiter in the list of delimiters
+        start (int) : Start index of the math text, including its delimiters
+        end (int) : End index of the math text, including its delimiters
+        body_start (int) : Start index of the equation within the delimiters
+        body_end (int) : End index of the equation within the delimiters
+    '''
+    kind: int
+    start: int
+    end: int
+    body_start: int
+    body_end: int
+
+
+class BudgetExceededError(RuntimeError):
+    '''
+    Class to represent an equation or table that has taken longer to convert
+    than the time it was given (see 'deadline')
+    '''
+
+
+class UnbalancedBracesError(ValueError):
+    '''
+    Class to represent an open brace without a close brace (or the reverse)
+    in an equation
+    '''
+
+
+class _Deadlines(threading.local):
+    # Deadline of the conversion running in each thread (see 'deadline'),
+    # which is None rather than missing in a new thread so that looking it
+    # up stays cheap
+    time = None
+
+
+_deadlines = _Deadlines()
+
+
+@contextmanager
+def deadline(seconds):
+    '''
+    Function to limit the time of the conversion within a 'with' block in
+    this thread, e.g.
+        with deadline(0.5):
+            eqn_tokenise(equation, symbols, special_symbols)
+
+    Parameters:
+        seconds (float) : Time after which 'checkpoint' raises
+            'BudgetExceededError' (an earlier deadline of an enclosing block
+            is kept, and None keeps it as it is)
+    '''
+    previous = _deadlines.time
+    if seconds is not None:
+        end = time.perf_counter() + seconds
+        _deadlines.time = end if previous is None else min(previous, end)
+    try:
+        yield
+    finally:
+        _deadlines.time = previous
+
+
+def checkpoint():
+    '''
+    Function to stop a conversion once it has passed the deadline set for it
+    by 'deadline' (nothing is checked if no deadline is set)
+    '''
+    end = _deadlines.time
+    if end is not None and time.perf_counter() > end:
+        raise BudgetExceededError('The time budget ran out')
+
+
+class _Reports(threading.local):
+    # Diagnostics collected from the conversion running in each thread (see
+    # 'collecting'), with the file, span and offset within the span that the
+    # conversion has reached, the offset within the span and text of the
+    # equation being converted, and the number of lines read by
+    # 'stream_tokenise'
+    diagnostics = None
+    file = None
+    span = None
+    offset = 0
+    equation = None
+    stream_span = None
+    lines_read = 0
+
+
+_reports = _Reports()
+
+
+@contextmanager
+def collecting(diagnostics):
+    '''
+    Function to collect what the conversion within a 'with' block in this
+    thread finds that may need attention (commands not in the csv file,
+    delimiters without a match, table rows that do not fit their table and
+    macros that could not be expanded), rather than writing anything as the
+    conversion goes, e.g.
+        with collecting(diagnostics):
+            write_altex(stream_tokenise(...), altex_file)
+
+    Parameters:
+        diagnostics (Diagnostics) : Collector given each diagnostic (see
+            'alttex_diagnostics'), or None to collect nothing
+    '''
+    previous = dict(_reports.__dict__)
+    _reports.__dict__.clear()
+    _reports.diagnostics = diagnostics
+    try:
+        yield
+    finally:
+        _reports.__dict__.clear()
+        _reports.__dict__.update(previous)
+
+
+def diagnostic(kind, item):
+    '''
+    Function to record something found by the conversion running in this
+    thread with the diagnostics being collected (nothing is recorded if none
+    are, see 'collecting')
+
+    Parameters:
+        kind (str) : 'unknown command', 'unmatched delimiter', 'table row'
+            or 'macro'
+        item (str) : What was found, e.g. the command not in the csv file
+    '''
+    diagnostics = _reports.diagnostics
+    if diagnostics is None:
+        return
+    equation = _reports.equation
+    if equation is None:
+        diagnostics.add(kind, item, _position)
+        return
+    # Recorded at the item within the equation being converted, which may
+    # be on a later line than the equation starts on
+    start, text = equation
+    offset = _reports.offset
+    _reports.offset = start + max(text.find(item), 0)
+    try:
+        diagnostics.add(kind, item, _position)
+    finally:
+        _reports.offset = offset
+
+
+def _position():
+    # File and line of the diagnostic being recorded (the line is None if
+    # not known). Each line of the document is followed by an extra newline
+    # within a span (see 'begin_doc'), and '_doc_lines' reads one line
+    # ahead, so the line within a document being streamed is found by
+    # counting back from the end of the span
+    span = _reports.span
+    if span is None:
+        return None, None
+    if span is _reports.stream_span:
+        return _reports.file, max(1, _reports.lines_read -
+                                  span.count('\n', _reports.offset) // 2)
+    return None, span.count('\n', 0, _reports.offset) + 1
+
+
+@contextmanager
+def recording():
+    '''
+    Function to keep what the conversion within a 'with' block in this
+    thread finds that may need attention (which is still recorded with the
+    diagnostics being collected), so that it can be recorded again with
+    'replay' whenever the alt text is reused rather than made again, e.g.
+        with recording() as found:
+            alt_equation = eqn_tokenise(...)
+
+    Yields:
+        found (list) : Kind, item and offset within the span of each
+            diagnostic found, in the order they were found
+    '''
+    recorder = _Recorder(_reports.diagnostics)
+    _reports.diagnostics = recorder
+    try:
+        yield recorder.found
+    finally:
+        _reports.diagnostics = recorder.diagnostics
+
+
+def replay(found, offsets=False):
+    '''
+    Function to record the diagnostics kept by 'recording' again, as if the
+    alt text they were found in had been made again
+
+    Parameters:
+        found (iterable) : Kind, item and offset within the span of each
+            diagnostic (see 'recording')
+        offsets (bool) : Whether each diagnostic is recorded at its offset
+            within the current span (e.g. when a part of a document is
+            reused), rather than where the conversion has reached
+    '''
+    for kind, item, offset in found:
+        if offsets:
+            _reports.offset = offset
+        diagnostic(kind, item)
+
+
+class _Recorder:
+    # Stands in for the diagnostics collector, keeping each diagnostic with
+    # the offset within the span it was found at before passing it on
+    def __init__(self, diagnostics):
+        self.diagnostics = diagnostics
+        self.found = []
+
+    def add(self, kind, item, where=None, count=1):
+        self.found.append((kind, item, _reports.offset))
+        if self.diagnostics is not None:
+            self.diagnostics.add(kind, item, where, count)
+
+
 def begin_doc(original_doc):
     '''
     Function to insert the todo package statement into the LaTeX document
@@ -59,13 +392,132 @@ def begin_doc(original_doc):
     latex_doc = '\n'.join(original_doc)
     if bool(re.search(r'{todonotes}', latex_doc)) is True:
         return latex_doc
-    begin_index = re.search(r'\\begin\{document\}', latex_doc).start()
+    begin_match = re.search(r'\\begin\{document\}', latex_doc)
+    if begin_match is None:
+        raise ValueError('No \\begin{document} in the LaTeX document')
+    begin_index = begin_match.start()
     latex_doc = (latex_doc[:begin_index] +
                  '\\usepackage[color=white, bordercolor=black]{todonotes}\n' +
                  latex_doc[begin_index:])
     return latex_doc
 
 
+class DelimiterMatcher:
+    '''
+    Class to find math text between any of a list of delimiters with a
+    single compiled pattern, where each match gives the delimiter, the math
+    text and the equation within it (see 'MathSpan')
+
+    Delimiters are tried in the order they are listed where more than one
+    could start at the same index, as in 'find_equations'.
+
+    Attributes:
+        pattern (Pattern) : Pattern of all of the delimiters
+    '''
+
+    def __init__(self, delimiters):
+        '''
+        Parameters:
+            delimiters (list) : Math text characters to search between,
+                where the first group of each is the equation (without
+                numbered backreferences, as the groups are renumbered)
+        '''
+        alternatives = []
+        self._kinds = {}
+        group = 1
+        for kind, delimiter in enumerate(delimiters):
+            delimiter = re.compile(delimiter)
+            # Flags such as '(?s)' are only allowed at the start of a
+            # pattern, so they are kept for this delimiter's part alone
+            source = re.sub(r'^\(\?[aiLmsux]+\)', '', delimiter.pattern)
+            flags = ''.join(letter for flag, letter in INLINE_FLAGS.items()
+                            if delimiter.flags & flag)
+            if flags != '':
+                source = '(?%s:%s)' % (flags, source)
+            alternatives.append('(%s)' % source)
+            self._kinds[group] = (kind, group + 1 if delimiter.groups > 0
+                                  else None)
+            group += 1 + delimiter.groups
+        self.pattern = re.compile('|'.join(alternatives))
+
+    def match(self, text, pos=0):
+        '''
+        Function to find math text starting at 'pos'
+
+        Parameters:
+            text (str) : Text to search
+            pos (int) : Index the math text must start at
+
+        Returns:
+            span (MathSpan) : Math text starting at 'pos' (None if there is
+                none)
+        '''
+        match = self.pattern.match(text, pos)
+        return None if match is None else self._span(match)
+
+    def finditer(self, text, pos=0):
+        '''
+        Function to find all of the math text in 'text' in one pass
+
+        Parameters:
+            text (str) : Text to search
+            pos (int) : Index to start searching from
+
+        Yields:
+            span (MathSpan) : Next math text in 'text'
+        '''
+        for match in self.pattern.finditer(text, pos):
+            yield self._span(match)
+
+    def _span(self, match):
+        kind, body = self._kinds[match.lastindex]
+        start, end = match.span()
+        body_start, body_end = (match.span(body) if body is not None
+                                else (start, end))
+        if body_start < 0:
+            body_start = body_end = end
+        return MathSpan(kind, start, end, body_start, body_end)
+
+
+def delimiter_matcher(delimiters):
+    '''
+    Function to find the delimiter matcher of a list of delimiters, which is
+    only compiled once for each list
+
+    Parameters:
+        delimiters (list) : Math text characters to search between
+
+    Returns:
+        matcher (DelimiterMatcher) : Matcher of 'delimiters'
+    '''
+    delimiters = [re.compile(delimiter) for delimiter in delimiters]
+    return _delimiter_matcher(tuple((delimiter.pattern, delimiter.flags)
+                                    for delimiter in delimiters))
+
+
+@lru_cache(maxsize=16)
+def _delimiter_matcher(sources):
+    # Compiled delimiters cannot be compared, so the matchers are cached by
+    # the patterns and flags of the delimiters
+    return DelimiterMatcher([re.compile(pattern, flags)
+                             for pattern, flags in sources])
+
+
+def math_spans(latex_doc, delimiters):
+    '''
+    Function to index all of the math text in a LaTeX document in one pass
+
+    Parameters:
+        latex_doc (str) : LaTeX document (or any part of it)
+        delimiters (list) : Math text characters to search between
+
+    Returns:
+        spans (list) : Math text in 'latex_doc' (see 'MathSpan'), in the
+            order it appears
+    '''
+    return list(delimiter_matcher(delimiters).finditer(latex_doc))
+
+
 def find_equations(token, delimiters):
     '''
     Function to find the math text within the given delimiters
@@ -79,12 +531,23 @@ def find_equations(token, delimiters):
             if no delimiters are found)
     '''
     for delimiter in delimiters:
-        if re.findall(delimiter, token) != []:
-            equation = re.findall(delimiter, token)[0]
+        match = re.search(delimiter, token)
+        if match is not None:
+            equation = _match_value(match)
             if equation != '':
                 return equation
 
 
+def _match_value(match):
+    # The first item 're.findall' would give for the same pattern
+    groups = match.groups('')
+    if len(groups) == 0:
+        return match.group()
+    if len(groups) == 1:
+        return groups[0]
+    return groups
+
+
 def find_commands(equation):
     '''
     Function to identify '\' LaTeX commands within math text
@@ -117,14 +580,14 @@ def find_commands(equation):
     return commands
 
 
-def convert_commands(commands, symbols, converted_symbols):
+def convert_commands(commands, symbols):
     '''
     Function to convert the commands found in the math text to alt text
 
     Paramters:
         commands (list) : List of identified commands within the equation
-        symbols (list) : List of LaTeX symbols in csv file
-        converted_symbols (list) : List of alt text versions of 'symbols'
+        symbols (SymbolTable) : Table of LaTeX symbols in csv file with their
+            alt text
 
     Returns:
         converted (dict) : Dictionary of 'commands' with their alt text
@@ -132,55 +595,149 @@ def convert_commands(commands, symbols, converted_symbols):
     '''
     converted = {}
     if isinstance(commands, str):
-        if commands != [] and commands in symbols:
-            converted[commands] = converted_symbols[symbols.index(commands)]
+        commands = [commands]
+    for command in commands:
+        if command in symbols:
+            converted[command] = symbols[command]
         else:
-            print(commands + ' not in CSV file.')
-    else:
-        for command in commands:
-            if command != [] and command in symbols:
-                converted[command] = converted_symbols[symbols.index(command)]
-            else:
-                print(command + ' not in CSV file.')
+            diagnostic('unknown command', '\\' + command)
     return converted
 
 
-def alt_commands(arg, track_commands, symbols, converted_symbols,
-                 special_symbols):
+def _known_start(name, symbols):
+    # Longest start of a command name that is in the csv file, so that e.g.
+    # '\\limx' is read as '\\lim' followed by 'x' (None if there is none)
+    for size in range(len(name) - 1, 0, -1):
+        if name[:size] in symbols:
+            return name[:size]
+    return None
+
+
+def alt_commands(arg, track_commands, symbols, special_symbols):
     '''
     Function to convert the commands to alt text
 
     Parameters:
         arg (str) : Math text within brackets
         commands (list) : List of identified commands within the equation
-        symbols (list) : List of LaTeX symbols in csv file
-        converted_symbols (list) : List of alt text versions of 'symbols'
+        symbols (SymbolTable) : Table of LaTeX symbols in csv file with their
+            alt text
         special_symbols (dict) : Dictionary of math symbols to be replaced
 
     Returns:
-        alt_equation (list) : Alt text of 'arg'
+        alt_equation (list) : Alt text of 'arg' (empty if the only commands
+            in 'arg' are in 'SKIPPED_COMMANDS')
     '''
-    alt_equation = []
-    commands = find_commands(arg)
-    for command in commands:
-        if command in ('left', 'right', 'rm', 'text', ':', ','):
-            continue
-        converted = convert_commands(command, symbols, converted_symbols)
-        if command in ('cos', 'sin', 'tan', 'arccos', 'arcsin', 'arctan',
-                       'cosh', 'sinh', 'tanh', 'cot', 'sec', 'coth'):
-            index = re.search(command, arg).end()
-            try:
-                if arg[index] == '^':
-                    key, value = list(converted.items())[0]
-                    convert_command = value.replace('of', '')
-                    converted[command] = convert_command
-            except IndexError:
-                pass
-        alt_command = multi_replace(arg, converted)
-        alt_command = alt_symbols(alt_command, track_commands, special_symbols)
-        alt_command = ''.join(flatten(alt_command))
-        alt_equation.append(alt_command.replace('\\', ''))
-    return alt_equation
+    alt_command, converted = command_substituter(symbols).substitute(
+        arg, COMMAND_HANDLERS)
+    if converted == 0:
+        return []
+    alt_command = alt_symbols(alt_command, track_commands, special_symbols)
+    alt_command = ''.join(flatten(alt_command))
+    return [alt_command.replace('\\', '')]
+
+
+def _skip_command(name, alt_text, text, end):
+    # Leaves e.g. '\left' and '\text' for the brackets and text after them
+    return None
+
+
+def _trig_power(name, alt_text, text, end):
+    # 'sin^2 x' is read as 'sine superscript 2 x' rather than 'sine of
+    # superscript 2 x'
+    if alt_text is not None and text.startswith('^', end):
+        return alt_text.replace('of', '')
+    return alt_text
+
+
+# Handlers of the commands that 'alt_commands' does not simply replace
+COMMAND_HANDLERS = dict.fromkeys(SKIPPED_COMMANDS, _skip_command)
+COMMAND_HANDLERS.update(dict.fromkeys(TRIG_FUNCTIONS, _trig_power))
+
+
+class CommandSubstituter:
+    '''
+    Class to replace every '\\' command in math text with its alt text in a
+    single pass, rather than one pass over the text per command
+
+    Attributes:
+        symbols (SymbolTable) : Table of LaTeX symbols in csv file with their
+            alt text
+    '''
+
+    def __init__(self, symbols):
+        '''
+        Parameters:
+            symbols (SymbolTable) : Table of LaTeX symbols in csv file with
+                their alt text
+        '''
+        self.symbols = symbols
+
+    def substitute(self, text, handlers=None):
+        '''
+        Function to replace the commands in 'text' with their alt text
+
+        Parameters:
+            text (str) : Math text
+            handlers (dict) : Commands mapped to functions that give their
+                replacement, called with the command, its alt text, 'text'
+                and the index after the command, and returning the new alt
+                text (or None to leave the command as it is written); the
+                alt text is None for commands not in the csv file
+
+        Returns:
+            alt_text (str) : 'text' with each command replaced by its alt
+                text (a command not in the csv file is read as the longest
+                command in it that the name starts with, followed by text;
+                commands with no such start, or left by a handler, lose
+                their backslash)
+            converted (int) : Number of commands not left by a handler
+        '''
+        symbols = self.symbols
+        alt_text = []
+        converted = 0
+        last = 0
+        for match in COMMAND_NAMES.finditer(text):
+            name = match.group(1)
+            end = match.end()
+            replacement = symbols.get(name)
+            if replacement is None and (handlers is None or
+                                        name not in handlers):
+                known = _known_start(name, symbols)
+                if known is not None:
+                    name = known
+                    end = match.start() + 1 + len(name)
+                    replacement = symbols.get(name)
+            alt_text.append(text[last:match.start()])
+            last = end
+            if handlers is not None and name in handlers:
+                replacement = handlers[name](name, replacement, text, end)
+                if replacement is None:
+                    alt_text.append(' ' + name)
+                    continue
+            elif replacement is None:
+                convert_commands(name, symbols)
+                replacement = name
+            alt_text.append(' ' + replacement)
+            converted += 1
+        alt_text.append(text[last:])
+        return ''.join(alt_text), converted
+
+
+@lru_cache(maxsize=16)
+def command_substituter(symbols):
+    '''
+    Function to find the command substituter of a symbol table, which is
+    only made once for each table
+
+    Parameters:
+        symbols (SymbolTable) : Table of LaTeX symbols in csv file with their
+            alt text
+
+    Returns:
+        substituter (CommandSubstituter) : Substituter of 'symbols'
+    '''
+    return CommandSubstituter(symbols)
 
 
 def multi_replace(equation, replace_dict):
@@ -194,15 +751,26 @@ def multi_replace(equation, replace_dict):
     Returns:
         replaced_eqn (str) : 'equation' with replaced commands and symbols
     '''
-    dict_keys = [re.escape(k) for k in sorted(replace_dict, key=len,
-                                              reverse=True)]
-    pattern = re.compile("|".join(dict_keys), flags=re.DOTALL)
-    replaced_eqn = pattern.sub(lambda x: replace_dict[x.group(0)], equation)
+    if replace_dict == {}:
+        # e.g. a command not in the csv file, which is left as it is
+        replaced_eqn = equation
+    else:
+        pattern = _replace_pattern(tuple(replace_dict))
+        replaced_eqn = pattern.sub(lambda x: replace_dict[x.group(0)],
+                                   equation)
     replaced_eqn = replaced_eqn.replace('\\', ' ')
     return replaced_eqn
 
 
-def convert_symbols(equation, index, value, track_commands, special_symbols):
+@lru_cache(maxsize=256)
+def _replace_pattern(keys):
+    # Longest keys first, so that no key is replaced in part by a shorter one
+    dict_keys = [re.escape(k) for k in sorted(keys, key=len, reverse=True)]
+    return re.compile("|".join(dict_keys), flags=re.DOTALL)
+
+
+def convert_symbols(equation, index, value, track_commands, special_symbols,
+                    braces=None):
     '''
     Function to convert symbols to alt text
 
@@ -213,50 +781,14 @@ def convert_symbols(equation, index, value, track_commands, special_symbols):
         track_commands (list) : List of previous commands found in math text
         alt_equation (list) : Alt text of previous math text
         special_symbols (dict) : Dictionary of math symbols to be replaced
+        braces (dict) : Brace index of 'equation' from 'match_braces'
 
     Returns:
         alt_equation (list) : Alt text of 'value' added onto previous alt text
     '''
-    symbol = []
-    alt_equation = []
-    try:
-        if (track_commands[-1] == 'sum' or track_commands[-1] == 'int' or
-                track_commands[-1] == 'prod'):
-            if value == '^':
-                if '^' not in symbol:
-                    alt_equation.append(' to ')
-                else:
-                    alt_equation.append(' superscript ')
-                symbol.append(value)
-            elif value == '_':
-                symbol.append(value)
-                if equation[index + 1] == '{':
-                    close_brac = len(next_bracket(equation, index + 1)[0])
-                    if (equation[index + close_brac] != '^' and 
-                            '^' not in symbol):
-                        alt_equation.append(' over ')
-                    else:
-                        alt_equation.append(' from ')
-                else:
-                    if equation[index + 2] != '^' and '^' not in symbol:
-                        alt_equation.append(' over ')
-                    else:
-                        alt_equation.append(' from ')
-            else:
-                alt_equation.append(multi_replace(value, special_symbols))
-        elif value == '^' and 'prime' in equation[index+1:index+8]:
-            alt_equation.append(' ')
-        elif track_commands[-1] == 'log' and value == '_':
-            alt_equation.append(' base ')
-        elif value == '_' and equation[index - 1] == '|':
-            alt_equation.append(' ')
-        elif value == '|' and equation[index + 1] == '_':
-            alt_equation.append(' evaluated at ')
-        else:
-            alt_equation.append(multi_replace(value, special_symbols))
-    except IndexError:
-        alt_equation.append(multi_replace(value, special_symbols))
-    return alt_equation
+    rules = symbol_rules(special_symbols)
+    command = track_commands[-1] if track_commands != [] else None
+    return [rules.convert(equation, index, value, command, braces)]
 
 
 def alt_symbols(equation, track_commands, special_symbols):
@@ -269,18 +801,137 @@ def alt_symbols(equation, track_commands, special_symbols):
         special_symbols (dict) : Dictionary of math symbols to be replaced
 
     Returns:
-        alt_equation (str) : Equation string with all special symbols
-            converted
+        alt_equation (list) : Parts of the equation string with all special
+            symbols converted
     '''
-    alt_equation = []
-    for i, char in enumerate(equation):
-        if char in special_symbols.keys():
-            alt_equation.append(convert_symbols(equation, i, char, 
-                                                track_commands, 
-                                                special_symbols))
+    rules = symbol_rules(special_symbols)
+    command = track_commands[-1] if track_commands != [] else None
+    return rules.apply(equation, command)
+
+
+class SymbolRules:
+    '''
+    Class to convert the special symbols of math text, with the alt text of
+    each symbol and the rules for symbols that depend on the text around them
+    made once for each dictionary of special symbols
+
+    Attributes:
+        special_symbols (dict) : Dictionary of math symbols to be replaced
+        table (dict) : Translation table of the single character symbols for
+            'str.translate'
+    '''
+
+    def __init__(self, special_symbols):
+        '''
+        Parameters:
+            special_symbols (dict) : Dictionary of math symbols to be
+                replaced
+        '''
+        self.special_symbols = special_symbols
+        self._plain = {symbol: multi_replace(symbol, special_symbols)
+                       for symbol in special_symbols if len(symbol) == 1}
+        self.table = str.maketrans(self._plain)
+
+    def apply(self, equation, command):
+        '''
+        Function to convert all of the special symbols within an equation
+
+        Parameters:
+            equation (str) : Equation within math text
+            command (str) : Last command found in the math text (None to
+                convert every symbol without its context)
+
+        Returns:
+            alt_equation (list) : Parts of 'equation' with all special
+                symbols converted
+        '''
+        if command is None:
+            return [equation.translate(self.table)]
+        if command in ('sum', 'int', 'prod'):
+            context = SYMBOL_CONTEXTS['operator']
+        elif command == 'log':
+            context = SYMBOL_CONTEXTS['log']
         else:
-            alt_equation.append(char)
-    return alt_equation
+            context = SYMBOL_CONTEXTS['other']
+        alt_equation = []
+        last = 0
+        for match in context.finditer(equation):
+            index = match.start()
+            value = equation[index]
+            if value not in self._plain:
+                continue
+            alt_equation.append(equation[last:index].translate(self.table))
+            alt_equation.append(self.convert(equation, index, value,
+                                             command))
+            last = index + 1
+        alt_equation.append(equation[last:].translate(self.table))
+        return alt_equation
+
+    def convert(self, equation, index, value, command, braces=None):
+        '''
+        Function to convert a symbol to alt text, given the text around it
+
+        Parameters:
+            equation (str) : Equation within math text
+            index (int) : Index of 'value' in 'equation'
+            value (str) : Symbol found in math text
+            command (str) : Last command found in the math text (None to
+                convert 'value' without its context)
+            braces (dict) : Brace index of 'equation' from 'match_braces'
+
+        Returns:
+            alt_symbol (str) : Alt text of 'value'
+        '''
+        try:
+            if command is None:
+                pass
+            elif command in ('sum', 'int', 'prod'):
+                if value == '^':
+                    return ' to '
+                elif value == '_':
+                    if equation[index + 1] == '{':
+                        close_brac = len(next_bracket(equation, index + 1,
+                                                      braces)[0])
+                        if equation[index + close_brac] != '^':
+                            return ' over '
+                        return ' from '
+                    if equation[index + 2] != '^':
+                        return ' over '
+                    return ' from '
+            elif value == '^' and 'prime' in equation[index+1:index+8]:
+                return ' '
+            elif command == 'log' and value == '_':
+                return ' base '
+            elif value == '_' and equation[index - 1] == '|':
+                return ' '
+            elif value == '|' and equation[index + 1] == '_':
+                return ' evaluated at '
+        except (IndexError, UnbalancedBracesError):
+            pass
+        alt_symbol = self._plain.get(value)
+        if alt_symbol is None:
+            return multi_replace(value, self.special_symbols)
+        return alt_symbol
+
+
+def symbol_rules(special_symbols):
+    '''
+    Function to find the symbol rules of a dictionary of special symbols,
+    which are only made once for each dictionary
+
+    Parameters:
+        special_symbols (dict) : Dictionary of math symbols to be replaced
+
+    Returns:
+        rules (SymbolRules) : Rules of 'special_symbols'
+    '''
+    return _symbol_rules(tuple(special_symbols.items()))
+
+
+@lru_cache(maxsize=16)
+def _symbol_rules(items):
+    # Dictionaries cannot be hashed, so the rules are cached by their items
+    return SymbolRules(dict(items))
 
 
 def check_brackets(equation):
@@ -315,7 +966,29 @@ def check_brackets(equation):
     return stack == []
 
 
-def next_bracket(equation, index):
+def match_braces(equation):
+    '''
+    Function to match every open brace in 'equation' with its close brace in
+    a single pass
+
+    Parameters:
+        equation (str) : Equation within math text
+
+    Returns:
+        braces (dict) : Dictionary of the index of each open brace with the
+            index of its close brace (unmatched braces are left out)
+    '''
+    braces = {}
+    stack = []
+    for match in BRACES.finditer(equation):
+        if match.group() == '{':
+            stack.append(match.start())
+        elif stack != []:
+            braces[stack.pop()] = match.start()
+    return braces
+
+
+def next_bracket(equation, index, braces=None):
     '''
     Function to find the equation string with complete brackets
 
@@ -323,20 +996,110 @@ def next_bracket(equation, index):
         equation (str) : Equation within math text
         index (int) : Index of the start bracket (or the index for the end of
             '\\frac' in the case of searching for fractions)
+        braces (dict) : Brace index of 'equation' from 'match_braces' (the
+            close brace is searched for if this is not given)
 
     Returns:
         complete (tup) : Tuple where the first element is the equation string
             containing complete brackets and the second element is the index
             of the closed bracket
     '''
-    complete = []
-    count = index + 1
-    while count < len(equation):
-        for _ in equation[index:]:
-            if check_brackets(equation[index:count]) is True:
-                complete.append((equation[index:count], count))
-            count += 1
-    return complete[0]
+    if index >= len(equation) or equation[index] == '}':
+        raise UnbalancedBracesError(
+            'No open brace at index %d of %r' % (index, equation))
+    if equation[index] != '{':
+        return (equation[index], index + 1)
+    if braces is not None:
+        close_index = braces.get(index)
+    else:
+        close_index = None
+        depth = 0
+        for match in BRACES.finditer(equation, index):
+            depth += 1 if match.group() == '{' else -1
+            if depth == 0:
+                close_index = match.start()
+                break
+    if close_index is None:
+        raise UnbalancedBracesError(
+            'No close brace for the open brace at index %d of %r' %
+            (index, equation))
+    return (equation[index:close_index + 1], close_index + 1)
+
+
+def _quoted_end(equation, index):
+    # Quoted strings are kept whole (as pyparsing's 'quotedString' did), so
+    # primes such as f''(x) stay in one part
+    match = QUOTED_STRINGS[equation[index]].match(equation, index)
+    end_index = match.end()
+    if end_index < len(equation) and equation[end_index] == equation[index]:
+        return end_index + 1
+    return None
+
+
+def parse_groups(equation):
+    '''
+    Function to split a string in braces into nested lists of its
+    whitespace separated parts in a single pass
+
+    Parameters:
+        equation (str) : Equation within math text, starting with '{' and
+            ending with its close brace
+
+    Returns:
+        parts (list) : Parts within the outer braces, where each inner brace
+            group is a nested list (e.g. '{x^{2}+1}' gives ['x^', ['2'], '+1'])
+    '''
+    # Tabs are expanded first, as pyparsing's 'parseString' did
+    equation = equation.expandtabs()
+    root = []
+    stack = [root]
+    index = 0
+    length = len(equation)
+    while index < length:
+        char = equation[index]
+        if char in ' \t\n\r':
+            index += 1
+        elif char == '{':
+            group = []
+            stack[-1].append(group)
+            stack.append(group)
+            index += 1
+        elif char == '}':
+            if len(stack) == 1:
+                raise UnbalancedBracesError(
+                    'No open brace for the close brace at index %d of %r' %
+                    (index, equation))
+            stack.pop()
+            index += 1
+        elif len(stack) == 1:
+            raise UnbalancedBracesError(
+                'Expected a single group in braces, got %r' % equation)
+        else:
+            end_index = None
+            if char in '\'"':
+                end_index = _quoted_end(equation, index)
+            if end_index is None:
+                # Plain text runs until whitespace, a brace or a quoted string
+                end_index = index + 1
+                while True:
+                    match = GROUP_STOPS.search(equation, end_index)
+                    if match is None:
+                        end_index = length
+                        break
+                    end_index = match.start()
+                    if (match.group() not in '\'"' or
+                            _quoted_end(equation, end_index) is not None):
+                        break
+                    end_index += 1
+            stack[-1].append(equation[index:end_index])
+            index = end_index
+    if len(stack) != 1:
+        raise UnbalancedBracesError(
+            'No close brace for the open brace in %r' % equation)
+    if len(root) != 1:
+        raise UnbalancedBracesError(
+            'Expected a single group in braces, got %r' % equation)
+    return root[0]
 
 
 def flatten(eqn_list):
@@ -358,23 +1121,21 @@ def flatten(eqn_list):
     return flattened
 
 
-def nested_brackets(equation, track_commands, symbols, converted_symbols,
-                    special_symbols):
+def nested_brackets(equation, track_commands, symbols, special_symbols):
     '''
     Function to find the elements within nested brackets
 
     Parameters:
         equation (str) : Equation within math text
-        symbols (list) : List of LaTeX symbols in csv file
-        converted_symbols (list) : List of alt text versions of 'symbols'
+        symbols (SymbolTable) : Table of LaTeX symbols in csv file with their
+            alt text
         special_symbols (dict) : Dictionary of math symbols to be replaced
 
     Returns:
         alt_equation (list) : List of alt text components within the brackets
     '''
     decomposed = []
-    parser = nestedExpr(opener='{', closer='}')
-    parts = parser.parseString(equation, parseAll=True).asList()[0]
+    parts = parse_groups(equation)
     for i, part in enumerate(parts):
         if part[-1] == '^' or part[-1] == '_' and isinstance(parts[i+1], list):
             if len(parts[i+1]) < 2:
@@ -398,16 +1159,12 @@ def nested_brackets(equation, track_commands, symbols, converted_symbols,
     decomposed = flatten(parts)
     alt_equation = []
     for part in decomposed:
-        commands = find_commands(part)
-        if commands != [] and (alt_commands(part, track_commands, symbols,
-                                            converted_symbols,
-                                            special_symbols) == []):
-            continue
-        if commands != []:
-            alt_equation.append(alt_commands(part, track_commands, symbols,
-                                             converted_symbols,
-                                             special_symbols)[0])
-        if commands == []:
+        if '\\' in part:
+            alt_command = alt_commands(part, track_commands, symbols,
+                                       special_symbols)
+            if alt_command != []:
+                alt_equation.append(alt_command[0])
+        else:
             for char in part:
                 if bool(re.match('[A-Z]', char)) is True:
                     capital_dict = {char: ' uppercase ' + char}
@@ -418,78 +1175,363 @@ def nested_brackets(equation, track_commands, symbols, converted_symbols,
     return alt_equation
 
 
-def tabular(table, delimiters, symbols, converted_symbols, special_symbols):
+def tabular(table, delimiters, symbols, special_symbols, cache=None):
     '''
     Function to create alt text for a table in the LaTeX document
 
     Parameters:
         table (str) : String of text within the tabular environment
         delimiters (list) : Math text characters to search between
-        symbols (list) : List of LaTeX symbols in csv file
-        converted_symbols (list) : List of alt text versions of 'symbols'
+        symbols (SymbolTable) : Table of LaTeX symbols in csv file with their
+            alt text
         special_symbols (dict) : Dictionary of math symbols to be replaced
+        cache (EquationCache) : Cache of the alt text of equations (None
+            to convert every equation)
 
     Returns:
-        alt_tab (str) : Alt text version of 'table'
-    '''
-    alt_text = []
-    cols = next_bracket(table, 0)[0]
-    separators = re.findall(r'c', cols)
-    newlines = [match.start() for match in re.finditer(r'\\\\', table)]
-    alt_text.append('\\todo[inline]{begin alt text. Table with ' +
-                    str(len(separators)) + ' columns and ' +
-                    str(len(newlines)) + ' rows.')
-
-    row_indices = [match.end() for match in re.finditer(r'\\hline', table)]
-    for i, index in enumerate(row_indices):
-        try:
-            eqn = table[index:row_indices[i+1]]
-            if re.search(r'\n\n', eqn) is not None:
-                eqn = eqn[re.search(r'\n\n', eqn).end():]
-            and_indices = [char.start() for char in re.finditer(r'\&', eqn)]
-            line_end = re.search(r'\\\\', eqn).start()
-        except IndexError:
+        alt_tab (list) : Alt text version of 'table' (see 'iter_tabular')
+    '''
+    return list(iter_tabular(table, delimiters, symbols, special_symbols,
+                             cache))
+
+
+def iter_tabular(table, delimiters, symbols, special_symbols, cache=None):
+    '''
+    Function to create alt text for a table in the LaTeX document a few rows
+    at a time, reading the table once from start to end
+
+    Rows end at each '\\\\' (with or without rules such as '\\hline'
+    between them), and columns are counted from the 'l', 'c', 'r' and
+    'p{...}' (or 'm{...}' and 'b{...}') column specification.
+
+    Parameters:
+        table (str) : String of text within the tabular environment
+        delimiters (list) : Math text characters to search between
+        symbols (SymbolTable) : Table of LaTeX symbols in csv file with their
+            alt text
+        special_symbols (dict) : Dictionary of math symbols to be replaced
+        cache (EquationCache) : Cache of the alt text of equations (None
+            to convert every equation)
+
+    Yields:
+        fragment (str) : Next part of the alt text version of 'table'
+    '''
+    columns, body_start = _table_columns(table)
+    rows = table.count('\\\\', body_start)
+    # A last row does not need to end with '\\'
+    last_row = max(body_start, table.rfind('\\\\') + 2)
+    if TABLE_TOKENS.sub('', table[last_row:]).strip() != '':
+        rows += 1
+    yield ('\\todo[inline]{begin alt text. Table with ' + str(columns) +
+           ' columns and ' + str(rows) + ' rows.')
+    reporting = _reports.diagnostics is not None
+    batch = []
+    first = True
+    for cells in _table_rows(table, body_start):
+        checkpoint()
+        if reporting:
+            _check_row(cells, columns)
+        batch.append(cells)
+        if len(batch) == TABLE_BATCH_ROWS:
+            yield from _table_batch(batch, first, delimiters, symbols,
+                                    special_symbols, cache)
+            batch = []
+            first = False
+    yield from _table_batch(batch, first, delimiters, symbols,
+                            special_symbols, cache)
+    yield ' end alt text}'
+
+
+def _table_columns(table):
+    # Number of columns in the column specification at the start of the
+    # table, and the index after it
+    index = 0
+    if table.startswith('['):
+        index = table.find(']') + 1
+    if not table.startswith('{', index):
+        return 0, 0
+    spec, body_start = next_bracket(table, index)
+    return _count_columns(spec[1:-1]), body_start
+
+
+def _count_columns(spec):
+    columns = 0
+    index = 0
+    while index < len(spec):
+        char = spec[index]
+        index += 1
+        if char in 'lcr':
+            columns += 1
+        elif char in 'pmb':
+            columns += 1
+            if spec.startswith('{', index):
+                index = next_bracket(spec, index)[1]
+        elif char in '@!<>':
+            if spec.startswith('{', index):
+                index = next_bracket(spec, index)[1]
+        elif char == '*' and spec.startswith('{', index):
+            # e.g. '*{3}{c}' for three centred columns
+            count, index = next_bracket(spec, index)
+            repeated = ''
+            if spec.startswith('{', index):
+                repeated, index = next_bracket(spec, index)
+            try:
+                columns += int(count[1:-1]) * _count_columns(repeated[1:-1])
+            except ValueError:
+                pass
+    return columns
+
+
+def _table_rows(table, start):
+    # Cells of each row of the table body, without rules and blank lines
+    cells = []
+    pieces = []
+    for match in TABLE_TOKENS.finditer(table, start):
+        kind = match.lastgroup
+        if kind == 'ESCAPED':
             continue
-        except AttributeError:
+        pieces.append(table[start:match.start()])
+        start = match.end()
+        if kind == 'RULE':
+            # A row starts after the rules before it
+            if cells == [] and ''.join(pieces).strip() == '':
+                pieces = []
             continue
+        cells.append(''.join(pieces))
+        pieces = []
+        if kind == 'ROW_END':
+            cells[0] = _row_start(cells[0])
+            yield cells
+            cells = []
+    pieces.append(table[start:])
+    # A last row without '\\' ends at the last text in the table
+    cells.append(''.join(pieces).rstrip())
+    if ''.join(cells).strip() != '':
+        cells[0] = _row_start(cells[0])
+        yield cells
+
+
+def _check_row(cells, columns):
+    # Rows that are read as they are written, but whose alt text may not
+    # match how the table looks
+    if ''.join(cells).strip() == '':
+        diagnostic('table row', 'empty row')
+    elif columns > 0 and len(cells) != columns:
+        diagnostic('table row', 'row of %d cells in a table of %d columns'
+                   % (len(cells), columns))
+
+
+def _row_start(cell):
+    # The first cell of a row starts after the blank line before it (each
+    # line of the document is followed by a blank line, see 'begin_doc')
+    content = len(cell) - len(cell.lstrip())
+    blank_line = cell.find('\n\n', 0, content)
+    if blank_line < 0:
+        return cell
+    return cell[blank_line + 2:]
+
+
+def _table_batch(batch, first, delimiters, symbols, special_symbols, cache):
+    # Alt text of a batch of rows, converting each distinct equation in the
+    # batch once. The diagnostics of an equation are recorded each time it
+    # is found, as if each were converted
+    convert = eqn_tokenise if cache is None else cache.eqn_tokenise
+    reporting = _reports.diagnostics is not None
+    found = []
+    alt_equations = {}
+    recorded = {}
+    for cells in batch:
+        for cell in cells:
+            spans = [span for span in math_spans(cell, delimiters)
+                     if span.body_end > span.body_start]
+            for span in spans:
+                equation = cell[span.body_start:span.body_end]
+                if equation in alt_equations:
+                    if reporting:
+                        replay(recorded[equation])
+                elif reporting:
+                    with recording() as recorded[equation]:
+                        alt_equations[equation] = convert(
+                            equation, symbols, special_symbols)
+                else:
+                    alt_equations[equation] = convert(equation, symbols,
+                                                      special_symbols)
+            found.append(spans)
+    found = iter(found)
+    for cells in batch:
+        if not first:
+            yield 'next row'
+        first = False
+        for i, cell in enumerate(cells):
+            if i > 0:
+                yield ' and '
+            last = 0
+            for span in next(found):
+                yield cell[last:span.start]
+                yield alt_equations[cell[span.body_start:span.body_end]]
+                last = span.end
+            yield cell[last:]
+
+
+class TokenStream:
+    '''
+    Class to hold the tokens of a string compactly, as arrays of the kind
+    code and the start and end index of each token, which refer back to the
+    string rather than copying each token out of it. A 'Token' is only made
+    when a token is looked up, e.g.
+        stream = doc_token_stream(latex_doc)
+        for i in stream.indices('EQN_1', 'EQN_2'):
+            print(stream[i].value)
 
-        alt_text.append(eqn[:and_indices[0]])
-        for j in range(1, len(and_indices)):
-            if and_indices[j - 1] < and_indices[j]:
-                alt_text.append(' and ')
-                tab_entry = eqn[and_indices[j-1]+1:and_indices[j]]
-                alt_text.append(tab_entry)
-        alt_text.append(' and ')
-        alt_text.append(eqn[and_indices[-1]+1:line_end])
-        alt_text.append('next row')
-
-    incl_delims = [r'(\$\$(.*?)\$\$)', r'(\$(.*?)\$)', r'(\\\((.*?)\\\))',
-                   r'(\\\[(.*?)\\\])', r'(\\begin\{math\}(.*?)\\end\{math\})']
-
-    alt_tab = []
-    for element in alt_text:
-        tab_eqn = find_equations(element, delimiters)
-        if tab_eqn is not None:
-            tab_eqn_delim = find_equations(element, incl_delims)[0]
-            alt_eqn = (eqn_tokenise(tab_eqn, symbols, converted_symbols,
-                                    special_symbols))
-            alt_tab.append(element.replace(tab_eqn_delim, alt_eqn))
-        else:
-            alt_tab.append(element)
-    if alt_tab[-1] == 'next row':
-        alt_tab = alt_tab[:-1]
-    alt_tab.append(' end alt text}')
-    return alt_tab
+    Attributes:
+        text (str) : String the tokens were found in
+        kinds (tuple) : Name of each kind of token, indexed by its code
+        codes (array) : Kind code of each token
+        starts (array) : Start index of each token in 'text'
+        ends (array) : End index of each token in 'text'
+    '''
 
+    def __init__(self, text, kinds, codes, starts, ends):
+        '''
+        Parameters:
+            text (str) : String the tokens were found in
+            kinds (tuple) : Name of each kind of token, indexed by its code
+            codes (array) : Kind code of each token
+            starts (array) : Start index of each token in 'text'
+            ends (array) : End index of each token in 'text'
+        '''
+        self.text = text
+        self.kinds = kinds
+        self.codes = codes
+        self.starts = starts
+        self.ends = ends
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, i):
+        start = self.starts[i]
+        end = self.ends[i]
+        return Token(self.kinds[self.codes[i]], self.text[start:end], start,
+                     end)
+
+    def __iter__(self):
+        for i in range(len(self.codes)):
+            yield self[i]
+
+    def kind(self, i):
+        '''
+        Function to find the kind of a token, without making a 'Token'
+
+        Parameters:
+            i (int) : Position of the token in the stream
+
+        Returns:
+            kind (str) : Kind of the token, e.g. 'EQN_2'
+        '''
+        return self.kinds[self.codes[i]]
+
+    def value(self, i):
+        '''
+        Function to find the text of a token, without making a 'Token'
+
+        Parameters:
+            i (int) : Position of the token in the stream
+
+        Returns:
+            value (str) : Substring of 'text' matched by the token
+        '''
+        return self.text[self.starts[i]:self.ends[i]]
+
+    def indices(self, *kinds):
+        '''
+        Function to find the tokens of the given kinds
+
+        Parameters:
+            kinds (str) : Kinds of token to find, e.g. 'EQN_1'
+
+        Returns:
+            indices (list) : Positions of the tokens in the stream, in order
+        '''
+        wanted = {self.kinds.index(kind) for kind in kinds}
+        return [i for i, code in enumerate(self.codes) if code in wanted]
+
+    def position(self, index):
+        '''
+        Function to find the first token at or after an index of 'text', so
+        that a parser can jump over part of the text without scanning it
+        again
+
+        Parameters:
+            index (int) : Index of 'text'
+
+        Returns:
+            i (int) : Position in the stream of the first token starting at
+                or after 'index' (the length of the stream if there is none)
+        '''
+        return bisect_left(self.starts, index)
+
+
+def doc_token_stream(latex_doc):
+    '''
+    Function to find every token of a LaTeX document (see
+    'DOC_TOKEN_SPECIFICATION'), including those within the tables that
+    'iter_tokenise' jumps over
+
+    Parameters:
+        latex_doc (str) : LaTeX document (all as a single string)
 
-def eqn_tokenise(equation, symbols, converted_symbols, special_symbols):
+    Returns:
+        stream (TokenStream) : Tokens of 'latex_doc'
+    '''
+    return _token_stream(latex_doc, DOC_TOKENS, DOC_TOKEN_SPECIFICATION)
+
+
+def eqn_token_stream(equation):
+    '''
+    Function to find every token of an equation (see
+    'EQN_TOKEN_SPECIFICATION'), including those within the fractions that
+    'eqn_tokenise' jumps over
+
+    Parameters:
+        equation (str) : Equation within math text
+
+    Returns:
+        stream (TokenStream) : Tokens of 'equation' (newlines, which match
+            no kind of token, are left out)
+    '''
+    return _token_stream(equation, EQN_TOKENS, EQN_TOKEN_SPECIFICATION)
+
+
+def _token_stream(text, scanner, specification):
+    # The outer group of each kind closes last, so 'lastindex' is the group
+    # of the kind of token that matched
+    kinds = tuple(name for name, _ in specification)
+    group_codes = [0] * (scanner.groups + 1)
+    for code, name in enumerate(kinds):
+        group_codes[scanner.groupindex[name]] = code
+    codes = array('B')
+    starts = array('I')
+    ends = array('I')
+    add_code = codes.append
+    add_start = starts.append
+    add_end = ends.append
+    for match in scanner.finditer(text):
+        add_code(group_codes[match.lastindex])
+        start, end = match.span()
+        add_start(start)
+        add_end(end)
+    return TokenStream(text, kinds, codes, starts, ends)
+
+
+def eqn_tokenise(equation, symbols, special_symbols):
     '''
     Function to tokenise an equation within the LaTeX document
 
     Parameters:
         equation (str) : Equation within math text
-        symbols (list) : List of LaTeX symbols in csv file
-        converted_symbols (list) : List of alt text versions of 'symbols'
+        symbols (SymbolTable) : Table of LaTeX symbols in csv file with their
+            alt text
         special_symbols (dict) : Dictionary of math symbols to be replaced
 
     Returns:
@@ -499,35 +1541,26 @@ def eqn_tokenise(equation, symbols, converted_symbols, special_symbols):
     track_commands = ['']
     track_symbols = ['']
     track_environ = ['']
-    duplicates = []
-    token_specification = [
-        ('NUMBER',       r'\d+(\.\d*)?'),          # Integer or decimal
-        ('ID',           r'[A-Za-z]+'),            # Words
-        ('SYMBOL',       r'[_/\^/>/</\-///!/\|]'), # Special symbols
-        ('OPEN_BRAC',    r'\\{'),                  # Curly bracket command
-        ('CLOSE_BRAC',   r'\\}'),                  # Curly bracket command
-        ('COLON',        r'\\:'),                  # Colon command
-        ('BRACKET',      r'[\(/\)/\[/\]]'),        # Parentheses
-        ('FRACTION',     r'\\frac'),               # \\frac
-        ('DFRACTION',    r'\\dfrac'),              # \\dfrac
-        ('BRACE',        r'\{(.*?\})'),            # Curly brackets
-        ('AND',          r'\&'),                   # And
-        ('NEWLINE',      r'\\\\'),                 # Newline
-        ('COMMAND',      r'\\'),                   # Command statement
-        ('MISMATCH',     r'.'),                    # Any other character
-    ]
-    tok_regex = '|'.join('(?P<%s>%s)' % pair for pair in token_specification)
-    for match in re.finditer(tok_regex, equation):
+    braces = match_braces(equation)
+    # Scanning resumes at 'cursor', so text already converted along with an
+    # earlier token (e.g. the arguments of a fraction) is jumped over
+    cursor = 0
+    while True:
+        checkpoint()
+        match = EQN_TOKENS.search(equation, cursor)
+        if match is None:
+            break
         kind = match.lastgroup
         value = match.group()
         index = match.start()
-        end_index = index + len(value)
-        if len(duplicates) > 0 and index in duplicates[-1]:
-            continue
+        end_index = cursor = match.end()
         if kind == 'NUMBER':
             alt_equation.append(str(value))
         elif kind == 'ID':
-            if value in symbols and value == track_commands[-1]:
+            # The name of a command not in the csv file is written by the
+            # 'COMMAND' token before it
+            if value == track_commands[-1] and (
+                    value in symbols or equation[index - 1] == '\\'):
                 continue
             if equation[index - 1] == '^' and len(value) > 1:
                 for letter in value:
@@ -545,7 +1578,7 @@ def eqn_tokenise(equation, symbols, converted_symbols, special_symbols):
                 continue
             alt_equation.append(convert_symbols(equation, index, value,
                                                 track_commands,
-                                                special_symbols)[0])
+                                                special_symbols, braces)[0])
         elif kind == 'OPEN_BRAC':
             alt_equation.append(value)
         elif kind == 'CLOSE_BRAC':
@@ -556,14 +1589,12 @@ def eqn_tokenise(equation, symbols, converted_symbols, special_symbols):
             alt_equation.append(value)
         elif kind in ('FRACTION', 'DFRACTION'):
             track_commands.append('frac')
-            first_brac = next_bracket(equation, end_index)
-            second_brac = next_bracket(equation, first_brac[1])
+            first_brac = next_bracket(equation, end_index, braces)
+            second_brac = next_bracket(equation, first_brac[1], braces)
             list_first = nested_brackets(first_brac[0], track_commands,
-                                         symbols, converted_symbols,
-                                         special_symbols)
+                                         symbols, special_symbols)
             list_second = nested_brackets(second_brac[0], track_commands,
-                                          symbols, converted_symbols,
-                                          special_symbols)
+                                          symbols, special_symbols)
             alt_first = ''.join(list_first)
             alt_second = ''.join(list_second)
             if len(alt_first) < 3 and len(alt_second) < 3:
@@ -573,7 +1604,7 @@ def eqn_tokenise(equation, symbols, converted_symbols, special_symbols):
                 alt_equation.append(' fraction with numerator ' + alt_first +
                                     ' and denominator ' + alt_second +
                                     ' end fraction ')
-            duplicates.append(list(range(end_index, second_brac[1])))
+            cursor = second_brac[1]
         elif kind == 'BRACE':
             if track_commands[-1] == 'label' or track_commands[-1] == 'hspace':
                 continue
@@ -585,26 +1616,22 @@ def eqn_tokenise(equation, symbols, converted_symbols, special_symbols):
                     continue
                 track_environ.append('array')
                 alt_equation.append(' Begin array environment. ')
-                eqn_index = next_bracket(equation, end_index)[1] - 1
-                duplicates.append(list(range(end_index, eqn_index)))
+                # Skips the column specification, e.g. '{cc}'
+                cursor = next_bracket(equation, end_index, braces)[1]
                 continue
             if (equation[index - 1] == '^' or equation[index - 1] == '_' or
                     track_commands[-1] == 'sqrt'):
                 alt_equation.append('(')
             arg = re.findall(r'\{(.*?)\}', value)[0]
             if '{' in arg:
-                complete_brac = next_bracket(equation, index)
+                complete_brac = next_bracket(equation, index, braces)
                 alt_equation.append(nested_brackets(complete_brac[0],
                                                     track_commands, symbols,
-                                                    converted_symbols,
                                                     special_symbols))
-                duplicates.append(list(range(end_index, complete_brac[1])))
+                cursor = complete_brac[1]
             else:
-                commands = find_commands(arg)
-                if commands != []:
-                    convert = convert_commands(
-                        commands, symbols, converted_symbols)
-                    alt = multi_replace(arg, convert)
+                if '\\' in arg:
+                    alt = command_substituter(symbols).substitute(arg)[0]
                     if ('dot' in track_commands[-1] or
                             'ddot' in track_commands[-1] or
                             'hat' in track_commands[-1]):
@@ -636,117 +1663,394 @@ def eqn_tokenise(equation, symbols, converted_symbols, special_symbols):
                 command = find_commands(equation[index:])[0]
             except IndexError:
                 continue
+            if command not in symbols:
+                known = _known_start(command, symbols)
+                if known is not None:
+                    # The rest of the name is read as the text after it
+                    command = known
+                    cursor = index + 1 + len(command)
             track_commands.append(command)
             if command in ('left', 'right', 'rm', 'label', 'begin', 'end',
                            'text', 'nonumber', ',', 'quad'):
                 continue
             if command == 'prime' and track_symbols[-1] == '^':
                 alt_equation = alt_equation[:-1]
-            converted = convert_commands(command, symbols, converted_symbols)
+            converted = convert_commands(command, symbols)
             alt_equation.append(multi_replace(command, converted))
         elif kind == 'MISMATCH':
             if value in track_commands[-1]:
                 continue
             alt_equation.append(value)
-#        yield Token(kind, value, index, end_index)
     alt_equation = ' '.join(flatten(alt_equation))
     return alt_equation
 
 
-altex = []
-def tokenise(latex_doc, delimiters, symbols, converted_symbols,
-             special_symbols):
+def tokenise(latex_doc, delimiters, symbols, special_symbols, cache=None,
+             budget=None):
     '''
     Function to tokenise the LaTeX document
 
     Parameters:
         latex_doc (str) : LaTeX document (all as a single string)
         delimiters (list) : Math text characters to search between
-        symbols (list) : List of LaTeX symbols in csv file
-        converted_symbols (list) : List of alt text versions of 'symbols'
+        symbols (SymbolTable) : Table of LaTeX symbols in csv file with their
+            alt text
         special_symbols (dict) : Dictionary of math symbols to be replaced
+        cache (EquationCache) : Cache of the alt text of equations (None
+            to convert every equation)
+
+        budget (Budget) : Limits on the time and size of each equation and
+            table (None for no limits, see 'alttex_budget')
 
     Returns:
-        altex_doc (str) : Alt text verions of 'latex_doc'
-    '''
-    duplicates = []
-    token_specification = [
-        ('NUMBER',     r'\d+(\.\d*)?'),           # Integer or decimal number
-        ('NEWLINE',    r'\n'),                    # Newline
-        ('SKIP',       r'[ \t]+'),                # Skip over spaces and tabs
-        ('ID',         r'[A-Za-z]+'),             # Words
-        ('EQN_1',      r'\$\$(.*?)\$\$'),         # EQN_1-EQN_5 = delimiters
-        ('EQN_2',      r'\$(.*?)\$'),
-        ('EQN_3',      r'\\begin\{math\}(.*?)\\end\{math\}'),
-        ('EQN_4',      r'\\\((.*?)\\\)'),
-        ('EQN_5',      r'\\\[(.*?)\\\]'),
-        ('EQN_6',      r'\\begin\{equation\}'),   # Begin{equation}
-        ('END_EQN',    r'\\end\{equation\}'),     # End{equation}
-        ('EQN_7',      r'\\begin\{align\}'),      # Begin{align}
-        ('END_ALIGN',  r'\\end\{align\}'),        # End{align}
-        ('BEGIN_TAB',  r'\\begin{tabular}'),      # Begin{tabular}
-        ('END_TAB',    r'\\end{tabular}'),        # End{tabular}
-        ('MISMATCH',   r'.'),                     # Any other character
-    ]
-    tok_regex = '|'.join('(?P<%s>%s)' % pair for pair in token_specification)
-    for match in re.finditer(tok_regex, latex_doc):
+        altex_doc (str) : Alt text verions of 'latex_doc', with the macros
+            defined in its preamble expanded within its equations
+    '''
+    cache = _with_macros(latex_doc, cache)
+    return ''.join(iter_tokenise(latex_doc, delimiters, symbols,
+                                 special_symbols, cache, budget))
+
+
+def iter_tokenise(latex_doc, delimiters, symbols, special_symbols,
+                  cache=None, budget=None):
+    '''
+    Function to tokenise the LaTeX document, yielding its alt text version
+    in fragments
+
+    Parameters:
+        latex_doc (str) : LaTeX document (all as a single string)
+        delimiters (list) : Math text characters to search between
+        symbols (SymbolTable) : Table of LaTeX symbols in csv file with their
+            alt text
+        special_symbols (dict) : Dictionary of math symbols to be replaced
+        cache (EquationCache) : Cache of the alt text of equations (None
+            to convert every equation)
+
+        budget (Budget) : Limits on the time and size of each equation and
+            table (None for no limits, see 'alttex_budget')
+
+    Yields:
+        fragment (str) : Next part of the alt text version of 'latex_doc'
+    '''
+    if budget is not None:
+        # Equations over budget are given a fallback note, including those
+        # within tables
+        cache = budget.limit(cache)
+    convert = eqn_tokenise if cache is None else cache.eqn_tokenise
+    reporting = _reports.diagnostics is not None
+    if reporting:
+        _reports.span = latex_doc
+    # The math text is indexed up front, so that the equation within each
+    # delimited token is known without searching the token again
+    spans = {span.start: span for span in math_spans(latex_doc, delimiters)}
+    # Alt text of the environments that have begun, until their end
+    pending = {}
+    # Scanning resumes at 'cursor', so the body of a table (which is
+    # converted as a whole by 'tabular') is jumped over
+    cursor = 0
+    while True:
+        match = DOC_TOKENS.search(latex_doc, cursor)
+        if match is None:
+            break
         kind = match.lastgroup
         value = match.group()
         index = match.start()
-        end_index = index + len(value)
-        if len(duplicates) > 0 and index in duplicates[-1]:
-            continue
+        end_index = cursor = match.end()
         if kind in ('NUMBER', 'NEWLINE', 'SKIP', 'ID'):
-            altex.append(value)
+            yield value
         elif kind in ('EQN_1', 'EQN_2', 'EQN_3', 'EQN_4', 'EQN_5'):
-            equation = find_equations(value, delimiters)
-            if bool(re.match('^[0-9]+$', equation)) is True:
-                altex.append(value)
+            span = spans.get(index)
+            if span is not None and span.end == end_index:
+                equation = latex_doc[span.body_start:span.body_end]
+            else:
+                # e.g. within an equation environment, which the index
+                # takes as a whole
+                equation = find_equations(value, delimiters)
+            if (equation is None or equation == '' or
+                    bool(re.match('^[0-9]+$', equation)) is True):
+                yield value
+            else:
+                if reporting:
+                    _reports.offset = index
+                    _reports.equation = (index + max(value.find(equation),
+                                                     0), equation)
+                alt_text = convert(equation, symbols, special_symbols)
+                _reports.equation = None
+                yield value
+                yield ('\\todo[inline]{begin alt text ' + alt_text +
+                       ' end alt text}')
+        elif kind == 'BEGIN_ENV':
+            name = match.group(match.lastindex + 1)
+            environ = ENVIRONMENT_KINDS.get(name)
+            # The end is found from this index on, without copying the rest
+            # of the document
+            end_environ = latex_doc.find('\\end{' + name + '}', end_index)
+            if reporting and environ is not None:
+                _reports.offset = index
+                if end_environ < 0:
+                    diagnostic('unmatched delimiter', value)
+            if environ is None or end_environ < 0:
+                yield value
+            elif environ == 'table':
+                table = latex_doc[end_index:end_environ]
+                if budget is None:
+                    pending[name] = iter_tabular(table, delimiters, symbols,
+                                                 special_symbols, cache)
+                    if reporting:
+                        # The table is only converted once its end is
+                        # reached
+                        pending[name] = _reported_at(index, pending[name])
+                else:
+                    pending[name] = budget.tabular(table, delimiters,
+                                                   symbols, special_symbols,
+                                                   cache)
+                yield latex_doc[index:end_environ]
+                cursor = end_environ
             else:
-                alt_text = eqn_tokenise(equation, symbols, converted_symbols,
-                                        special_symbols)
-                altex.append(value)
-                altex.append('\\todo[inline]{begin alt text ' + alt_text +
-                             ' end alt text}')
-        elif kind == 'EQN_6':
-            end_equation = re.search(r'\\end{equation}', latex_doc[index:])
-            end_index = end_equation.span()[1] + index
-            equation = re.findall(
-                r'(?s)\\begin\{equation\}(.*)\\end\{equation\}',
-                latex_doc[index:end_index])[0]
-            alt_text = eqn_tokenise(equation, symbols, converted_symbols,
-                                    special_symbols)
-            altex.append(value + '\n')
-        elif kind == 'END_EQN':
-            altex.append(value)
-            altex.append('\\todo[inline]{begin alt text ' + alt_text +
-                         ' end alt text}')
-        elif kind == 'EQN_7':
-            end_equation = re.search(r'\\end{align}', latex_doc[index:])
-            end_index = end_equation.span()[1] + index
-            equation = re.findall(
-                r'(?s)\\begin\{align\}(.*)\\end\{align\}',
-                latex_doc[index:end_index])[0]
-            alt_text = eqn_tokenise(equation, symbols, converted_symbols,
-                                    special_symbols)
-            altex.append(value)
-        elif kind == 'END_ALIGN':
-            altex.append(value)
-            altex.append('\\todo[inline]{begin alt text ' + alt_text +
-                         ' end alt text}')
-        elif kind == 'BEGIN_TAB':
-            end_tab_span = (re.search(r'\\end{tabular}',
-                                      latex_doc[end_index:]).span())
-            end_tab = (end_tab_span[0] + end_index)
-            alt_table = tabular(latex_doc[end_index:end_tab], delimiters,
-                                symbols, converted_symbols, special_symbols)
-            altex.append(latex_doc[index:end_tab_span[0] + end_index])
-            duplicates.append(list(range(index, end_tab_span[0] + end_index)))
-        elif kind == 'END_TAB':
-            altex.append(value)
-            altex.append(alt_table)
+                equation = latex_doc[end_index:end_environ]
+                if reporting:
+                    _reports.equation = (end_index, equation)
+                pending[name] = convert(equation, symbols, special_symbols)
+                _reports.equation = None
+                # '\begin{equation}' has always had a newline of its own
+                yield value + '\n' if name == 'equation' else value
+        elif kind == 'END_ENV':
+            name = match.group(match.lastindex + 1)
+            yield value
+            alt_environ = pending.pop(name, None)
+            if alt_environ is None:
+                if reporting and name in ENVIRONMENT_KINDS:
+                    _reports.offset = index
+                    diagnostic('unmatched delimiter', value)
+            elif ENVIRONMENT_KINDS.get(name) == 'table':
+                yield from alt_environ
+            else:
+                yield ('\\todo[inline]{begin alt text ' + alt_environ +
+                       ' end alt text}')
         elif kind == 'MISMATCH':
-            altex.append(value)
-#        yield Token(kind, value, index, end_index)
-    altex_doc = ''.join(flatten(altex))
-    return altex_doc
+            if reporting and value in '$\\':
+                _check_delimiter(latex_doc, index)
+            yield value
+
+
+def _check_delimiter(latex_doc, index):
+    # A '$', '\\(' or '\\[' left by the delimited tokens has no match on its
+    # line (a '\\$' or '\\\\[...]' is not a delimiter)
+    if index > 0 and latex_doc[index - 1] == '\\':
+        return
+    if latex_doc[index] == '$':
+        delimiter = '$'
+    elif latex_doc.startswith(('\\(', '\\['), index):
+        delimiter = latex_doc[index:index + 2]
+    else:
+        return
+    _reports.offset = index
+    diagnostic('unmatched delimiter', delimiter)
+
+
+def _reported_at(offset, fragments):
+    # Diagnostics found while 'fragments' are made are recorded at 'offset'
+    # of the span
+    _reports.offset = offset
+    yield from fragments
+
+
+def _doc_lines(latex_file):
+    # Lines of the document joined as in 'begin_doc', counted for the line
+    # of each diagnostic
+    previous = None
+    for line in latex_file:
+        _reports.lines_read += 1
+        if previous is not None:
+            yield previous + '\n'
+        previous = line
+    if previous is not None:
+        yield previous
+
+
+def stream_tokenise(latex_file, delimiters, symbols, special_symbols,
+                    cache=None, index=None, budget=None):
+    '''
+    Function to tokenise a LaTeX document as it is read, so that only the
+    current line (or the current equation or table environment) is held in
+    memory
+
+    The macros defined in the preamble (see 'alttex_macros') are expanded
+    within every equation of the document before it is converted.
+
+    Parameters:
+        latex_file (file) : LaTeX document opened for reading (or any
+            iterable of its lines)
+        delimiters (list) : Math text characters to search between
+        symbols (SymbolTable) : Table of LaTeX symbols in csv file with their
+            alt text
+        special_symbols (dict) : Dictionary of math symbols to be replaced
+        cache (EquationCache) : Cache of the alt text of equations (None
+            to convert every equation)
+        index (SpanIndex) : Alt text of the parts of the document from the
+            last run, so that only edited parts are converted (None to
+            convert the whole document). The diagnostics of each part are
+            kept with its alt text, and recorded again when it is reused
+        budget (Budget) : Limits on the time and size of each equation and
+            table (None for no limits, see 'alttex_budget')
+
+    Yields:
+        fragment (str) : Next part of the alt text version of the document,
+            including the todo package statement from 'begin_doc'
+    '''
+    reporting = _reports.diagnostics is not None
+    if reporting:
+        _reports.file = getattr(latex_file, 'name', None)
+        _reports.lines_read = 0
+    first = True
+    for span in _doc_spans(latex_file):
+        if first:
+            # The preamble is within the first span
+            cache = _with_macros(span, cache, index)
+            first = False
+        if reporting:
+            # Set here too, as a reused part is not passed to 'iter_tokenise'
+            _reports.span = _reports.stream_span = span
+        if index is None:
+            yield from iter_tokenise(span, delimiters, symbols,
+                                     special_symbols, cache, budget)
+            continue
+        alt_span, found = index.find(span)
+        reused = alt_span is not None
+        keep = True
+        if reused:
+            replay(found, offsets=True)
+        else:
+            fallbacks = 0 if budget is None else len(budget.diagnostics)
+            with recording() as found:
+                alt_span = ''.join(iter_tokenise(
+                    span, delimiters, symbols, special_symbols, cache,
+                    budget))
+            # A part given a fallback note is converted again on the next
+            # run, which may have a larger budget (or none)
+            keep = budget is None or len(budget.diagnostics) == fallbacks
+        index.add(span, alt_span, reused, found, keep)
+        yield alt_span
+
+
+def _with_macros(latex_doc, cache, index=None):
+    # Stand-in for the cache expanding the macros defined before
+    # '\\begin{document}' (the cache itself if none are defined). The alt
+    # text in the index then depends on the macros too
+    end = latex_doc.find('\\begin{document}')
+    if end < 0:
+        return cache
+    preamble = latex_doc[:end]
+    # Each definition has '\\def' or 'command' in it, so 'alttex_macros'
+    # is only imported for a document that may define macros
+    if '\\def' not in preamble and 'command' not in preamble:
+        return cache
+    from alttex_macros import read_macros
+    macros = read_macros(preamble)
+    if len(macros) == 0:
+        return cache
+    if index is not None:
+        index.context = macros.fingerprint
+    return _MacroCache(macros, cache)
+
+
+class _MacroCache:
+    # Stands in for the equation cache, expanding the macros of the document
+    # within each equation before it is converted
+    def __init__(self, macros, cache):
+        from alttex_macros import MacroError
+        self.macros = macros
+        self.cache = cache
+        self.macro_error = MacroError
+
+    def eqn_tokenise(self, equation, symbols, special_symbols):
+        try:
+            equation = self.macros.expand(equation)
+        except self.macro_error as error:
+            # Converted as it is written
+            diagnostic('macro', str(error))
+        if self.cache is not None:
+            return self.cache.eqn_tokenise(equation, symbols, special_symbols)
+        return eqn_tokenise(equation, symbols, special_symbols)
+
+
+def _doc_spans(latex_file):
+    # Parts of the document that can be tokenised separately: single lines,
+    # or whole equation and table environments with the lines around them
+    lines = _doc_lines(latex_file)
+    # The todo package is only searched for before '\\begin{document}'
+    preamble = []
+    for line in lines:
+        preamble.append(line)
+        if re.search(r'\\begin\{document\}', line) is not None:
+            break
+    else:
+        raise ValueError('No \\begin{document} in the LaTeX document')
+    pending = [begin_doc([''.join(preamble)])]
+    open_environ = _open_environ(pending[0], None)
+    for line in lines:
+        pending.append(line)
+        open_environ = _open_environ(line, open_environ)
+        if open_environ is None:
+            yield ''.join(pending)
+            pending = []
+    if pending != []:
+        yield ''.join(pending)
+
+
+def _open_environ(text, open_environ):
+    # Name of the equation or table environment left open at the end of
+    # 'text', as the document can only be split outside of them
+    for match in ENVIRONMENTS.finditer(text):
+        if match.group(2) not in ENVIRONMENT_KINDS:
+            continue
+        if open_environ is None and match.group(1) == 'begin':
+            open_environ = match.group(2)
+        elif match.group(1) == 'end' and match.group(2) == open_environ:
+            open_environ = None
+    return open_environ
+
+
+def write_altex(fragments, altex_file, buffer_size=WRITE_BUFFER_SIZE):
+    '''
+    Function to write the alt text version of a document line by line,
+    leaving out blank lines and joining lines that start with '\\\\' onto
+    the next line
+
+    The fragments are read once, as they are made, and the lines are written
+    in batches of about 'buffer_size' characters, so the alt text is never
+    held in memory as a whole.
+
+    Parameters:
+        fragments (iterable) : Parts of the alt text version of the document
+            (e.g. from 'stream_tokenise')
+        altex_file (file) : File opened for writing (e.g. 'sys.stdout')
+        buffer_size (int) : Characters gathered before each write
+    '''
+    line = []
+    pending = []
+    size = 0
+    for fragment in fragments:
+        if '\n' not in fragment:
+            line.append(fragment)
+            continue
+        parts = fragment.split('\n')
+        line.append(parts[0])
+        parts[0] = ''.join(line)
+        for part in parts[:-1]:
+            if part != '':
+                pending.append(part)
+                size += len(part)
+                if not part.startswith('\\\\'):
+                    pending.append('\n')
+        line = [parts[-1]]
+        if size >= buffer_size:
+            altex_file.write(''.join(pending))
+            pending = []
+            size = 0
+    last = ''.join(line)
+    if last != '':
+        pending.append(last)
+        if not last.startswith('\\\\'):
+            pending.append('\n')
+    altex_file.write(''.join(pending))
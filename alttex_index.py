@@ -0,0 +1,184 @@
+'''
+alttex_index
+
+Keeps a sidecar index of the parts of a document converted on the last run,
+so that only the parts that have been edited since are converted again.
+
+Classes:
+    SpanIndex
+
+Functions:
+    index_path
+'''
+
+import hashlib
+import json
+import os
+from alttex_symbols import CACHE_DIR_NAME
+
+INDEX_VERSION = 6
+
+
+def index_path(document_path):
+    '''
+    Function to find where the index of a document is kept
+
+    Parameters:
+        document_path (str) : Path to the LaTeX document
+
+    Returns:
+        path (str) : Path in the '.alttex_cache' folder next to the document,
+            e.g. 'notes/week1.tex' gives
+            'notes/.alttex_cache/week1.tex.index.json'
+    '''
+    directory, name = os.path.split(os.path.abspath(document_path))
+    return os.path.join(directory, CACHE_DIR_NAME, name + '.index.json')
+
+
+class SpanIndex:
+    '''
+    Class to look up the alt text of each part of a document (a line, or an
+    equation or table environment with the lines around it) by the hash of
+    its LaTeX
+
+    Attributes:
+        path (str) : Path to the index file
+        fingerprint (str) : Hash of the settings the alt text was made with
+        reused (int) : Number of parts found in the index on this run
+        converted (int) : Number of parts converted on this run
+        context (str) : Fingerprint of anything else the alt text of each
+            part depends on, e.g. the macros defined in the preamble of the
+            document (see 'stream_tokenise'), which is part of its key
+    '''
+
+    def __init__(self, path, symbols, delimiters, special_symbols,
+                 engine='tokenise'):
+        '''
+        Parameters:
+            path (str) : Path to the index file (see 'index_path'), which is
+                read if it exists and was made with the same settings
+            symbols (SymbolTable) : Table of LaTeX symbols in csv file with
+                their alt text
+            delimiters (list) : Math text characters to search between
+            special_symbols (dict) : Dictionary of math symbols to be
+                replaced
+            engine (str) : Engine converting the equations (see
+                'AltTexConverter')
+        '''
+        self.path = path
+        # Compiled delimiters are compared by their patterns
+        delimiters = [getattr(delimiter, 'pattern', delimiter)
+                      for delimiter in delimiters]
+        self.fingerprint = hashlib.sha256(repr(
+            (symbols.fingerprint, delimiters, sorted(special_symbols.items()),
+             engine)).encode('utf8')).hexdigest()
+        self.reused = 0
+        self.converted = 0
+        self.context = ''
+        previous = _read_index(path, self.fingerprint)
+        self._previous = previous.get('spans', {})
+        self._previous_found = previous.get('diagnostics', {})
+        self._current = {}
+        self._current_found = {}
+
+    def get(self, span):
+        '''
+        Function to find the alt text of a part of the document from the last
+        run
+
+        Parameters:
+            span (str) : Part of the LaTeX document
+
+        Returns:
+            alt_span (str) : Alt text version of 'span' (None if 'span' has
+                been edited since the last run)
+        '''
+        return self.find(span)[0]
+
+    def find(self, span):
+        '''
+        Function to find the alt text of a part of the document from the last
+        run, with the diagnostics found when it was made
+
+        Parameters:
+            span (str) : Part of the LaTeX document
+
+        Returns:
+            alt_span (str) : Alt text version of 'span' (None if 'span' has
+                been edited since the last run)
+            found (list) : Kind, item and offset within 'span' of each
+                diagnostic (see 'recording')
+        '''
+        key = _span_key(self.context + span)
+        if key not in self._previous:
+            return None, []
+        alt_span = self._previous[key]
+        found = self._previous_found.get(key, [])
+        # Parts without math text are stored as None to keep the index small
+        return span if alt_span is None else alt_span, found
+
+    def add(self, span, alt_span, reused=False, found=(), keep=True):
+        '''
+        Function to record the alt text of a part of the document for the
+        next run
+
+        Parameters:
+            span (str) : Part of the LaTeX document
+            alt_span (str) : Alt text version of 'span'
+            reused (bool) : Whether 'alt_span' was found with 'get' or 'find'
+            found (list) : Kind, item and offset within 'span' of each
+                diagnostic found when 'alt_span' was made
+            keep (bool) : Whether 'alt_span' is kept for the next run (e.g.
+                not if it has a fallback note from a budget)
+        '''
+        if keep:
+            key = _span_key(self.context + span)
+            self._current[key] = None if alt_span == span else alt_span
+            if len(found) > 0:
+                self._current_found[key] = found
+        if reused:
+            self.reused += 1
+        else:
+            self.converted += 1
+
+    def save(self):
+        '''
+        Function to write the index, keeping only the parts added on this run
+        '''
+        _write_index(self.path, {'version': INDEX_VERSION,
+                                 'fingerprint': self.fingerprint,
+                                 'spans': self._current,
+                                 'diagnostics': self._current_found})
+
+
+def _span_key(span):
+    return hashlib.blake2b(span.encode('utf8'), digest_size=16).hexdigest()
+
+
+def _read_index(path, fingerprint):
+    try:
+        with open(path, 'r', encoding='utf8') as index_file:
+            index = json.load(index_file)
+    except (OSError, ValueError):
+        return {}
+    if (not isinstance(index, dict) or
+            index.get('version') != INDEX_VERSION or
+            index.get('fingerprint') != fingerprint):
+        return {}
+    return index
+
+
+def _write_index(path, index):
+    # Written to a temporary file first so that an interrupted run never
+    # leaves a partially written index
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(temp_path, 'w', encoding='utf8') as index_file:
+            json.dump(index, index_file)
+        os.replace(temp_path, path)
+    except OSError:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
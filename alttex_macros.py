@@ -0,0 +1,330 @@
+'''
+alttex_macros
+
+Reads the macros a document defines in its preamble (with '\\newcommand',
+'\\renewcommand', '\\providecommand' or '\\def') and expands them within its
+equations, so that e.g. '\\R' is converted as the '\\mathbb{R}' it stands for
+rather than as a command that is not in the csv file.
+
+Classes:
+    Macro
+    MacroError
+    MacroTable
+
+Functions:
+    read_macros
+'''
+
+import hashlib
+import re
+from typing import NamedTuple
+
+# Most macros expanded within each other, and most characters in an expanded
+# equation, so that a macro defined in terms of itself cannot stall the
+# conversion
+MAX_DEPTH = 32
+MAX_LENGTH = 100000
+
+COMMENTS = re.compile(r'(?<!\\)%.*')
+DEFINITIONS = re.compile(r'\\(?:(newcommand|renewcommand|providecommand)\*?|'
+                         r'(def))(?![A-Za-z])')
+MACRO_NAME = re.compile(r'\s*(\\(?:[A-Za-z]+|.))')
+PARAMETERS = re.compile(r'#(#|[1-9])')
+
+
+class Macro(NamedTuple):
+    '''
+    Class to represent a macro defined in the preamble
+
+    Attributes:
+        name (str) : Name of the macro without its backslash, e.g. 'R'
+        arguments (int) : Number of arguments, including an optional first
+            argument
+        default (str) : Value of the optional first argument when it is not
+            given (None if the first argument is not optional)
+        body (str) : Text the macro stands for, with '#1' to '#9' for its
+            arguments
+    '''
+    name: str
+    arguments: int
+    default: str
+    body: str
+
+
+class MacroError(ValueError):
+    '''
+    Class to represent a macro whose expansion is nested too deeply or is too
+    long (see 'MacroTable')
+    '''
+
+
+def read_macros(preamble, max_depth=MAX_DEPTH, max_length=MAX_LENGTH):
+    '''
+    Function to find the macros defined in the preamble of a LaTeX document
+
+    Definitions that cannot be read (e.g. '\\def' with delimited arguments)
+    are left out, so those macros are converted as they are written.
+
+    Parameters:
+        preamble (str) : Text of the document before '\\begin{document}'
+        max_depth (int) : Most macros expanded within each other
+        max_length (int) : Most characters in an expanded equation
+
+    Returns:
+        macros (MacroTable) : Table of the macros defined in 'preamble'
+    '''
+    preamble = COMMENTS.sub('', preamble)
+    macros = {}
+    for match in DEFINITIONS.finditer(preamble):
+        command = match.group(1) or match.group(2)
+        if command == 'def':
+            macro = _read_def(preamble, match.end())
+        else:
+            macro = _read_newcommand(preamble, match.end())
+        if macro is None:
+            continue
+        # As in LaTeX, '\\newcommand' and '\\providecommand' do not replace a
+        # macro that is already defined
+        if (command in ('newcommand', 'providecommand') and
+                macro.name in macros):
+            continue
+        macros[macro.name] = macro
+    return MacroTable(macros.values(), max_depth, max_length)
+
+
+def _read_newcommand(text, index):
+    # e.g. '{\\vect}[1]{\\mathbf{#1}}', '\\R{\\mathbb{R}}' or
+    # '{\\norm}[2][2]{\\|#2\\|_{#1}}'
+    index = _skip_spaces(text, index)
+    braced = text.startswith('{', index)
+    match = MACRO_NAME.match(text, index + 1 if braced else index)
+    if match is None:
+        return None
+    name = match.group(1)[1:]
+    index = match.end()
+    if braced:
+        index = _skip_spaces(text, index)
+        if not text.startswith('}', index):
+            return None
+        index += 1
+    arguments = 0
+    default = None
+    index = _skip_spaces(text, index)
+    if text.startswith('[', index):
+        end = text.find(']', index)
+        try:
+            arguments = int(text[index + 1:end])
+        except ValueError:
+            return None
+        index = _skip_spaces(text, end + 1)
+        if text.startswith('[', index):
+            default, index = _bracketed(text, index, '[', ']')
+            if default is None:
+                return None
+            index = _skip_spaces(text, index)
+    if not 0 <= arguments <= 9 or not text.startswith('{', index):
+        return None
+    body, _ = _bracketed(text, index, '{', '}')
+    if body is None:
+        return None
+    return Macro(name, arguments, default, body)
+
+
+def _read_def(text, index):
+    # e.g. '\\vect#1{\\mathbf{#1}}', where the arguments must be '#1', '#2'
+    # and so on in order
+    match = MACRO_NAME.match(text, index)
+    if match is None:
+        return None
+    name = match.group(1)[1:]
+    start = match.end()
+    end = text.find('{', start)
+    if end < 0:
+        return None
+    parameters = text[start:end].replace(' ', '')
+    arguments = len(parameters) // 2
+    if (arguments > 9 or
+            parameters != ''.join('#%d' % (i + 1) for i in range(arguments))):
+        return None
+    body, _ = _bracketed(text, end, '{', '}')
+    if body is None:
+        return None
+    return Macro(name, arguments, None, body)
+
+
+def _skip_spaces(text, index):
+    while index < len(text) and text[index] in ' \t\r\n':
+        index += 1
+    return index
+
+
+def _bracketed(text, index, open_char, close_char):
+    # Text between the bracket at 'index' and its match, and the index after
+    # the match (None if it has no match). Escaped brackets and '\\\\' are not
+    # counted
+    depth = 0
+    position = index
+    while position < len(text):
+        char = text[position]
+        if char == '\\':
+            position += 2
+            continue
+        if char == open_char:
+            depth += 1
+        elif char == close_char:
+            depth -= 1
+            if depth == 0:
+                return text[index + 1:position], position + 1
+        position += 1
+    return None, index
+
+
+class MacroTable:
+    '''
+    Class to expand the macros of a document within its equations
+
+    Each macro is expanded once for each set of arguments it is given, and
+    the expansion is kept, so a macro used thousands of times costs little
+    more than one used once. A table can be shared by many threads.
+
+    Attributes:
+        macros (dict) : Name of each macro (without its backslash) mapped to
+            its 'Macro'
+        max_depth (int) : Most macros expanded within each other
+        max_length (int) : Most characters in an expanded equation
+        fingerprint (str) : Hash of the macros, so that alt text made with
+            other macros is not reused
+    '''
+
+    def __init__(self, macros=(), max_depth=MAX_DEPTH,
+                 max_length=MAX_LENGTH):
+        '''
+        Parameters:
+            macros (iterable) : Macros of the document (see 'read_macros')
+            max_depth (int) : Most macros expanded within each other
+            max_length (int) : Most characters in an expanded equation
+        '''
+        self.macros = {macro.name: macro for macro in macros}
+        self.max_depth = max_depth
+        self.max_length = max_length
+        self.fingerprint = hashlib.sha256(repr(
+            sorted(self.macros.values())).encode('utf8')).hexdigest()
+        # '\\\\' is matched first so that it is never read as the start of a
+        # macro. Longer names are tried first, and a name made of letters
+        # must not be followed by another letter
+        names = sorted(self.macros, key=len, reverse=True)
+        self._pattern = re.compile(r'\\\\|\\(%s)' % '|'.join(
+            re.escape(name) + ('(?![A-Za-z])' if name.isalpha() else '')
+            for name in names)) if names != [] else None
+        self._expansions = {}
+
+    def __len__(self):
+        return len(self.macros)
+
+    def expand(self, equation):
+        '''
+        Function to expand every macro within an equation
+
+        Parameters:
+            equation (str) : Equation within math text
+
+        Returns:
+            expanded (str) : 'equation' with each macro replaced by the text
+                it stands for (a macro missing arguments at the end of
+                'equation' is left as it is). 'MacroError' is raised if
+                macros are expanded more than 'max_depth' times within each
+                other, or 'expanded' would be longer than 'max_length'
+        '''
+        if self._pattern is None:
+            return equation
+        return self._expand(equation, 0)
+
+    def _expand(self, text, depth):
+        pieces = []
+        length = 0
+        last = 0
+        position = 0
+        while True:
+            match = self._pattern.search(text, position)
+            if match is None:
+                break
+            position = match.end()
+            name = match.group(1)
+            if name is None:
+                continue
+            macro = self.macros[name]
+            arguments, end = _arguments(text, position, macro)
+            if arguments is None:
+                continue
+            key = (name, arguments)
+            expansion = self._expansions.get(key)
+            if expansion is None:
+                if depth >= self.max_depth:
+                    raise MacroError('\\%s is expanded within more than %d '
+                                     'other macros' % (name, self.max_depth))
+                expansion = self._expand(_substitute(macro.body, arguments),
+                                         depth + 1)
+                self._expansions[key] = expansion
+            pieces.append(text[last:match.start()])
+            pieces.append(expansion)
+            length += match.start() - last + len(expansion)
+            if length > self.max_length:
+                raise MacroError('\\%s expands to more than %d characters' %
+                                 (name, self.max_length))
+            last = position = end
+        if last == 0:
+            return text
+        pieces.append(text[last:])
+        return ''.join(pieces)
+
+
+def _arguments(text, index, macro):
+    # Arguments given to the macro after 'index', and the index after them
+    # (None if there are too few)
+    arguments = []
+    count = macro.arguments
+    if macro.default is not None:
+        count -= 1
+        position = _skip_spaces(text, index)
+        if text.startswith('[', position):
+            value, position = _bracketed(text, position, '[', ']')
+            if value is None:
+                return None, index
+            index = position
+        else:
+            value = macro.default
+        arguments.append(value)
+    for _ in range(count):
+        index = _skip_spaces(text, index)
+        if index >= len(text):
+            return None, index
+        if text[index] == '{':
+            value, position = _bracketed(text, index, '{', '}')
+            if value is None:
+                return None, index
+            index = position
+        else:
+            # An argument without braces is a single command or character
+            match = MACRO_NAME.match(text, index)
+            if match is not None and text[index] == '\\':
+                value = match.group(1)
+                index = match.end()
+            else:
+                value = text[index]
+                index += 1
+        arguments.append(value)
+    return tuple(arguments), index
+
+
+def _substitute(body, arguments):
+    # Body of the macro with '#1' to '#9' replaced by its arguments (and '##'
+    # by '#')
+    if arguments == ():
+        return body.replace('##', '#')
+
+    def argument(match):
+        if match.group(1) == '#':
+            return '#'
+        number = int(match.group(1))
+        return arguments[number - 1] if number <= len(arguments) else ''
+    return PARAMETERS.sub(argument, body)
@@ -0,0 +1,221 @@
+'''
+alttex_parallel
+
+Converts the equations of a single large document across a pool of
+processes: the document is read once to collect every equation (including
+those within tables), the distinct equations are converted in chunks by the
+pool, and the alt text is then put back together in document order. The
+result is exactly the same as converting the document in one process.
+
+Functions:
+    collect_equations
+    parallel_tokenise
+'''
+
+import os
+import alttex_functions
+from alttex_functions import (_doc_spans, _with_macros, collecting,
+                              iter_tokenise, recording, replay,
+                              stream_tokenise)
+
+# Fewer equations than this are converted in this process, as starting the
+# pool would take longer than converting them
+MIN_PARALLEL_EQUATIONS = 256
+# Chunks given to each process, so that a chunk of slow equations does not
+# hold up the rest of the pool
+CHUNKS_PER_JOB = 4
+
+_worker = {}
+
+
+def collect_equations(latex_file, delimiters, symbols, special_symbols,
+                      index=None):
+    '''
+    Function to find every equation of a LaTeX document that would be passed
+    to 'eqn_tokenise', without converting any of them
+
+    Parameters:
+        latex_file (file) : LaTeX document opened for reading (or any
+            iterable of its lines)
+        delimiters (list) : Math text characters to search between
+        symbols (SymbolTable) : Table of LaTeX symbols in csv file with their
+            alt text
+        special_symbols (dict) : Dictionary of math symbols to be replaced
+        index (SpanIndex) : Alt text of the parts of the document from the
+            last run, whose equations are left out (None to collect the
+            equations of the whole document)
+
+    Returns:
+        equations (list) : Distinct equations, in the order they are first
+            found in the document, with the macros defined in its preamble
+            expanded
+    '''
+    collector = _EquationCollector()
+    recorder = None
+    # Diagnostics are only recorded when the document is converted
+    with collecting(None):
+        for span in _doc_spans(latex_file):
+            if recorder is None:
+                # The preamble is within the first span
+                recorder = _with_macros(span, collector, index)
+            if index is not None and index.get(span) is not None:
+                continue
+            for _ in iter_tokenise(span, delimiters, symbols,
+                                   special_symbols, recorder):
+                pass
+    return list(collector.equations)
+
+
+def parallel_tokenise(latex_file, delimiters, symbols, special_symbols,
+                      cache=None, index=None, jobs=None, budget=None):
+    '''
+    Function to tokenise a LaTeX document, converting its equations across
+    a pool of processes
+
+    Unlike 'stream_tokenise', the whole document is read before the first
+    fragment is yielded. Equations that fail to convert in the pool are
+    converted again in this process, so any error is raised where
+    'stream_tokenise' would raise it, and the diagnostics found by the pool
+    are recorded each time the equation is put back (see 'collecting').
+
+    Parameters:
+        latex_file (file) : LaTeX document opened for reading (or any
+            iterable of its lines)
+        delimiters (list) : Math text characters to search between
+        symbols (SymbolTable) : Table of LaTeX symbols in csv file with their
+            alt text
+        special_symbols (dict) : Dictionary of math symbols to be replaced
+        cache (EquationCache) : Cache of the alt text of equations, whose
+            'function' the pool converts with (None to convert with
+            'eqn_tokenise')
+        index (SpanIndex) : Alt text of the parts of the document from the
+            last run, so that only edited parts are converted (None to
+            convert the whole document)
+        jobs (int) : Number of processes (defaults to the number of CPUs)
+        budget (Budget) : Limits on the time and size of each equation and
+            table (None for no limits, see 'alttex_budget')
+
+    Yields:
+        fragment (str) : Next part of the alt text version of the document
+            (see 'stream_tokenise')
+    '''
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    lines = _Lines(latex_file)
+    lines.name = getattr(latex_file, 'name', None)
+    equations = collect_equations(lines, delimiters, symbols,
+                                  special_symbols, index)
+    alt_equations = {}
+    found = {}
+    if jobs > 1 and len(equations) >= MIN_PARALLEL_EQUATIONS:
+        function = None if cache is None else cache.function
+        alt_equations, found = _convert_equations(equations, symbols,
+                                                  special_symbols, function,
+                                                  jobs, budget)
+    yield from stream_tokenise(lines, delimiters, symbols, special_symbols,
+                               _Converted(alt_equations, found, cache),
+                               index, budget)
+
+
+def _convert_equations(equations, symbols, special_symbols, function, jobs,
+                       budget):
+    # Alt text of each equation converted by the pool, leaving out those
+    # that failed or were over budget, and the diagnostics found in each
+    # Imported here as multiprocessing is slow to import, and most runs
+    # never start a pool
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures.process import BrokenProcessPool
+    size = -(-len(equations) // (jobs * CHUNKS_PER_JOB))
+    chunks = [equations[i:i + size] for i in range(0, len(equations), size)]
+    alt_equations = {}
+    found = {}
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                             initargs=(symbols, special_symbols, function,
+                                       budget)) as executor:
+        try:
+            for chunk, alt_chunk in zip(chunks, executor.map(_convert_chunk,
+                                                             chunks)):
+                for equation, (alt_equation, diagnostics) in zip(
+                        chunk, alt_chunk):
+                    if alt_equation is not None:
+                        alt_equations[equation] = alt_equation
+                        if diagnostics != []:
+                            found[equation] = diagnostics
+        except BrokenProcessPool:
+            # The rest are converted in this process
+            pass
+    return alt_equations, found
+
+
+def _init_worker(symbols, special_symbols, function, budget):
+    # Runs once in each worker process, so the symbol table is only sent
+    # once per process rather than with every chunk
+    _worker['symbols'] = symbols
+    _worker['special_symbols'] = special_symbols
+    _worker['convert'] = (alttex_functions.eqn_tokenise if function is None
+                          else function)
+    _worker['budget'] = budget
+
+
+def _convert_chunk(equations):
+    convert = _worker['convert']
+    budget = _worker['budget']
+    alt_chunk = []
+    for equation in equations:
+        try:
+            with collecting(None), recording() as found:
+                if budget is None:
+                    alt_equation = convert(equation, _worker['symbols'],
+                                           _worker['special_symbols'])
+                else:
+                    fallbacks = len(budget.diagnostics)
+                    alt_equation = budget.equation(
+                        equation, convert, _worker['symbols'],
+                        _worker['special_symbols'])
+                    # Fallback notes are made again in the main process, so
+                    # that they are recorded in its budget
+                    if len(budget.diagnostics) > fallbacks:
+                        alt_equation = None
+                        del budget.diagnostics[fallbacks:]
+        except Exception:
+            alt_equation = None
+        alt_chunk.append((alt_equation, found))
+    return alt_chunk
+
+
+class _EquationCollector:
+    # Stands in for the equation cache, recording each equation instead of
+    # converting it
+    def __init__(self):
+        self.equations = {}
+
+    def eqn_tokenise(self, equation, symbols, special_symbols):
+        self.equations[equation] = None
+        return ''
+
+
+class _Lines(list):
+    # Lines of the document read up front, keeping the name of its file for
+    # the position of each diagnostic
+    name = None
+
+
+class _Converted:
+    # Stands in for the equation cache, answering with the alt text from the
+    # pool and converting any other equation as usual
+    def __init__(self, alt_equations, found, cache):
+        self.alt_equations = alt_equations
+        self.found = found
+        self.cache = cache
+
+    def eqn_tokenise(self, equation, symbols, special_symbols):
+        alt_equation = self.alt_equations.get(equation)
+        if alt_equation is not None:
+            # Recorded each time, as if the equation had been converted here
+            replay(self.found.get(equation, ()))
+            return alt_equation
+        if self.cache is not None:
+            return self.cache.eqn_tokenise(equation, symbols, special_symbols)
+        # Looked up on each call so that it can be wrapped by a profiler
+        return alttex_functions.eqn_tokenise(equation, symbols,
+                                             special_symbols)
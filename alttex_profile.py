@@ -0,0 +1,284 @@
+'''
+alttex_profile
+
+Measures where the time of a conversion goes: the time and number of calls
+of each stage, the number of tokens of each kind, the peak memory and the
+slowest equations. Nothing is measured (or slowed down) unless a Profiler is
+enabled.
+
+Classes:
+    Profiler
+'''
+
+import heapq
+import inspect
+import itertools
+import json
+import sys
+import time
+import tracemalloc
+from collections import Counter
+import alttex_functions
+
+STAGES = {
+    'find_equations': 'delimiter detection',
+    'math_spans': 'delimiter detection',
+    'eqn_tokenise': 'eqn_tokenise',
+    'nested_brackets': 'nested_brackets',
+    'tabular': 'tabular',
+    'iter_tabular': 'tabular',
+    # Commands within brackets are replaced by 'CommandSubstituter', and
+    # the rest are looked up by 'convert_commands'
+    'CommandSubstituter.substitute': 'symbol lookup',
+    'convert_commands': 'symbol lookup',
+}
+
+
+class Profiler:
+    '''
+    Class to profile the functions in 'alttex_functions' while it is enabled,
+    e.g.
+        with Profiler() as profiler:
+            write_altex(stream_tokenise(...), altex_file)
+        profiler.save('profile.json')
+
+    The functions are only wrapped while the profiler is enabled, so there is
+    no cost to a conversion that is not profiled.
+
+    Attributes:
+        top (int) : Number of slowest equations to keep
+        stages (dict) : Name of each stage mapped to a dictionary of its
+            number of calls and total time in seconds
+        tokens (dict) : 'document' and 'equation' mapped to the number of
+            tokens of each kind found by 'iter_tokenise' and 'eqn_tokenise'
+        peak_memory (int) : Most memory allocated while enabled, in bytes
+        seconds (float) : Time the profiler was enabled for
+    '''
+
+    def __init__(self, top=10):
+        '''
+        Parameters:
+            top (int) : Number of slowest equations to keep
+        '''
+        self.top = top
+        self.stages = {stage: {'calls': 0, 'seconds': 0.0}
+                       for stage in STAGES.values()}
+        self.tokens = {'document': Counter(), 'equation': Counter()}
+        self.peak_memory = None
+        self.seconds = 0.0
+        self._slowest = []
+        self._order = itertools.count()
+        self._originals = {}
+        self._depths = {}
+        self._start = None
+        self._file = None
+        self._lines_read = 0
+        self._span = ''
+
+    def __enter__(self):
+        self.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.disable()
+
+    def enable(self):
+        '''
+        Function to start profiling, by wrapping the functions and token
+        scanners in 'alttex_functions'
+        '''
+        if self._originals != {}:
+            return
+        # The equation cache and converter call their own references to
+        # 'eqn_tokenise'
+        modules = [alttex_functions] + [sys.modules[name] for name in
+                                        ('alttex_cache', 'alttex_converter')
+                                        if name in sys.modules]
+        for name, stage in STAGES.items():
+            owner, _, method = name.rpartition('.')
+            if owner != '':
+                # Methods are wrapped on their class, which is shared by
+                # every module
+                owner = getattr(alttex_functions, owner)
+                self._patch(owner, method,
+                            self._timed(getattr(owner, method), stage))
+                continue
+            wrapper = self._timed(getattr(alttex_functions, name), stage)
+            for module in modules:
+                if hasattr(module, name):
+                    self._patch(module, name, wrapper)
+        self._patch(alttex_functions, 'DOC_TOKENS',
+                    _CountingScanner(alttex_functions.DOC_TOKENS,
+                                     self.tokens['document']))
+        self._patch(alttex_functions, 'EQN_TOKENS',
+                    _CountingScanner(alttex_functions.EQN_TOKENS,
+                                     self.tokens['equation']))
+        self._patch(alttex_functions, '_doc_lines',
+                    self._counted_lines(alttex_functions._doc_lines))
+        self._patch(alttex_functions, 'iter_tokenise',
+                    self._tracked_spans(alttex_functions.iter_tokenise))
+        tracemalloc.start()
+        self._start = time.perf_counter()
+
+    def disable(self):
+        '''
+        Function to stop profiling, putting back the original functions
+        '''
+        if self._originals == {}:
+            return
+        self.seconds += time.perf_counter() - self._start
+        self.peak_memory = max(self.peak_memory or 0,
+                               tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        for (module, name), original in self._originals.items():
+            setattr(module, name, original)
+        self._originals = {}
+
+    def slowest_equations(self):
+        '''
+        Function to list the slowest equations passed to 'eqn_tokenise'
+
+        Returns:
+            equations (list) : Dictionaries of the time in seconds, file,
+                line number and text of each equation, slowest first
+        '''
+        return [{'seconds': seconds, 'file': file, 'line': line,
+                 'equation': equation}
+                for seconds, _, file, line, equation
+                in sorted(self._slowest, reverse=True)]
+
+    def report(self):
+        '''
+        Function to summarise the profile
+
+        Returns:
+            report (dict) : Total time, peak memory, stages, token counts
+                and slowest equations
+        '''
+        return {'seconds': self.seconds,
+                'peak_memory_bytes': self.peak_memory,
+                'stages': self.stages,
+                'tokens': {scanner: dict(counts.most_common())
+                           for scanner, counts in self.tokens.items()},
+                'slowest_equations': self.slowest_equations()}
+
+    def save(self, path):
+        '''
+        Function to write the profile to a file as JSON
+
+        Parameters:
+            path (str) : Path to write the profile to
+        '''
+        with open(path, 'w', encoding='utf8') as profile_file:
+            json.dump(self.report(), profile_file, indent=2)
+
+    def _patch(self, module, name, replacement):
+        self._originals[(module, name)] = getattr(module, name)
+        setattr(module, name, replacement)
+
+    def _timed(self, function, stage):
+        totals = self.stages[stage]
+        # Shared by the functions of a stage, e.g. 'tabular' and
+        # 'iter_tabular'
+        depth = self._depths.setdefault(stage, [0])
+        if inspect.isgeneratorfunction(function):
+            return self._timed_generator(function, totals, depth)
+
+        def wrapper(*args, **kwargs):
+            totals['calls'] += 1
+            # Only the outermost call is timed, so that time is not counted
+            # twice if the stage calls itself
+            if depth[0] > 0:
+                return function(*args, **kwargs)
+            depth[0] += 1
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start
+                depth[0] -= 1
+                totals['seconds'] += seconds
+                if stage == 'eqn_tokenise':
+                    self._record_equation(args[0], seconds)
+        return wrapper
+
+    def _timed_generator(self, function, totals, depth):
+        # The time of a generator is the time spent making each item
+        def wrapper(*args, **kwargs):
+            if depth[0] > 0:
+                yield from function(*args, **kwargs)
+                return
+            totals['calls'] += 1
+            items = function(*args, **kwargs)
+            while True:
+                depth[0] += 1
+                start = time.perf_counter()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+                finally:
+                    totals['seconds'] += time.perf_counter() - start
+                    depth[0] -= 1
+                yield item
+        return wrapper
+
+    def _record_equation(self, equation, seconds):
+        entry = (seconds, next(self._order), self._file,
+                 self._equation_line(equation), equation)
+        if len(self._slowest) < self.top:
+            heapq.heappush(self._slowest, entry)
+        elif seconds > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, entry)
+
+    def _equation_line(self, equation):
+        # Each line of the document is followed by an extra newline within a
+        # span (see 'begin_doc'), and '_doc_lines' reads one line ahead, so
+        # the line of the equation is found by counting back from the end of
+        # the span
+        position = self._span.find(equation)
+        if position < 0:
+            return None
+        return max(1, self._lines_read -
+                   self._span.count('\n', position) // 2)
+
+    def _counted_lines(self, doc_lines):
+        def wrapper(latex_file):
+            self._file = getattr(latex_file, 'name', None)
+            self._lines_read = 0
+
+            def counted(lines):
+                for line in lines:
+                    self._lines_read += 1
+                    yield line
+            return doc_lines(counted(latex_file))
+        return wrapper
+
+    def _tracked_spans(self, iter_tokenise):
+        def wrapper(latex_doc, *args, **kwargs):
+            self._span = latex_doc
+            return iter_tokenise(latex_doc, *args, **kwargs)
+        return wrapper
+
+
+class _CountingScanner:
+    # Stands in for a compiled token scanner, counting the kind of each token
+    # that is found
+    def __init__(self, pattern, counts):
+        self.pattern = pattern
+        self.counts = counts
+
+    def search(self, string, pos=0):
+        match = self.pattern.search(string, pos)
+        if match is not None:
+            self.counts[match.lastgroup] += 1
+        return match
+
+    def finditer(self, string, pos=0):
+        for match in self.pattern.finditer(string, pos):
+            self.counts[match.lastgroup] += 1
+            yield match
+
+    def __getattr__(self, name):
+        # e.g. 'groupindex', used by 'doc_token_stream'
+        return getattr(self.pattern, name)
@@ -0,0 +1,526 @@
+'''
+alttex_server
+
+Serves conversions over HTTP (on a TCP port or a Unix socket) from a pool of
+worker processes that have already loaded the symbol table, so that each
+request is answered without any setup cost. Includes a client for load
+tests, e.g.
+    python alttex_server.py serve --port 8765 --workers 4
+    python alttex_server.py load-test --port 8765 --requests 1000
+
+Requests:
+    POST /document : Body is a LaTeX document, answered with its alt text
+        version (as written by 'write_altex')
+    POST /equation : Body is a single equation, answered with its alt text
+    GET /stats : Answered with the number of requests, rejections and
+        batches so far
+
+Responses are JSON, with 'alt_text' (or 'error'), 'seconds', the time the
+request spent queued, being converted and in total, and 'fallbacks', the
+equations and tables of the request that were over the server's budget.
+
+Classes:
+    ConversionServer
+
+Functions:
+    load_test
+    request
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from alttex_cache import EquationCache
+from alttex_converter import AltTexConverter
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+           413: 'Payload Too Large', 500: 'Internal Server Error',
+           503: 'Service Unavailable', 504: 'Gateway Timeout'}
+KINDS = {'/document': 'document', '/equation': 'equation'}
+
+_worker = {}
+
+
+def _init_worker(csv_path, budget):
+    # Runs once in each worker process, so every request is converted with
+    # a warm symbol table and equation cache
+    _worker['converter'] = AltTexConverter(csv_path,
+                                           cache=EquationCache(),
+                                           budget=budget)
+    _worker['converter'].convert_equation('x')
+
+
+def _convert_jobs(jobs):
+    # Converts a batch of (kind, text) jobs in a worker process, giving
+    # (alt_text, error, seconds, fallbacks) for each
+    converter = _worker['converter']
+    budget = converter.budget
+    results = []
+    for kind, text in jobs:
+        start = time.perf_counter()
+        fallbacks = 0 if budget is None else len(budget.diagnostics)
+        try:
+            if kind == 'document':
+                alt_text = converter.convert_document(text)
+            else:
+                alt_text = converter.convert_equation(text)
+            error = None
+        except Exception as exception:
+            alt_text = None
+            error = '%s: %s' % (type(exception).__name__, exception)
+        notes = []
+        if budget is not None:
+            # Taken out of the budget, so that it only keeps the notes of
+            # the request being converted
+            notes = budget.diagnostics[fallbacks:]
+            del budget.diagnostics[fallbacks:]
+        results.append((alt_text, error, time.perf_counter() - start,
+                        notes))
+    return results
+
+
+def _ping():
+    return os.getpid()
+
+
+class ConversionServer:
+    '''
+    Class to serve conversions from a pool of warm worker processes
+
+    Requests wait in a bounded queue, and are sent to the workers in batches
+    of up to 'batch_size', so that many small requests share the cost of
+    reaching a worker. A request that arrives when the queue is full is
+    answered straight away with status 503, rather than slowing down every
+    other request. Each equation and table of a request is converted within
+    'budget', and a request that takes longer than 'timeout' is answered
+    with status 504. If a worker process dies (e.g. killed for using too
+    much memory) the requests it was converting fail, and the pool is
+    replaced with a new one.
+
+    Attributes:
+        csv_path (str) : Path to 'LaTeX_Symbols.csv'
+        workers (int) : Number of worker processes
+        queue_size (int) : Most requests waiting to be converted
+        batch_size (int) : Most requests sent to a worker at once
+        batch_wait (float) : Longest time in seconds to wait for a batch to
+            fill up
+        max_body (int) : Largest request body in bytes
+        budget (Budget) : Limits on the time and size of each equation and
+            table of a request (None for no limits, see 'alttex_budget')
+        timeout (float) : Longest time in seconds a request waits for its
+            alt text (None for no limit)
+        stats (dict) : Number of requests, rejections, errors, timeouts,
+            batches and restarts of the pool
+    '''
+
+    def __init__(self, csv_path='LaTeX_Symbols.csv', workers=None,
+                 queue_size=256, batch_size=16, batch_wait=0.002,
+                 max_body=16 * 1024 * 1024, budget=None, timeout=60.0):
+        '''
+        Parameters:
+            csv_path (str) : Path to 'LaTeX_Symbols.csv'
+            workers (int) : Number of worker processes (defaults to the
+                number of CPUs)
+            queue_size (int) : Most requests waiting to be converted
+            batch_size (int) : Most requests sent to a worker at once
+            batch_wait (float) : Longest time in seconds to wait for a batch
+                to fill up
+            max_body (int) : Largest request body in bytes
+            budget (Budget) : Limits on the time and size of each equation
+                and table of a request, which each worker has a copy of
+            timeout (float) : Longest time in seconds a request waits for
+                its alt text
+        '''
+        self.csv_path = os.path.abspath(csv_path)
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.max_body = max_body
+        self.budget = budget
+        self.timeout = timeout
+        self.stats = {'requests': 0, 'rejected': 0, 'errors': 0,
+                      'timeouts': 0, 'batches': 0, 'restarts': 0}
+        self._queue = None
+        self._pool = None
+        self._slots = None
+        self._dispatcher = None
+
+    async def start(self):
+        '''
+        Function to start the worker processes, waiting until each of them
+        has loaded the symbol table
+        '''
+        loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        # Only one batch per worker is sent at a time, so requests beyond
+        # that wait in the bounded queue
+        self._slots = asyncio.Semaphore(self.workers)
+        self._pool = self._new_pool()
+        await asyncio.gather(*[loop.run_in_executor(self._pool, _ping)
+                               for _ in range(self.workers)])
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def close(self):
+        '''
+        Function to stop sending work to the worker processes and shut them
+        down
+        '''
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+
+    async def convert(self, kind, text):
+        '''
+        Function to convert a document or equation in a worker process
+
+        Parameters:
+            kind (str) : 'document' or 'equation'
+            text (str) : LaTeX document or equation
+
+        Returns:
+            result (dict) : 'alt_text' (or 'error' if the conversion failed),
+                'seconds', the time spent queued, being converted and in
+                total, and 'fallbacks', the notes of each equation or table
+                over budget (None if the queue is full)
+
+        Raises:
+            asyncio.TimeoutError : If the alt text is not ready within
+                'timeout'
+        '''
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        try:
+            self._queue.put_nowait((kind, text, future, loop.time()))
+        except asyncio.QueueFull:
+            self.stats['rejected'] += 1
+            return None
+        self.stats['requests'] += 1
+        try:
+            # The future is cancelled on a timeout, so its result is thrown
+            # away when the worker finishes
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            self.stats['timeouts'] += 1
+            raise
+
+    async def serve(self, host='127.0.0.1', port=8765, unix_path=None):
+        '''
+        Function to start the workers and answer requests until cancelled
+
+        Parameters:
+            host (str) : Address to listen on
+            port (int) : Port to listen on
+            unix_path (str) : Path of a Unix socket to listen on instead of
+                'host' and 'port'
+        '''
+        await self.start()
+        if unix_path is not None:
+            server = await asyncio.start_unix_server(self._handle,
+                                                     path=unix_path)
+        else:
+            server = await asyncio.start_server(self._handle, host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.close()
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.batch_wait
+            while len(batch) < self.batch_size:
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(),
+                                                        timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._slots.acquire()
+            self.stats['batches'] += 1
+            sent = loop.time()
+            jobs = [(kind, text) for kind, text, _, _ in batch]
+            pool = self._pool
+            try:
+                work = loop.run_in_executor(pool, _convert_jobs, jobs)
+            except BrokenProcessPool:
+                # Broken by a worker that died since the last batch
+                self._restart(pool)
+                pool = self._pool
+                work = loop.run_in_executor(pool, _convert_jobs, jobs)
+            work.add_done_callback(
+                lambda work, batch=batch, sent=sent, pool=pool:
+                self._finish(work, batch, sent, pool))
+
+    def _new_pool(self):
+        return ProcessPoolExecutor(max_workers=self.workers,
+                                   initializer=_init_worker,
+                                   initargs=(self.csv_path, self.budget))
+
+    def _restart(self, pool):
+        # Replaces a pool broken by a worker that died, unless it has
+        # already been replaced (every batch sent to it fails)
+        if pool is not self._pool:
+            return
+        self.stats['restarts'] += 1
+        pool.shutdown(wait=False, cancel_futures=True)
+        self._pool = self._new_pool()
+
+    def _finish(self, work, batch, sent, pool):
+        self._slots.release()
+        now = asyncio.get_running_loop().time()
+        try:
+            results = work.result()
+        except Exception as exception:
+            if isinstance(exception, BrokenProcessPool):
+                self._restart(pool)
+            results = [(None, '%s: %s' % (type(exception).__name__,
+                                          exception), 0.0, [])] * len(batch)
+        for (_, _, future, queued), (alt_text, error, seconds, notes) in \
+                zip(batch, results):
+            if future.done():
+                continue
+            result = {'seconds': {'queue': sent - queued,
+                                  'convert': seconds,
+                                  'total': now - queued},
+                      'batch_size': len(batch),
+                      'fallbacks': notes}
+            if error is None:
+                result['alt_text'] = alt_text
+            else:
+                self.stats['errors'] += 1
+                result['error'] = error
+            future.set_result(result)
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if request_line.strip() == b'':
+                    break
+                parts = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                if length > self.max_body:
+                    await self._respond(writer, 413,
+                                        {'error': 'Body too large'}, False)
+                    break
+                body = await reader.readexactly(length)
+                status, result = await self._route(parts, body)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                await self._respond(writer, status, result, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _route(self, parts, body):
+        if len(parts) < 2:
+            return 400, {'error': 'Bad request line'}
+        method, path = parts[0], parts[1]
+        if method == 'GET' and path == '/stats':
+            return 200, dict(self.stats, queued=self._queue.qsize())
+        if method != 'POST' or path not in KINDS:
+            return 404, {'error': 'Unknown request %s %s' % (method, path)}
+        try:
+            text = body.decode('utf8')
+        except UnicodeDecodeError:
+            return 400, {'error': 'Body is not UTF-8'}
+        try:
+            result = await self.convert(KINDS[path], text)
+        except asyncio.TimeoutError:
+            return 504, {'error': 'No alt text within %gs' % self.timeout}
+        if result is None:
+            return 503, {'error': 'Queue is full'}
+        return (500 if 'error' in result else 200), result
+
+    async def _respond(self, writer, status, result, keep_alive):
+        body = json.dumps(result).encode('utf8')
+        headers = ['HTTP/1.1 %d %s' % (status, REASONS[status]),
+                   'Content-Type: application/json',
+                   'Content-Length: %d' % len(body),
+                   'Connection: %s' % ('keep-alive' if keep_alive
+                                       else 'close')]
+        if status == 503:
+            headers.append('Retry-After: 1')
+        writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1') +
+                     body)
+        await writer.drain()
+
+
+async def request(path, body=b'', host='127.0.0.1', port=8765,
+                  unix_path=None):
+    '''
+    Function to send one request to a running server
+
+    Parameters:
+        path (str) : '/document', '/equation' or '/stats'
+        body (bytes) : LaTeX document or equation (sent with POST if not
+            empty, otherwise GET is used)
+        host (str) : Address of the server
+        port (int) : Port of the server
+        unix_path (str) : Path of the server's Unix socket instead of 'host'
+            and 'port'
+
+    Returns:
+        status (int) : HTTP status code
+        result (dict) : Decoded JSON response
+    '''
+    if unix_path is not None:
+        reader, writer = await asyncio.open_unix_connection(unix_path)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    try:
+        method = 'POST' if body else 'GET'
+        writer.write(('%s %s HTTP/1.1\r\nHost: %s\r\nContent-Length: %d\r\n'
+                      'Connection: close\r\n\r\n' %
+                      (method, path, host, len(body))).encode('latin-1') +
+                     body)
+        await writer.drain()
+        status = int((await reader.readline()).split()[1])
+        length = 0
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            if name.strip().lower() == 'content-length':
+                length = int(value)
+        return status, json.loads(await reader.readexactly(length))
+    finally:
+        writer.close()
+
+
+async def load_test(body, path='/equation', requests=500, concurrency=32,
+                    host='127.0.0.1', port=8765, unix_path=None):
+    '''
+    Function to send many requests to a running server at once and measure
+    how quickly they are answered
+
+    Parameters:
+        body (bytes) : LaTeX document or equation sent with every request
+        path (str) : '/document' or '/equation'
+        requests (int) : Total number of requests
+        concurrency (int) : Number of requests sent at the same time
+        host (str) : Address of the server
+        port (int) : Port of the server
+        unix_path (str) : Path of the server's Unix socket instead of 'host'
+            and 'port'
+
+    Returns:
+        results (dict) : Number of requests, failures and rejections, total
+            time, requests per second, and latency percentiles in seconds
+    '''
+    latencies = []
+    counts = {'failed': 0, 'rejected': 0}
+    remaining = iter(range(requests))
+
+    async def client():
+        for _ in remaining:
+            start = time.perf_counter()
+            try:
+                status, _ = await request(path, body, host, port, unix_path)
+            except (ConnectionError, OSError, ValueError):
+                status = None
+            if status == 200:
+                latencies.append(time.perf_counter() - start)
+            elif status == 503:
+                counts['rejected'] += 1
+            else:
+                counts['failed'] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    seconds = time.perf_counter() - start
+    latencies.sort()
+    percentiles = {}
+    if latencies != []:
+        for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+            percentiles[name] = latencies[min(len(latencies) - 1,
+                                              int(fraction * len(latencies)))]
+        percentiles['mean'] = statistics.mean(latencies)
+        percentiles['max'] = latencies[-1]
+    return {'requests': requests, 'failed': counts['failed'],
+            'rejected': counts['rejected'], 'seconds': seconds,
+            'throughput': len(latencies) / seconds if seconds else 0.0,
+            'latency': percentiles}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Serve alt text conversions, or load test a server.')
+    parser.add_argument('mode', choices=['serve', 'load-test'])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', default=None,
+                        help='Unix socket to use instead of host and port')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes (serve)')
+    parser.add_argument('--queue-size', type=int, default=256,
+                        help='most requests waiting to be converted (serve)')
+    parser.add_argument('--batch-size', type=int, default=16,
+                        help='most requests sent to a worker at once (serve)')
+    parser.add_argument('--budget', type=float, default=None,
+                        help='most seconds to spend on one equation, with '
+                             'ten times as long for a table (serve)')
+    parser.add_argument('--timeout', type=float, default=60.0,
+                        help='most seconds a request waits for its alt text '
+                             '(serve)')
+    parser.add_argument('--requests', type=int, default=500,
+                        help='number of requests to send (load-test)')
+    parser.add_argument('--concurrency', type=int, default=32,
+                        help='requests sent at the same time (load-test)')
+    parser.add_argument('--document', default=None,
+                        help='LaTeX document to send instead of an equation '
+                             '(load-test)')
+    parser.add_argument('--equation', default=r'\frac{a}{b} + \sqrt{x^{2}}',
+                        help='equation to send (load-test)')
+    args = parser.parse_args()
+
+    if args.mode == 'serve':
+        budget = None
+        if args.budget is not None:
+            # Only imported when a budget is given, to keep start up fast
+            from alttex_budget import Budget
+            budget = Budget(seconds=args.budget,
+                            table_seconds=10 * args.budget)
+        server = ConversionServer(workers=args.workers,
+                                  queue_size=args.queue_size,
+                                  batch_size=args.batch_size, budget=budget,
+                                  timeout=args.timeout)
+        try:
+            asyncio.run(server.serve(args.host, args.port, args.unix))
+        except KeyboardInterrupt:
+            pass
+    else:
+        if args.document is not None:
+            with open(args.document, 'rb') as latex_file:
+                body, path = latex_file.read(), '/document'
+        else:
+            body, path = args.equation.encode('utf8'), '/equation'
+        print(json.dumps(asyncio.run(load_test(
+            body, path, args.requests, args.concurrency, args.host,
+            args.port, args.unix)), indent=2))
@@ -0,0 +1,164 @@
+'''
+alttex_symbols
+
+Loads 'LaTeX_Symbols.csv' into a hash-indexed table of LaTeX symbols and their
+alt text, with a binary snapshot cache so that the csv file is only parsed
+again when it changes.
+
+Classes:
+    SymbolTable
+'''
+
+import hashlib
+import io
+import os
+import pickle
+from types import MappingProxyType
+
+SNAPSHOT_VERSION = 1
+CACHE_DIR_NAME = '.alttex_cache'
+
+
+class SymbolTable:
+    '''
+    Class to look up the alt text of LaTeX symbols in the csv file
+
+    Attributes:
+        symbols (dict) : LaTeX symbols mapped to their alt text
+        categories (dict) : Category names (fifth column of the csv file)
+            mapped to dictionaries of the symbols in that category
+        fingerprint (str) : Hash of the rows the table was built from
+    '''
+
+    def __init__(self, rows):
+        '''
+        Parameters:
+            rows (list) : Rows of the csv file, where the first column is the
+                LaTeX symbol, the second column is its alt text and the fifth
+                column starts a new category
+        '''
+        self.symbols = {}
+        self.categories = {}
+        category = None
+        for row in rows:
+            if len(row) < 2:
+                continue
+            symbol, alt_text = row[0], row[1]
+            if len(row) > 4 and row[4] != '':
+                category = row[4]
+                self.categories.setdefault(category, {})
+            # The first row wins for repeated symbols, as 'list.index' did
+            self.symbols.setdefault(symbol, alt_text)
+            if symbol != '' and category is not None:
+                self.categories[category].setdefault(symbol, alt_text)
+        self.fingerprint = hashlib.sha256(
+            repr([row[:2] + row[4:5] for row in rows]).encode('utf8')
+            ).hexdigest()
+
+    def __contains__(self, symbol):
+        return symbol in self.symbols
+
+    def __getitem__(self, symbol):
+        return self.symbols[symbol]
+
+    def __iter__(self):
+        return iter(self.symbols)
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def get(self, symbol, default=None):
+        '''
+        Function to find the alt text of 'symbol'
+
+        Parameters:
+            symbol (str) : LaTeX symbol (without the backslash)
+            default : Value returned if 'symbol' is not in the table
+
+        Returns:
+            alt_text (str) : Alt text of 'symbol' (or 'default')
+        '''
+        return self.symbols.get(symbol, default)
+
+    def category(self, name):
+        '''
+        Function to view the symbols within one category of the csv file
+
+        Parameters:
+            name (str) : Category name, e.g. 'Delimiters' or 'Greek Letters'
+
+        Returns:
+            view (mappingproxy) : Read-only dictionary of the symbols in
+                the category with their alt text
+        '''
+        return MappingProxyType(self.categories[name])
+
+    @classmethod
+    def from_csv(cls, csv_path, cache_dir=None):
+        '''
+        Function to load the table from the csv file, reusing the binary
+        snapshot in 'cache_dir' when the csv file has not changed
+
+        Parameters:
+            csv_path (str) : Path to 'LaTeX_Symbols.csv'
+            cache_dir (str) : Directory for the snapshot (defaults to
+                '.alttex_cache' next to the csv file)
+
+        Returns:
+            table (SymbolTable) : Table of the symbols in the csv file
+        '''
+        if cache_dir is None:
+            csv_dir = os.path.dirname(os.path.abspath(csv_path))
+            cache_dir = os.path.join(csv_dir, CACHE_DIR_NAME)
+        snapshot_path = os.path.join(cache_dir,
+                                     os.path.basename(csv_path) + '.pickle')
+        stat = os.stat(csv_path)
+        stat_key = (stat.st_mtime_ns, stat.st_size)
+        snapshot = _read_snapshot(snapshot_path)
+        if snapshot is not None and snapshot['stat'] == stat_key:
+            return snapshot['table']
+
+        with open(csv_path, 'rb') as csv_file:
+            data = csv_file.read()
+        digest = hashlib.sha256(data).hexdigest()
+        if snapshot is not None and snapshot['digest'] == digest:
+            table = snapshot['table']
+        else:
+            # Only imported when the snapshot cannot be used
+            import csv
+            rows = list(csv.reader(io.StringIO(data.decode('utf8'))))
+            table = cls(rows)
+        _write_snapshot(snapshot_path, {'version': SNAPSHOT_VERSION,
+                                        'stat': stat_key, 'digest': digest,
+                                        'table': table})
+        return table
+
+
+def _read_snapshot(snapshot_path):
+    try:
+        with open(snapshot_path, 'rb') as snapshot_file:
+            snapshot = pickle.load(snapshot_file)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError,
+            ImportError):
+        return None
+    if (not isinstance(snapshot, dict) or
+            snapshot.get('version') != SNAPSHOT_VERSION):
+        return None
+    return snapshot
+
+
+def _write_snapshot(snapshot_path, snapshot):
+    # Written to a temporary file first so that parallel workers never read a
+    # partially written snapshot
+    temp_path = '%s.%d.tmp' % (snapshot_path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(snapshot_path), exist_ok=True)
+        with open(temp_path, 'wb') as snapshot_file:
+            pickle.dump(snapshot, snapshot_file,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, snapshot_path)
+    except OSError:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
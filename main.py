@@ -2,64 +2,162 @@
 main
 
 Uses 'alttex_functions' to convert a given document into its alt text version. 
+
+Run without arguments to convert 'LaTeX_Doc.txt' into 'Alt_Text', give
+documents, directories or glob patterns to convert them in a batch, e.g.
+    python main.py notes/ "archive/**/*.tex" --jobs 8
+or give '-' to convert standard input to standard output, e.g.
+    cat notes.tex | python main.py - > notes_alt.tex
 '''
 
-import re
-import csv
-from alttex_functions_Edit import *
+import argparse
+import sys
+from alttex_functions import *
+# The modules of each feature are imported where they are used, so that a
+# short conversion (e.g. from a commit hook) only imports what it needs
 
 
 if __name__ == '__main__':
-    with open('LaTeX_Symbols.csv', 'r') as csv_file:
-        symbols_table = [row for row in csv.reader(csv_file)]
-        symbols, converted_symbols = ([symbols_table[j][i] 
-                                       for j in range(len(symbols_table))] 
-                                       for i in range(2))
-    with open('LaTeX_Doc.txt', 'r', encoding="utf8") as latex_file:
-        latex_doc = [line for line in latex_file]     
+    parser = argparse.ArgumentParser(
+        description='Insert alt text for the math text of LaTeX documents.')
+    parser.add_argument('inputs', nargs='*',
+                        help='documents, directories or glob patterns to '
+                             'convert in a batch (each alt text version is '
+                             'written next to its document), or - to '
+                             'convert standard input to standard output')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of processes for a batch (defaults to '
+                             'the number of CPUs), or to convert the '
+                             'equations of a single document across '
+                             '(defaults to 1)')
+    parser.add_argument('--manifest', default='alttex_manifest.json',
+                        help='where to write the manifest of a batch')
+    parser.add_argument('--cache', default=None,
+                        help='sqlite database to keep the alt text of '
+                             'equations in between runs')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only convert the parts of each document '
+                             'edited since the last run')
+    parser.add_argument('--profile', nargs='?', default=None,
+                        const='alttex_profile.json',
+                        help='time each stage of the conversion and write '
+                             'the results as JSON (a batch is then '
+                             'converted in this process)')
+    parser.add_argument('--top', type=int, default=10,
+                        help='number of slowest equations in the profile')
+    parser.add_argument('--budget', type=float, default=None,
+                        metavar='SECONDS',
+                        help='most time to spend on one equation (and ten '
+                             'times as long on one table) before writing a '
+                             'todo note with its LaTeX instead')
+    parser.add_argument('--diagnostics', default=None, metavar='PATH',
+                        help='write the commands not in the csv file, '
+                             'unmatched delimiters and table rows that do '
+                             'not fit their table to PATH as JSON (or text '
+                             'if PATH ends with .txt) rather than listing '
+                             'them at the end')
+    args = parser.parse_args()
+    piped = args.inputs == ['-']
+    if '-' in args.inputs and not piped:
+        parser.error('- cannot be given with other inputs')
+    if piped and args.incremental:
+        parser.error('--incremental needs the path of the document')
+
+    budget = None
+    if args.budget is not None:
+        from alttex_budget import Budget
+        budget = Budget(seconds=args.budget, table_seconds=10 * args.budget)
 
-    special_symbols = {
-        r'_': ' subscript ', r'^': ' superscript ', 
-        r'>': ' greater than ', r'<': ' less than ', r'-': ' minus ',
-        r'/': ' over ', r'!': ' factorial ', r'|': ' vertical bar '
-    }
-    delimiters = [ 
-        r'\$\$(.*?)\$\$', r'\$(.*?)\$', r'\\\((.*?)\\\)', r'\\\[(.*?)\\\]', 
-        r'\\begin\{math\}(.*?)\\end\{math\}',
-        r'(?s)\\begin\{equation\}(.*)\\end\{equation\}'
-    ]
+    profiler = None
+    if args.profile is not None:
+        # Only imported when profiling, as tracemalloc and inspect are slow
+        # to import
+        from alttex_profile import Profiler
+        profiler = Profiler(top=args.top)
+        profiler.enable()
 
+    if args.inputs != [] and not piped:
+        from alttex_batch import convert_batch, find_documents
+        from alttex_converter import DELIMITERS, SPECIAL_SYMBOLS
+        from alttex_diagnostics import Diagnostics
+        manifest = convert_batch(find_documents(args.inputs), DELIMITERS,
+                                 SPECIAL_SYMBOLS,
+                                 jobs=1 if profiler is not None else args.jobs,
+                                 manifest_path=args.manifest,
+                                 cache_path=args.cache,
+                                 incremental=args.incremental,
+                                 budget=budget)
+        if profiler is not None:
+            profiler.disable()
+            profiler.save(args.profile)
+        for record in manifest['files']:
+            if record['status'] == 'failed':
+                print('%s: %s' % (record['input'], record['error']),
+                      file=sys.stderr)
+        print('Converted %d of %d documents in %.1fs (manifest: %s)' %
+              (manifest['documents'] - manifest['failed'],
+               manifest['documents'], manifest['seconds'], args.manifest))
+        if manifest['fallbacks'] > 0:
+            print('%d equations or tables were over budget and given a '
+                  'todo note with their LaTeX instead' %
+                  manifest['fallbacks'], file=sys.stderr)
+        diagnostics = Diagnostics()
+        diagnostics.update(manifest['diagnostics'])
+        if args.diagnostics is not None:
+            diagnostics.save(args.diagnostics)
+        elif len(diagnostics) > 0:
+            print(diagnostics.text(), file=sys.stderr)
+        sys.exit(1 if manifest['failed'] > 0 else 0)
 
-    latex_doc = begin_doc(latex_doc)
+    from alttex_cache import EquationCache
+    from alttex_converter import AltTexConverter
+    from alttex_diagnostics import Diagnostics
+    converter = AltTexConverter(
+        cache=EquationCache(path=args.cache),
+        jobs=1 if profiler is not None or args.jobs is None else args.jobs,
+        budget=budget)
+    index = None
+    if args.incremental:
+        from alttex_index import SpanIndex, index_path
+        index = SpanIndex(index_path('LaTeX_Doc.txt'), converter.symbols,
+                          converter.delimiters, converter.special_symbols,
+                          converter.engine)
 
 
 # DEBUGGING
 
-    test = ''
-#   use the yeild statement at the end of 'eqn_tokenise'
-    [print(token) for token in eqn_tokenise(test, symbols, converted_symbols, 
-                                            special_symbols)]
-#   use the return statement at the end of 'eqn_tokenise'
-    print(eqn_tokenise(test, symbols, converted_symbols, special_symbols))
+#   print the alt text of a single equation
+#    test = ''
+#    print(converter.convert_equation(test))
+
+#   print each fragment of the document's alt text as it is converted
+#    with open('LaTeX_Doc.txt', 'r', encoding="utf8") as latex_file:
+#        [print(fragment) for fragment in converter.iter_document(
+#            latex_file)]
 
-#   use the yield statement at the end of 'tokenise' and return statement at the
-#       end of 'eqn_tokenise'
-    [print(token) for token in tokenise(latex_doc, delimiters, symbols, 
-                                        converted_symbols, special_symbols)]
 
-#   use the return statement at the end of 'tokenise' and return statement at
-#      the end of 'eqn_tokenise'
-    altex_doc = tokenise(latex_doc, delimiters, symbols, converted_symbols, 
-                         special_symbols)
-    altex = re.split(r'\n', altex_doc)
-    
-with open('Alt_Text', 'w') as file:
-    for line in altex:
-        if line == '':
-            continue
-        if re.search(r'^\\\\.*', line) == None:
-            file.write(line)
-            file.write('\n')
-        else:
-            file.write(line)
-    file.close()
+    diagnostics = Diagnostics()
+    if piped:
+        # Anything else is written to standard error, so that only the alt
+        # text goes down the pipe
+        with collecting(diagnostics):
+            write_altex(converter.iter_document(sys.stdin), sys.stdout)
+    else:
+        with open('LaTeX_Doc.txt', 'r', encoding="utf8") as latex_file, \
+                open('Alt_Text', 'w') as file, collecting(diagnostics):
+            write_altex(converter.iter_document(latex_file, index), file)
+    if index is not None:
+        index.save()
+    converter.cache.close()
+    if budget is not None:
+        for note in budget.diagnostics:
+            print('%s over budget (%s): %s' % (note['kind'], note['reason'],
+                                               note['latex'][:60]),
+                  file=sys.stderr)
+    if args.diagnostics is not None:
+        diagnostics.save(args.diagnostics)
+    elif len(diagnostics) > 0:
+        print(diagnostics.text(), file=sys.stderr)
+    if profiler is not None:
+        profiler.disable()
+        profiler.save(args.profile)